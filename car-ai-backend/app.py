@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, Request, request, jsonify
 import base64
 import os
 import re
@@ -9,6 +9,22 @@ from dotenv import load_dotenv
 import logging
 from datetime import datetime
 import json
+import time
+import hashlib
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, TimeoutError as FuturesTimeoutError
+from cache import LRUCache, all_stats as cache_stats
+import car_schema
+import gemini_client
+import metrics
+import records
+from catalog import VehicleCatalog
+from history_store import HistoryStore
+from collection_store import CollectionStore, CollectionError, CollectionNotFoundError
+from persistence import PersistenceQueue
+from imaging import encode_image, ImageTooLargeError, MAX_REQUEST_BYTES, IMAGE_MAX_PIXELS
+from jobs import JobStore, JobQueue, JobQueueFullError, DONE, FAILED, FINISHED
+from singleflight import coalesced, stats as singleflight_stats
 
 # Configure logging with more detail
 logging.basicConfig(
@@ -22,68 +38,149 @@ load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
 logger.info(f"Loaded API key: {api_key[:5]}...{api_key[-5:] if api_key else 'None'}")
 
-app = Flask(__name__)
-
-HISTORY_FILE = "history.json"
-COLLECTION_FILE = "collections.json"
-
-# Resize ảnh và mã hóa base64
-def encode_image(image_file, max_size=512):
-    try:
-        # Đọc và kiểm tra kích thước file
-        image_file.seek(0, os.SEEK_END)
-        original_size = image_file.tell()
-        image_file.seek(0)
-        logger.info(f"Original file size: {original_size / 1024:.2f}KB")
-
-        if original_size > 10 * 1024 * 1024:  # 10MB limit
-            raise ValueError("File size exceeds 10MB limit")
-
-        # Đọc ảnh
-        image = Image.open(image_file)
-        logger.info(f"Original image size: {image.size}, mode: {image.mode}")
-
-        # Chuyển đổi sang RGB nếu cần
-        if image.mode != 'RGB':
-            logger.info(f"Converting image from {image.mode} to RGB")
-            image = image.convert('RGB')
-
-        # Tính toán kích thước mới
-        if max(image.size) > max_size:
-            ratio = max_size / max(image.size)
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            logger.info(f"Resizing image from {image.size} to {new_size}")
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
-
-        # Nén ảnh với chất lượng tự động điều chỉnh
-        quality = 85
-        buffer = io.BytesIO()
-        while True:
-            buffer.seek(0)
-            buffer.truncate()
-            image.save(buffer, format='JPEG', quality=quality, optimize=True)
-            size = buffer.tell()
-            logger.info(f"Compressed size with quality {quality}: {size / 1024:.2f}KB")
-            
-            if size <= 800 * 1024 or quality <= 30:  # Giới hạn 800KB
-                break
-                
-            quality -= 10
+# Batch phân tích nhiều ảnh trong một request
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "30"))
+BATCH_MAX_REQUEST_BYTES = int(os.getenv("BATCH_MAX_REQUEST_BYTES", str(100 * 1024 * 1024)))
 
-        buffer.seek(0)
-        base64_data = base64.b64encode(buffer.read()).decode("utf-8")
-        logger.info(f"Final base64 size: {len(base64_data) / 1024:.2f}KB")
-        return base64_data
+class UploadRequest(Request):
+    @property
+    def max_content_length(self):
+        # Werkzeug từ chối request quá lớn (413) dựa vào Content-Length, trước khi đọc body
+        return BATCH_MAX_REQUEST_BYTES if self.endpoint == 'analyze_batch' else MAX_REQUEST_BYTES
 
-    except Exception as e:
-        logger.error(f"Error encoding image: {str(e)}")
-        raise
+app = Flask(__name__)
+app.request_class = UploadRequest
+
+HISTORY_FILE = "history.json"  # Chỉ dùng để chuyển dữ liệu cũ sang history.db
+COLLECTION_FILE = "collections.json"  # Chỉ dùng để chuyển dữ liệu cũ sang collections.db
+
+history_store = HistoryStore(legacy_file=HISTORY_FILE)
+HISTORY_PAGE_PARAMS = ('limit', 'cursor', 'brand', 'year', 'since', 'until', 'fields')
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+collection_store = CollectionStore(legacy_file=COLLECTION_FILE)
+
+# Danh mục xe cục bộ: điền thông số cho xe đã biết mà không cần gọi Gemini tra cứu
+vehicle_catalog = VehicleCatalog()
+# Client được dùng lại /brands trong khoảng này, sau đó kiểm tra lại bằng ETag
+BRANDS_CACHE_MAX_AGE = int(os.getenv("BRANDS_CACHE_MAX_AGE", "3600"))
+
+# Cache bản ghi phân tích theo hash ảnh; mỗi bản ghi chứa văn bản của mọi ngôn ngữ đã phục vụ
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+# Perceptual hash để nhận diện ảnh gần trùng (tắt mặc định)
+RESULT_CACHE_PHASH = os.getenv("RESULT_CACHE_PHASH", "0") == "1"
+RESULT_CACHE_PHASH_DISTANCE = int(os.getenv("RESULT_CACHE_PHASH_DISTANCE", "4"))
+
+result_cache = LRUCache("analysis_records", max_entries=RESULT_CACHE_MAX_ENTRIES, ttl=RESULT_CACHE_TTL)
+phash_index = LRUCache("analysis_phash", max_entries=RESULT_CACHE_MAX_ENTRIES, ttl=RESULT_CACHE_TTL)
+
+# Cache thông số kỹ thuật đã tra cứu theo tên xe
+SPEC_CACHE_MAX_ENTRIES = int(os.getenv("SPEC_CACHE_MAX_ENTRIES", "5000"))
+SPEC_CACHE_TTL = int(os.getenv("SPEC_CACHE_TTL", str(30 * 24 * 3600)))
+spec_cache = LRUCache("car_specs", max_entries=SPEC_CACHE_MAX_ENTRIES, ttl=SPEC_CACHE_TTL)
+
+# Các cách viết khác nhau của cùng một hãng xe
+BRAND_ALIASES = {
+    "mercedes benz": "mercedes",
+    "merc": "mercedes",
+    "vw": "volkswagen",
+    "chevy": "chevrolet",
+    "lambo": "lamborghini",
+    "beemer": "bmw",
+    "bimmer": "bmw",
+    "alfa": "alfa romeo",
+    "land rover range rover": "range rover",
+}
+
+# Thứ tự các giá trị trả về của extract_fields
+SPEC_FIELDS = (
+    "car_name", "year", "price", "power", "acceleration", "top_speed",
+    "engine_detail", "interior", "description",
+)
 
-def research_missing_info(car_name, missing_fields, lang='en'):
-    """Research missing information using Gemini API"""
-    try:
-        # Always request all three sections for consistency and require real/estimated engine info
-        prompt = f'''
+# Thread pool chạy song song các bước tra cứu và dịch
+ENRICHMENT_WORKERS = int(os.getenv("ENRICHMENT_WORKERS", "8"))
+ENRICHMENT_TIMEOUT = float(os.getenv("ENRICHMENT_TIMEOUT", "25"))
+enrichment_executor = ThreadPoolExecutor(max_workers=ENRICHMENT_WORKERS, thread_name_prefix="enrichment")
+
+def image_hash(base64_image):
+    """Exact content hash of the normalized image produced by encode_image"""
+    return hashlib.sha256(base64_image.encode("utf-8")).hexdigest()
+
+def perceptual_hash(base64_image, hash_size=8):
+    """64-bit difference hash (dHash) of the normalized image, for near-duplicates"""
+    image = Image.open(io.BytesIO(base64.b64decode(base64_image)))
+    image = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (1 if pixels[offset + col] > pixels[offset + col + 1] else 0)
+    return f"{bits:016x}"
+
+def get_cached_record(image_key, phash):
+    """Look up the record of a previous analysis (any language) by exact hash, then by perceptual hash"""
+    cached = result_cache.get(image_key)
+    if cached is not None or not phash:
+        return cached
+    target = int(phash, 16)
+    for candidate, exact_key in phash_index.items():
+        if bin(int(candidate, 16) ^ target).count("1") <= RESULT_CACHE_PHASH_DISTANCE:
+            cached = result_cache.get(exact_key)
+            if cached is not None:
+                logger.info(f"Near-duplicate image matched cached result {exact_key[:12]}")
+                return cached
+    return None
+
+def cache_result(image_key, phash, record):
+    """Store a fresh record, keeping the languages a previous record of the image had"""
+    # Không cache kết quả không nhận diện được để lần thử lại có cơ hội thành công
+    if record.get("car_name") == "Unknown Car":
+        return record
+    record = records.merge(result_cache.get(image_key), record)
+    result_cache.set(image_key, record)
+    if phash:
+        phash_index.set(phash, image_key)
+    return record
+
+def normalize_car_name(car_name):
+    """Fold case, punctuation, whitespace and brand aliases into a cache key"""
+    name = unicodedata.normalize("NFKC", car_name or "").lower()
+    name = re.sub(r"[^\w\s]", " ", name)
+    name = " ".join(name.split())
+    for alias in sorted(BRAND_ALIASES, key=len, reverse=True):
+        if name == alias or name.startswith(alias + " "):
+            canonical = BRAND_ALIASES[alias]
+            # "alfa romeo giulia" đã ở dạng chuẩn dù bắt đầu bằng alias "alfa"
+            already_canonical = canonical.startswith(alias + " ") and (
+                name == canonical or name.startswith(canonical + " ")
+            )
+            if not already_canonical:
+                name = canonical + name[len(alias):]
+            break
+    return name
+
+def get_cached_specs(car_name):
+    key = normalize_car_name(car_name)
+    if not key or key == "unknown car":
+        return None
+    return spec_cache.get(key)
+
+def update_cached_specs(car_name, **specs):
+    key = normalize_car_name(car_name)
+    if not key or key == "unknown car":
+        return
+    record = dict(spec_cache.get(key) or {})
+    record.update(specs)
+    spec_cache.set(key, record)
+
+# Always request all three sections for consistency and require real/estimated engine info
+# Mỗi ngôn ngữ (giống assets/en.json, vi.json) có prompt riêng để mô hình trả lời thẳng
+# bằng ngôn ngữ đó; các nhãn phải khớp với những gì extract_fields nhận ra.
+MISSING_INFO_PROMPT = '''
 Research and provide accurate information about the car model: {car_name}.
 Return the result in exactly three clear sections, in this order:
 
@@ -108,41 +205,36 @@ Interior & Features:
 Do not return "No information available". Always provide the most likely real-world information, or a well-informed estimate for each section.
 '''
 
-        payload = {
-            "contents": [{
-                "parts": [{"text": prompt}]
-            }]
-        }
+MISSING_INFO_PROMPT_VI = '''
+Tra cứu và cung cấp thông tin chính xác về mẫu xe: {car_name}. Trả lời bằng tiếng Việt.
+Trả về đúng ba phần rõ ràng, theo thứ tự sau:
 
-        headers = {
-            "Content-Type": "application/json"
-        }
+Tổng quan:
+(2-3 câu về đặc điểm tổng thể của xe)
 
-        response = requests.post(
-            "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent",
-            params={"key": api_key},
-            headers=headers,
-            json=payload,
-            timeout=20
-        )
-        
-        response.raise_for_status()
-        result = response.json()
-        content = result["candidates"][0]["content"]["parts"][0]["text"]
-        
-        # Parse researched information
-        researched_fields = extract_fields(content)
-        logger.info(f"Successfully researched missing information for {car_name}")
-        return researched_fields
-        
-    except Exception as e:
-        logger.error(f"Error researching information: {str(e)}")
-        return None
+Động cơ:
+- Loại động cơ: (V8, V6, 4 xi-lanh thẳng hàng, hybrid, điện, ...)
+- Dung tích: (lít hoặc cc)
+- Công suất: (hp hoặc kW)
+- Tăng tốc 0-100 km/h: (giây)
+- Tốc độ tối đa: (km/h)
+- Hệ thống nạp: (tăng áp, siêu nạp, hút khí tự nhiên, ...)
+- Hộp số: (số sàn, tự động, ly hợp kép, số cấp)
+- Hệ dẫn động: (RWD, AWD, FWD, ...)
+Nếu không tìm được động cơ chính xác của mẫu/năm này, hãy cung cấp động cơ phổ biến nhất của dòng xe và ghi rõ đó là ước tính.
+
+Nội thất & Tính năng:
+- Ghế ngồi: (chất liệu và cấu hình)
+- Bảng điều khiển: (tính năng chính)
+- Công nghệ: (các công nghệ chính)
+- Tính năng nổi bật: (liệt kê 3-4 tính năng)
+
+Giữ nguyên tên hãng, tên mẫu xe, số liệu và đơn vị. Không trả về "Không có thông tin". Luôn cung cấp thông tin thực tế hoặc ước tính có căn cứ cho từng phần.
+'''
 
-def research_engine_info(car_name):
-    """Research engine information when not available"""
-    try:
-        prompt = f"""Research and provide detailed engine specifications for {car_name}. Include the following information in Vietnamese:
+MISSING_INFO_PROMPTS = {'en': MISSING_INFO_PROMPT, 'vi': MISSING_INFO_PROMPT_VI}
+
+ENGINE_INFO_PROMPT = """Research and provide detailed engine specifications for {car_name}. Include the following information in Vietnamese:
 
 1. Thông số kỹ thuật động cơ:
 - Loại động cơ: (V6, V8, inline-4, hybrid, electric, etc.)
@@ -172,46 +264,143 @@ def research_engine_info(car_name):
 
 Nếu không tìm thấy thông tin chính xác, hãy cung cấp thông tin ước tính dựa trên phiên bản tương tự hoặc cùng dòng xe. Không trả về "Không có thông tin". Luôn cung cấp thông tin thực tế hoặc ước tính có căn cứ."""
 
-        payload = {
-            "contents": [{
-                "parts": [{"text": prompt}]
-            }]
-        }
-
-        headers = {
-            "Content-Type": "application/json"
-        }
+ENGINE_INFO_PROMPT_EN = """Research and provide detailed engine specifications for {car_name}. Include the following information in English:
+
+1. Engine specifications:
+- Engine type: (V6, V8, inline-4, hybrid, electric, etc.)
+- Displacement: (cc or L)
+- Power: (hp or kW)
+- Torque: (Nm)
+- Induction: (turbo, supercharger, naturally aspirated)
+- Fuel system: (direct injection, port injection, etc.)
+- Emission standard: (Euro 6, Euro 5, etc.)
+
+2. Drivetrain:
+- Transmission type: (automatic, manual, dual-clutch)
+- Number of gears: (6-speed, 8-speed, etc.)
+- Drive: (FWD, RWD, AWD)
+- Gear ratios: (if available)
+
+3. Performance:
+- 0-100 km/h acceleration time
+- Top speed
+- Fuel consumption: (l/100km)
+- Fuel tank capacity: (L)
+
+4. Special technology:
+- Fuel saving systems: (start/stop, cylinder deactivation, etc.)
+- Boost technology: (twin-turbo, bi-turbo, etc.)
+- Cooling system: (liquid cooling, etc.)
+
+If the exact information cannot be found, provide an estimate based on a similar version or the same model line. Do not return "No information available". Always provide real-world information or a well-founded estimate."""
+
+ENGINE_INFO_PROMPTS = {'en': ENGINE_INFO_PROMPT_EN, 'vi': ENGINE_INFO_PROMPT}
+
+ENGINE_INFO_FALLBACK = "- Không có thông tin chi tiết về động cơ."
+ENGINE_INFO_FALLBACKS = {'en': "- No detailed engine information available.", 'vi': ENGINE_INFO_FALLBACK}
+
+def prompt_lang(lang):
+    """The locale whose prompts are used for a request language; English for anything unknown"""
+    return lang if lang in MISSING_INFO_PROMPTS else 'en'
+
+def research_key(car_name, lang='en'):
+    return f"{prompt_lang(lang)}:{normalize_car_name(car_name)}"
+
+def cached_missing_research(car_name, lang='en'):
+    cached = get_cached_specs(car_name)
+    research = cached and cached.get(f"research_{prompt_lang(lang)}")
+    if research:
+        logger.info(f"Spec cache hit for {car_name} ({prompt_lang(lang)})")
+        return tuple(research[field] for field in SPEC_FIELDS)
+    return None
+
+def store_missing_research(car_name, content, lang='en'):
+    """Parse researched information and remember it for this car and language"""
+    researched_fields = extract_fields(content)
+    logger.info(f"Successfully researched missing information for {car_name}")
+    research = dict(zip(SPEC_FIELDS, researched_fields))
+    if any(research[field] != "N/A" for field in ("power", "acceleration", "top_speed")):
+        update_cached_specs(car_name, **{f"research_{prompt_lang(lang)}": research})
+    return researched_fields
+
+@coalesced(research_key)
+def fetch_missing_research(car_name, lang='en'):
+    """One research request per car and language at a time; concurrent callers share its result"""
+    # Leader trước có thể vừa ghi cache xong
+    cached = cached_missing_research(car_name, lang)
+    if cached:
+        return cached
+    content = gemini_client.generate_text(
+        "gemini-pro", MISSING_INFO_PROMPTS[prompt_lang(lang)].format(car_name=car_name), api_version="v1beta",
+        timeout=20,
+    )
+    return store_missing_research(car_name, content, lang)
+
+@metrics.timed("missing_research")
+def research_missing_info(car_name, missing_fields, lang='en'):
+    """Research missing information using Gemini API, answered in the request language"""
+    cached = cached_missing_research(car_name, lang)
+    if cached:
+        return cached
+    try:
+        return fetch_missing_research(car_name, lang)
+    except Exception as e:
+        logger.error(f"Error researching information: {str(e)}")
+        return None
 
-        response = requests.post(
-            "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent",
-            params={"key": api_key},
-            headers=headers,
-            json=payload,
-            timeout=20
-        )
-        
-        response.raise_for_status()
-        result = response.json()
-        engine_info = result["candidates"][0]["content"]["parts"][0]["text"]
-        
-        # Format the response into clear sections
-        sections = engine_info.split('\n\n')
-        formatted_info = []
-        
-        for section in sections:
-            if section.strip():
-                # Add bullet points if not present
-                if not section.strip().startswith('-'):
-                    lines = section.split('\n')
-                    formatted_lines = ['- ' + line.strip() for line in lines if line.strip()]
-                    formatted_info.extend(formatted_lines)
-                else:
-                    formatted_info.append(section.strip())
-        
-        return '\n'.join(formatted_info) if formatted_info else "- Không có thông tin chi tiết về động cơ."
+def cached_engine_research(car_name, lang='en'):
+    cached = get_cached_specs(car_name)
+    engine_info = cached and cached.get(f"engine_info_{prompt_lang(lang)}")
+    if engine_info:
+        logger.info(f"Spec cache hit for {car_name} engine ({prompt_lang(lang)})")
+        return engine_info
+    return None
+
+def store_engine_research(car_name, engine_info, lang='en'):
+    """Format the researched engine text into bullet lines and remember it"""
+    # Format the response into clear sections
+    sections = engine_info.split('\n\n')
+    formatted_info = []
+
+    for section in sections:
+        if section.strip():
+            # Add bullet points if not present
+            if not section.strip().startswith('-'):
+                lines = section.split('\n')
+                formatted_lines = ['- ' + line.strip() for line in lines if line.strip()]
+                formatted_info.extend(formatted_lines)
+            else:
+                formatted_info.append(section.strip())
+
+    if not formatted_info:
+        return ENGINE_INFO_FALLBACKS[prompt_lang(lang)]
+    engine_info = '\n'.join(formatted_info)
+    update_cached_specs(car_name, **{f"engine_info_{prompt_lang(lang)}": engine_info})
+    return engine_info
+
+@coalesced(research_key)
+def fetch_engine_research(car_name, lang='en'):
+    """One engine research request per car and language at a time; concurrent callers share its result"""
+    cached = cached_engine_research(car_name, lang)
+    if cached:
+        return cached
+    engine_info = gemini_client.generate_text(
+        "gemini-pro", ENGINE_INFO_PROMPTS[prompt_lang(lang)].format(car_name=car_name), api_version="v1beta",
+        timeout=20,
+    )
+    return store_engine_research(car_name, engine_info, lang)
+
+@metrics.timed("engine_research")
+def research_engine_info(car_name, lang='en'):
+    """Research engine information when not available, answered in the request language"""
+    cached = cached_engine_research(car_name, lang)
+    if cached:
+        return cached
+    try:
+        return fetch_engine_research(car_name, lang)
     except Exception as e:
         logger.error(f"Error researching engine info: {str(e)}")
-        return "- Không có thông tin chi tiết về động cơ."
+        return ENGINE_INFO_FALLBACKS[prompt_lang(lang)]
 
 # Trích xuất các trường từ phản hồi
 def extract_fields(text):
@@ -237,23 +426,24 @@ def extract_fields(text):
             if not line:
                 continue
                 
-            # Check for section headers
+            # Check for section headers (English or Vietnamese prompts)
             if line.endswith(':'):
                 header = line[:-1].lower()
-                if "overview" in header:
+                if "overview" in header or "tổng quan" in header:
                     current_section = "overview"
-                elif "engine" in header:
+                elif "engine" in header or "động cơ" in header:
                     current_section = "engine"
-                elif "interior" in header or "features" in header:
+                elif any(word in header for word in ("interior", "features", "nội thất", "tính năng")):
                     current_section = "interior"
                 continue
                 
             # Handle performance metrics
-            if "power:" in line.lower():
+            lowered = line.lower()
+            if "power:" in lowered or "công suất:" in lowered:
                 fields["power"] = line.split(":", 1)[1].strip()
-            elif "0-60" in line.lower() or "0-100" in line.lower():
+            elif "0-60" in lowered or "0-100" in lowered:
                 fields["acceleration"] = line.split(":", 1)[1].strip()
-            elif "top speed" in line.lower():
+            elif "top speed" in lowered or "tốc độ tối đa" in lowered:
                 fields["top_speed"] = line.split(":", 1)[1].strip()
             elif ":" in line and not line.startswith('-'):
                 try:
@@ -261,13 +451,13 @@ def extract_fields(text):
                     key = key.strip().lower()
                     value = value.strip()
                     
-                    if "brand" in key:
+                    if "brand" in key or key == "hãng":
                         fields["brand"] = value
-                    elif "model" in key:
+                    elif "model" in key or key == "mẫu xe":
                         fields["model"] = value
-                    elif "year" in key:
+                    elif "year" in key or key == "năm":
                         fields["year"] = value
-                    elif "price" in key:
+                    elif "price" in key or key == "giá":
                         fields["price"] = value
                 except:
                     continue
@@ -307,23 +497,11 @@ def extract_fields(text):
             "Unable to extract detailed information from the image."
         )
 
-def translate_to_vietnamese(content):
-    """Translate content to Vietnamese"""
-    try:
-        # Split content into sections
-        sections = content.split('\n\n')
-        translated_sections = []
-        
-        for section in sections:
-            if not section.strip():
-                continue
-                
-            # Check if section is already in Vietnamese
-            if any(vn_word in section.lower() for vn_word in ['động cơ', 'nội thất', 'tính năng', 'công suất', 'tốc độ', 'xe', 'hệ thống', 'trang bị']):
-                translated_sections.append(section)
-                continue
-                
-            prompt = f"""Translate the following car information to Vietnamese. Keep all numbers, units and technical specifications as is:
+# Từ khóa nhận biết nội dung đã là tiếng Việt
+VI_CORE_KEYWORDS = ['động cơ', 'nội thất', 'tính năng', 'công suất', 'tốc độ']
+
+TRANSLATION_PROMPTS = {
+    'vi': """Translate the following car information to Vietnamese. Keep all numbers, units and technical specifications as is:
 
 {section}
 
@@ -334,48 +512,8 @@ Translation rules:
 4. Keep technical terms in their common Vietnamese form (e.g. 'turbo' -> 'tăng áp', 'hybrid' -> 'hybrid')
 5. Maintain bullet points and formatting
 6. Translate all English text to Vietnamese, including descriptions and features
-7. Keep any Vietnamese text as is"""
-
-            payload = {
-                "contents": [{
-                    "parts": [{"text": prompt}]
-                }]
-            }
-
-            response = requests.post(
-                "https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:generateContent",
-                params={"key": api_key},
-                json=payload,
-                timeout=20
-            )
-            
-            response.raise_for_status()
-            result = response.json()
-            translated = result["candidates"][0]["content"]["parts"][0]["text"]
-            translated_sections.append(translated)
-        
-        return '\n\n'.join(translated_sections)
-    except Exception as e:
-        logger.error(f"Error translating content: {str(e)}")
-        return content  # Return original content if translation fails
-
-def translate_to_english(content):
-    """Translate content to English"""
-    try:
-        # Split content into sections
-        sections = content.split('\n\n')
-        translated_sections = []
-        
-        for section in sections:
-            if not section.strip():
-                continue
-                
-            # Check if section is already in English
-            if not any(vn_word in section.lower() for vn_word in ['động cơ', 'nội thất', 'tính năng', 'công suất', 'tốc độ']):
-                translated_sections.append(section)
-                continue
-                
-            prompt = f"""Translate the following car information to English. Keep all numbers, units and technical specifications as is:
+7. Keep any Vietnamese text as is""",
+    'en': """Translate the following car information to English. Keep all numbers, units and technical specifications as is:
 
 {section}
 
@@ -384,111 +522,416 @@ Translation rules:
 2. Keep car brand names unchanged
 3. Translate all descriptions and features to English
 4. Keep technical terms in their common English form
-5. Maintain bullet points and formatting"""
-
-            payload = {
-                "contents": [{
-                    "parts": [{"text": prompt}]
-                }]
-            }
-
-            response = requests.post(
-                "https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:generateContent",
-                params={"key": api_key},
-                json=payload,
-                timeout=20
-            )
-            
-            response.raise_for_status()
-            result = response.json()
-            translated = result["candidates"][0]["content"]["parts"][0]["text"]
-            translated_sections.append(translated)
-        
-        return '\n\n'.join(translated_sections)
-    except Exception as e:
-        logger.error(f"Error translating content: {str(e)}")
-        return content  # Return original content if translation fails
+5. Maintain bullet points and formatting""",
+}
 
-def save_to_history(car_data):
-    try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                history = json.load(f)
-        else:
-            history = []
-        history.insert(0, car_data)  # Thêm mới lên đầu
-        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Error saving to history: {str(e)}")
+BATCH_TRANSLATION_PROMPT = """Translate every value of the following JSON object of car information to {language}. Keep all numbers, units and technical specifications as is:
 
-def save_to_collection(car_data, collection_name="Favorites"):
-    try:
-        if os.path.exists(COLLECTION_FILE):
-            with open(COLLECTION_FILE, "r", encoding="utf-8") as f:
-                collections = json.load(f)
-        else:
-            collections = {}
-        if collection_name not in collections:
-            collections[collection_name] = []
-        # Kiểm tra trùng lặp
-        if not any(car.get('car_name') == car_data.get('car_name') and car.get('brand') == car_data.get('brand') for car in collections[collection_name]):
-            collections[collection_name].insert(0, car_data)
-        with open(COLLECTION_FILE, "w", encoding="utf-8") as f:
-            json.dump(collections, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Error saving to collection: {str(e)}")
+{segments}
 
-@app.route('/analyze_car', methods=['POST'])
-def analyze_car():
+Translation rules:
+1. Keep all numbers and units (hp, km/h, etc) unchanged
+2. Keep car brand names unchanged
+3. Translate all descriptions and features to {language}
+4. Keep technical terms in their common {language} form
+5. Maintain bullet points and formatting inside each value
+6. Return ONLY a JSON object with exactly the same keys as the input, no extra text"""
+
+LANGUAGE_NAMES = {'vi': 'Vietnamese', 'en': 'English'}
+
+# Cache bản dịch theo từng đoạn (đoạn nguồn đã chuẩn hóa + ngôn ngữ đích)
+TRANSLATION_CACHE_MAX_ENTRIES = int(os.getenv("TRANSLATION_CACHE_MAX_ENTRIES", "20000"))
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", str(90 * 24 * 3600)))
+translation_cache = LRUCache(
+    "translations", max_entries=TRANSLATION_CACHE_MAX_ENTRIES, ttl=TRANSLATION_CACHE_TTL
+)
+
+def contains_vietnamese(text, keywords=VI_CORE_KEYWORDS):
+    lowered = text.lower()
+    return any(vn_word in lowered for vn_word in keywords)
+
+# Chữ cái có dấu đặc trưng của tiếng Việt; bỏ é, è, à, ü... hay gặp trong tên xe châu Âu
+VI_LETTERS = re.compile("[ăâđêôơưạảấầẩẫậắằẳẵặẹẻẽếềểễệỉịĩọỏốồổỗộớờởỡợụủũứừửữựỳỵỷỹ]", re.IGNORECASE)
+
+def is_vietnamese(text):
+    """Language check for generated text: Vietnamese diacritics or core Vietnamese terms"""
+    return len(VI_LETTERS.findall(text)) >= 2 or contains_vietnamese(text)
+
+def normalize_section(section):
+    return "\n".join(" ".join(line.split()) for line in section.strip().splitlines())
+
+def translation_key(section, target_lang):
+    digest = hashlib.sha1(normalize_section(section).encode("utf-8")).hexdigest()
+    return f"{target_lang}:{digest}"
+
+@coalesced(translation_key)
+def fetch_translation(section, target_lang):
+    """One translation request per normalized section at a time"""
+    key = translation_key(section, target_lang)
+    cached = translation_cache.get(key)
+    if cached is not None:
+        return cached
+
+    translated = gemini_client.generate_text(
+        "gemini-1.5-flash", TRANSLATION_PROMPTS[target_lang].format(section=section), timeout=20,
+        priority=gemini_client.PRIORITY_TRANSLATION
+    )
+    translation_cache.set(key, translated)
+    return translated
+
+def translate_section(section, target_lang):
+    """Translate one section with gemini-1.5-flash, using the translation cache"""
+    cached = translation_cache.get(translation_key(section, target_lang))
+    if cached is not None:
+        return cached
+    return fetch_translation(section, target_lang)
+
+# Đoạn nào cần dịch sang từng ngôn ngữ đích. Prompt đã sinh thẳng bằng ngôn ngữ
+# đích nên đây chỉ là dự phòng cho đoạn trả lời sai ngôn ngữ.
+NEEDS_TRANSLATION = {
+    'vi': lambda section: not is_vietnamese(section),
+    'en': is_vietnamese,
+}
+
+def parse_batch_translation(text, segment_ids):
+    """Parse the JSON object of a batched translation, keeping only valid segments"""
+    text = text.strip()
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return {}
     try:
-        logger.info("Received analyze_car request")
-        if not api_key:
-            logger.error("API key is not configured")
-            return jsonify({"error": "API key is not configured"}), 500
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {
+        segment_id: data[segment_id] for segment_id in segment_ids
+        if isinstance(data.get(segment_id), str) and data[segment_id].strip()
+    }
+
+def batch_translation_prompt(segments, target_lang):
+    return BATCH_TRANSLATION_PROMPT.format(
+        language=LANGUAGE_NAMES[target_lang],
+        segments=json.dumps(segments, ensure_ascii=False, indent=2)
+    )
+
+def batch_translation_key(segments, target_lang):
+    return tuple(translation_key(section, target_lang) for section in segments.values())
+
+@coalesced(batch_translation_key)
+def fetch_batch_translation(segments, target_lang):
+    """One batched request per set of sections; returns the parsed segments (shared, do not mutate)"""
+    text = gemini_client.generate_text(
+        "gemini-1.5-flash", batch_translation_prompt(segments, target_lang), timeout=30,
+        priority=gemini_client.PRIORITY_TRANSLATION
+    )
+    return parse_batch_translation(text, segments)
+
+def store_batch_translation(segments, parsed, target_lang):
+    """Cache the parsed segments; returns their translations and the ids still missing"""
+    translated = {}
+    for segment_id, text in parsed.items():
+        translation_cache.set(translation_key(segments[segment_id], target_lang), text)
+        translated[normalize_section(segments[segment_id])] = text
+
+    missing = [segment_id for segment_id in segments if segment_id not in parsed]
+    if missing:
+        logger.warning(f"Batched translation missing {len(missing)}/{len(segments)} segments, translating them one by one")
+    return translated, missing
+
+def translate_batch(sections, target_lang):
+    """Translate distinct sections in a single request, keyed by normalized section"""
+    if len(sections) == 1:
+        try:
+            return {normalize_section(sections[0]): translate_section(sections[0], target_lang)}
+        except Exception as e:
+            logger.error(f"Error translating section: {str(e)}")
+            return {}
 
-        logger.debug(f"Using API key: {api_key[:5]}...{api_key[-5:]}")
+    segments = {f"s{i}": section for i, section in enumerate(sections)}
+    parsed = {}
+    try:
+        parsed = fetch_batch_translation(segments, target_lang)
+    except Exception as e:
+        logger.error(f"Error in batched translation: {str(e)}")
 
-        if 'image' not in request.files:
-            logger.error("No image file provided")
-            return jsonify({"error": "No image file provided"}), 400
-            
-        image_file = request.files['image']
-        logger.info(f"Received image file: {image_file.filename}")
-        
-        if not image_file.filename:
-            logger.error("No image file selected")
-            return jsonify({"error": "No image file selected"}), 400
-            
-        lang = request.form.get('lang', 'vi')
-        logger.info(f"Language: {lang}")
-        
-        start_time = datetime.now()
-        
+    translated, missing = store_batch_translation(segments, parsed, target_lang)
+    # Phản hồi lỗi định dạng: dịch lại từng đoạn còn thiếu
+    for segment_id in missing:
         try:
-            base64_image = encode_image(image_file, max_size=512)
-            logger.info("Image encoded successfully")
+            translated[normalize_section(segments[segment_id])] = translate_section(segments[segment_id], target_lang)
         except Exception as e:
-            logger.error(f"Error encoding image: {str(e)}")
-            error_msg = {
-                'vi': "Lỗi xử lý ảnh. Vui lòng thử lại với ảnh khác.",
-                'en': "Image processing failed. Please try with a different image."
-            }
-            return jsonify({"error": error_msg[lang]}), 400
-
-        session = requests.Session()
-        retries = 3
-        backoff_factor = 0.5
-        retry_strategy = requests.adapters.Retry(
-            total=retries,
-            backoff_factor=backoff_factor,
-            status_forcelist=[429, 500, 502, 503, 504],
+            logger.error(f"Error translating section: {str(e)}")
+    return translated
+
+def plan_translation(fields, target_lang):
+    """Split fields into sections; returns (sections per field, cached translations, sections to translate)"""
+    needs_translation = NEEDS_TRANSLATION[target_lang]
+    split_fields = {}
+    translations = {}
+    pending = {}
+
+    for name, content in fields.items():
+        if not content:
+            continue
+        sections = [section for section in content.split('\n\n') if section.strip()]
+        split_fields[name] = sections
+        for section in sections:
+            if not needs_translation(section):
+                continue
+            normalized = normalize_section(section)
+            if normalized in translations or normalized in pending:
+                continue
+            cached = translation_cache.get(translation_key(section, target_lang))
+            if cached is not None:
+                translations[normalized] = cached
+            else:
+                pending[normalized] = section
+
+    if pending:
+        logger.info(f"Translating {len(pending)} sections to {target_lang} in one batch")
+    return split_fields, translations, list(pending.values())
+
+def apply_translations(fields, split_fields, translations, target_lang):
+    needs_translation = NEEDS_TRANSLATION[target_lang]
+    result = dict(fields)
+    for name, sections in split_fields.items():
+        result[name] = '\n\n'.join(
+            translations.get(normalize_section(section), section) if needs_translation(section) else section
+            for section in sections
         )
-        session.mount("https://", requests.adapters.HTTPAdapter(max_retries=retry_strategy))
+    return result
+
+@metrics.timed("translation")
+def translate_fields(fields, target_lang):
+    """Translate several response fields with one batched request for all cache misses"""
+    split_fields, translations, pending = plan_translation(fields, target_lang)
+    if pending:
+        translations.update(translate_batch(pending, target_lang))
+    return apply_translations(fields, split_fields, translations, target_lang)
+
+def iter_completed(tasks, timeout=ENRICHMENT_TIMEOUT):
+    """Run independent callables in parallel, yielding (name, result) as each finishes;
+    a task that fails or times out yields None"""
+    futures = {enrichment_executor.submit(metrics.bind(task)): name for name, task in tasks.items()}
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Error in enrichment task '{name}': {str(e)}")
+                result = None
+            yield name, result
+    except FuturesTimeoutError:
+        for future, name in futures.items():
+            if not future.done():
+                future.cancel()
+                logger.warning(f"Enrichment task '{name}' timed out after {timeout}s")
+                yield name, None
+
+def is_missing(value, placeholder):
+    return not value or value == placeholder
+
+def plan_enrichment(fields):
+    """Decide which research calls are needed and which fields can be translated right away"""
+    engine_detail = fields["engine_detail"]
+    needs_engine = is_missing(engine_detail, "No engine details available.") or "needs the engine specifications" in engine_detail
+    missing_fields = [
+        field for field in ("power", "acceleration", "top_speed") if is_missing(fields[field], "N/A")
+    ]
 
-        try:
-            # Use English prompt for initial analysis
-            prompt = """Analyze this car image and provide the following information in this EXACT format:
+    # Các trường có thể bị thay bằng kết quả tra cứu sẽ được dịch sau
+    researched_names = set()
+    if needs_engine:
+        researched_names.add("engine_detail")
+    if missing_fields:
+        if is_missing(fields["interior"], "No interior details available."):
+            researched_names.add("interior")
+        if is_missing(fields["description"], "No detailed description available."):
+            researched_names.add("description")
+    stable = {
+        name: fields[name] for name in ("description", "interior", "engine_detail") if name not in researched_names
+    }
+    return {
+        "needs_engine": needs_engine,
+        "missing_fields": missing_fields,
+        "researched_names": researched_names,
+        "stable": stable,
+    }
+
+def needs_engine_fallback(fields, plan, engine_info, researched):
+    return (
+        plan["needs_engine"] and not engine_info and not researched
+        and is_missing(fields["engine_detail"], "No engine details available.")
+    )
+
+def merge_research(fields, plan, engine_info, researched):
+    """Fill the identified fields with research results"""
+    fields = dict(fields)
+    if plan["needs_engine"] and engine_info:
+        fields["engine_detail"] = engine_info
+
+    if researched:
+        researched = dict(zip(SPEC_FIELDS, researched))
+        for field in plan["missing_fields"]:
+            fields[field] = researched[field]
+        if is_missing(fields["engine_detail"], "No engine details available."):
+            fields["engine_detail"] = researched["engine_detail"]
+        if is_missing(fields["interior"], "No interior details available."):
+            fields["interior"] = researched["interior"]
+        if is_missing(fields["description"], "No detailed description available."):
+            fields["description"] = researched["description"]
+        logger.info("Successfully researched missing information")
+    return fields
+
+def changed_fields(before, after):
+    return [name for name in after if after[name] != before.get(name)]
+
+def iter_enrichment(fields, lang):
+    """Research missing specs and translate text fields, running independent calls concurrently;
+    yields (stage, changed field names, fields so far) as each call completes"""
+    fields = dict(fields)
+    car_name = fields["car_name"]
+    target_lang = 'vi' if lang == 'vi' else 'en'
+    plan = plan_enrichment(fields)
+
+    tasks = {}
+    if plan["needs_engine"]:
+        logger.info("Researching engine details")
+        tasks["engine"] = lambda: research_engine_info(car_name, lang)
+    if plan["missing_fields"]:
+        logger.info(f"Researching missing fields: {plan['missing_fields']}")
+        tasks["missing"] = lambda: research_missing_info(car_name, plan["missing_fields"], lang)
+    if plan["stable"]:
+        tasks["translate"] = lambda: translate_fields(plan["stable"], target_lang)
+
+    # Kết quả được gộp ngay khi có; thứ tự hoàn thành không làm thay đổi kết quả cuối
+    engine_info = researched = None
+    for name, result in iter_completed(tasks):
+        before = fields
+        if name == "translate":
+            if result:
+                fields = {**fields, **result}
+            yield "translation", changed_fields(before, fields), fields
+        elif name == "engine":
+            engine_info = result
+            fields = merge_research(fields, plan, engine_info, None)
+            yield "engine", changed_fields(before, fields), fields
+        else:
+            researched = result
+            fields = merge_research(fields, plan, None, researched)
+            yield "performance", changed_fields(before, fields), fields
+
+    if needs_engine_fallback(fields, plan, engine_info, researched):
+        # Try one more time with a different prompt
+        before = fields
+        for _, researched in iter_completed({
+            "missing": lambda: research_missing_info(car_name, ['engine'], lang)
+        }):
+            fields = merge_research(fields, plan, None, researched)
+        yield "engine", changed_fields(before, fields), fields
+
+    if plan["researched_names"]:
+        before = fields
+        for _, translated in iter_completed({
+            "translate": lambda: translate_fields(
+                {name: fields[name] for name in plan["researched_names"]}, target_lang
+            )
+        }):
+            if translated:
+                fields = {**fields, **translated}
+        yield "translation", changed_fields(before, fields), fields
+
+def enrich_fields(fields, lang):
+    """Research missing specs and translate text fields, running independent calls concurrently"""
+    for _, _, fields in iter_enrichment(fields, lang):
+        pass
+    return fields
+
+def write_history(batch):
+    """Append a batch of (car_data, collection_name) records to history in one transaction"""
+    history_store.append_many([car_data for car_data, _ in batch])
+
+def write_collections(batch):
+    """Add a batch of (car_data, collection_name) records to their collections"""
+    by_collection = {}
+    for car_data, collection_name in batch:
+        by_collection.setdefault(collection_name, []).append(car_data)
+    # Trùng lặp bị bỏ qua nên ghi lại cả batch khi thử lại vẫn an toàn
+    for collection_name, items in by_collection.items():
+        collection_store.add_many(collection_name, items)
+
+persistence_queue = PersistenceQueue({"history": write_history, "collection": write_collections})
+
+def save_result(car_data, collection_name="Favorites"):
+    """Lưu vào lịch sử và collection mặc định (ghi nền nếu PERSIST_MODE=async)"""
+    persistence_queue.submit(car_data, collection_name)
+
+ERROR_MESSAGES = {
+    'image_processing': {
+        'vi': "Lỗi xử lý ảnh. Vui lòng thử lại với ảnh khác.",
+        'en': "Image processing failed. Please try with a different image."
+    },
+    'image_too_large': {
+        'vi': "Ảnh quá lớn. Vui lòng chọn ảnh dưới 10MB và không quá {megapixels} megapixel.",
+        'en': "Image is too large. Please choose an image under 10MB and at most {megapixels} megapixels."
+    },
+    'analysis_failed': {
+        'vi': "Không thể phân tích ảnh. Vui lòng thử lại với ảnh khác.",
+        'en': "Unable to analyze image. Please try with a different image."
+    },
+    'extraction_failed': {
+        'vi': "Lỗi xử lý thông tin xe. Vui lòng thử lại.",
+        'en': "Error processing car information. Please try again."
+    },
+    'timeout': {
+        'vi': "Quá thời gian phân tích. Vui lòng thử lại với ảnh khác (ảnh rõ nét hơn hoặc góc chụp khác).",
+        'en': "Analysis timeout. Please try again with a different image (clearer image or different angle)."
+    },
+    'connection': {
+        'vi': "Lỗi kết nối đến máy chủ. Vui lòng kiểm tra kết nối mạng và thử lại sau.",
+        'en': "Server connection error. Please check your network and try again later."
+    },
+    'unexpected': {
+        'vi': "Đã xảy ra lỗi không mong muốn. Vui lòng thử lại sau.",
+        'en': "An unexpected error occurred. Please try again later."
+    },
+    'busy': {
+        'vi': "Máy chủ đang bận. Vui lòng thử lại sau ít phút.",
+        'en': "The server is busy. Please try again in a few minutes."
+    },
+    'unavailable': {
+        'vi': "Dịch vụ phân tích AI tạm thời gián đoạn. Vui lòng thử lại sau ít phút.",
+        'en': "The AI analysis service is temporarily unavailable. Please try again in a few minutes."
+    },
+    'job_not_found': {
+        'vi': "Không tìm thấy yêu cầu phân tích hoặc yêu cầu đã hết hạn.",
+        'en': "Analysis job not found or expired."
+    },
+}
+
+def error_message(key, lang):
+    messages = ERROR_MESSAGES[key]
+    return messages.get(lang, messages['en']).format(megapixels=IMAGE_MAX_PIXELS // 1000000)
+
+def image_error(e, lang):
+    """Response body and status for an upload encode_image rejected"""
+    if isinstance(e, ImageTooLargeError):
+        return {"error": error_message('image_too_large', lang)}, 413
+    return {"error": error_message('image_processing', lang)}, 400
+
+class AnalysisError(Exception):
+    """A failed analysis step, reported to the client as a localized error"""
+
+    def __init__(self, key, status=400):
+        super().__init__(key)
+        self.key = key
+        self.status = status
+
+# Identification prompts per request language; the answer is generated in that language
+IDENTIFY_PROMPT = """Analyze this car image and provide the following information in this EXACT format:
 Brand: (manufacturer name)
 Model: (model name)
 Year: (specific year or year range)
@@ -516,220 +959,692 @@ Interior & Features:
 
 Note: Please maintain the exact format with proper line breaks and section headers."""
 
-            payload = {
-                "contents": [{
-                    "parts": [
-                        {"text": prompt},
-                        {
-                            "inline_data": {
-                                "mime_type": "image/jpeg",
-                                "data": base64_image
-                            }
-                        }
-                    ]
-                }]
-            }
-
-            headers = {
-                "Content-Type": "application/json"
-            }
-
-            logger.info("Sending request to Gemini API")
-            response = session.post(
-                "https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:generateContent",
-                params={"key": api_key},
-                headers=headers,
-                json=payload,
-                timeout=(3, 15)
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"API Error: {response.status_code} - {response.text}")
-                error_msg = {
-                    'vi': "Không thể phân tích ảnh. Vui lòng thử lại với ảnh khác.",
-                    'en': "Unable to analyze image. Please try with a different image."
-                }
-                return jsonify({"error": error_msg[lang]}), 400
-            
-            result = response.json()
-            logger.info("Received response from Gemini API")
-            
-            if 'error' in result:
-                logger.error(f"Gemini API error: {result['error']}")
-                error_msg = {
-                    'vi': "Không thể phân tích ảnh. Vui lòng thử lại với ảnh khác.",
-                    'en': "Unable to analyze image. Please try with a different image."
-                }
-                return jsonify({"error": error_msg[lang]}), 400
-                
-            if 'candidates' not in result or not result['candidates']:
-                logger.error("No candidates in Gemini API response")
-                error_msg = {
-                    'vi': "Không thể phân tích ảnh. Vui lòng thử lại với ảnh khác.",
-                    'en': "Unable to analyze image. Please try with a different image."
-                }
-                return jsonify({"error": error_msg[lang]}), 400
-                
-            content = result["candidates"][0]["content"]["parts"][0]["text"]
-            logger.info("Extracting fields from response")
-            
-            try:
-                car_name, year, price, power, acceleration, top_speed, engine_detail, interior, description = extract_fields(content)
-                logger.info(f"Successfully extracted fields for car: {car_name}")
-            except Exception as e:
-                logger.error(f"Error extracting fields: {str(e)}")
-                error_msg = {
-                    'vi': "Lỗi xử lý thông tin xe. Vui lòng thử lại.",
-                    'en': "Error processing car information. Please try again."
+IDENTIFY_PROMPT_VI = """Phân tích ảnh chiếc xe này và trả lời bằng tiếng Việt theo ĐÚNG định dạng sau:
+Hãng: (tên nhà sản xuất)
+Mẫu xe: (tên mẫu xe)
+Năm: (năm hoặc khoảng năm cụ thể)
+Giá: (khoảng giá bằng USD)
+Hiệu năng:
+- Công suất: (số mã lực chính xác hoặc khoảng)
+- 0-60 mph: (số giây chính xác)
+- Tốc độ tối đa: (km/h chính xác)
+
+Mô tả:
+Tổng quan:
+(2-3 câu về đặc điểm tổng thể của xe)
+
+Động cơ:
+- Cấu hình: (loại và bố trí động cơ)
+- Dung tích: (lít)
+- Tăng áp/Siêu nạp: (nếu có)
+- Hộp số: (loại và số cấp)
+
+Nội thất & Tính năng:
+- Ghế ngồi: (chất liệu và cấu hình)
+- Bảng điều khiển: (tính năng chính)
+- Công nghệ: (các công nghệ chính)
+- Tính năng nổi bật: (liệt kê 3-4 tính năng)
+
+Lưu ý: Giữ đúng định dạng với các dòng và tiêu đề như trên. Giữ nguyên tên hãng, tên mẫu xe, số liệu và đơn vị."""
+
+IDENTIFY_PROMPTS = {'en': IDENTIFY_PROMPT, 'vi': IDENTIFY_PROMPT_VI}
+
+# Chế độ structured output: Gemini trả JSON theo car_schema.IDENTIFICATION_SCHEMA
+# thay vì văn bản tự do; responseSchema chỉ có trên API v1beta.
+GEMINI_STRUCTURED_OUTPUT = os.getenv("GEMINI_STRUCTURED_OUTPUT", "1") == "1"
+IDENTIFY_API_VERSION = "v1beta" if GEMINI_STRUCTURED_OUTPUT else "v1"
+
+STRUCTURED_IDENTIFY_PROMPTS = {
+    'en': """Identify the car in this image and describe it in English using the response schema.
+Fill every field, including the engine specifications and the performance figures, with specific values and units.
+Write only facts about this car; if a value is truly unknown, leave that field empty.""",
+    'vi': """Nhận diện chiếc xe trong ảnh và mô tả nó bằng tiếng Việt theo response schema.
+Điền mọi trường, kể cả thông số động cơ và hiệu năng, với giá trị và đơn vị cụ thể.
+Giữ nguyên tên hãng và tên mẫu xe. Chỉ viết thông tin về chiếc xe này; nếu thật sự không biết một giá trị, để trống trường đó.""",
+}
+
+def identification_payload(base64_image, lang='en'):
+    prompts = STRUCTURED_IDENTIFY_PROMPTS if GEMINI_STRUCTURED_OUTPUT else IDENTIFY_PROMPTS
+    payload = {
+        "contents": [{
+            "parts": [
+                {"text": prompts[prompt_lang(lang)]},
+                {
+                    "inline_data": {
+                        "mime_type": "image/jpeg",
+                        "data": base64_image
+                    }
                 }
-                return jsonify({"error": error_msg[lang]}), 400
-            
-            # Always research engine details first if missing or incomplete
-            if not engine_detail or engine_detail == "No engine details available." or "needs the engine specifications" in engine_detail:
-                try:
-                    logger.info("Researching engine details")
-                    engine_detail = research_engine_info(car_name)
-                    if not engine_detail or engine_detail == "No engine details available.":
-                        # Try one more time with a different prompt
-                        engine_detail = research_missing_info(car_name, ['engine'], lang)[6]  # Get engine details from research
-                except Exception as e:
-                    logger.error(f"Error researching engine info: {str(e)}")
-                    pass
-
-            # Validate essential fields
-            missing_fields = []
-            if not power or power == "N/A":
-                missing_fields.append('power')
-            if not acceleration or acceleration == "N/A":
-                missing_fields.append('acceleration')
-            if not top_speed or top_speed == "N/A":
-                missing_fields.append('top_speed')
-            
-            if missing_fields:
-                try:
-                    logger.info(f"Researching missing fields: {missing_fields}")
-                    researched = research_missing_info(car_name, missing_fields, lang)
-                    if researched:
-                        _, _, _, r_power, r_acc, r_speed, r_engine, r_interior, r_desc = researched
-                        power = r_power if 'power' in missing_fields else power
-                        acceleration = r_acc if 'acceleration' in missing_fields else acceleration
-                        top_speed = r_speed if 'top_speed' in missing_fields else top_speed
-                        engine_detail = r_engine if not engine_detail or engine_detail == "No engine details available." else engine_detail
-                        interior = r_interior if not interior or interior == "No interior details available." else interior
-                        description = r_desc if not description or description == "No detailed description available." else description
-                        logger.info("Successfully researched missing information")
-                except Exception as e:
-                    logger.error(f"Error researching missing info: {str(e)}")
-                    pass
-
-            # Translate content based on language preference
-            if lang == 'vi':
-                try:
-                    logger.info("Translating content to Vietnamese")
-                    # Translate price description if it contains "depending on"
-                    if "depending on" in price.lower():
-                        price = price.replace("depending on year and trim level", "tùy thuộc vào phiên bản và năm sản xuất")
-                        price = price.replace("depending on", "tùy thuộc")
-                    
-                    # Translate description
-                    if description:
-                        description = translate_to_vietnamese(description)
-                    
-                    # Translate interior
-                    if interior:
-                        interior = translate_to_vietnamese(interior)
-                    
-                    # Translate engine details
-                    if engine_detail:
-                        engine_detail = translate_to_vietnamese(engine_detail)
-                    
-                    # Translate features
-                    if response_data["features"]:
-                        response_data["features"] = [translate_to_vietnamese(feature) for feature in response_data["features"]]
-                except Exception as e:
-                    logger.error(f"Error translating content: {str(e)}")
-                    pass
-            else:  # English
-                try:
-                    logger.info("Translating content to English")
-                    # Translate price description if it contains Vietnamese
-                    if any(vn_word in price.lower() for vn_word in ['tùy thuộc', 'phiên bản', 'năm sản xuất']):
-                        price = price.replace("tùy thuộc vào phiên bản và năm sản xuất", "depending on year and trim level")
-                        price = price.replace("tùy thuộc", "depending on")
-                    
-                    # Translate description to English if it's in Vietnamese
-                    if description and any(vn_word in description.lower() for vn_word in ['động cơ', 'nội thất', 'tính năng', 'công suất', 'tốc độ', 'xe', 'hệ thống', 'trang bị']):
-                        description = translate_to_english(description)
-                    
-                    # Translate interior to English if it's in Vietnamese
-                    if interior and any(vn_word in interior.lower() for vn_word in ['động cơ', 'nội thất', 'tính năng', 'công suất', 'tốc độ', 'xe', 'hệ thống', 'trang bị']):
-                        interior = translate_to_english(interior)
-                    
-                    # Translate engine details to English if it's in Vietnamese
-                    if engine_detail and any(vn_word in engine_detail.lower() for vn_word in ['động cơ', 'nội thất', 'tính năng', 'công suất', 'tốc độ', 'xe', 'hệ thống', 'trang bị']):
-                        engine_detail = translate_to_english(engine_detail)
-                    
-                    # Translate features to English if they're in Vietnamese
-                    if response_data["features"]:
-                        response_data["features"] = [translate_to_english(feature) if any(vn_word in feature.lower() for vn_word in ['động cơ', 'nội thất', 'tính năng', 'công suất', 'tốc độ', 'xe', 'hệ thống', 'trang bị']) else feature for feature in response_data["features"]]
-                except Exception as e:
-                    logger.error(f"Error translating content: {str(e)}")
-                    pass
-
-            end_time = datetime.now()
-            processing_time = (end_time - start_time).total_seconds()
-            
-            response_data = {
-                "car_name": car_name,
-                "brand": car_name.split()[0] if car_name else "",  # Extract brand from car name
-                "year": year,
-                "price": price,
-                "power": power,
-                "acceleration": acceleration,
-                "top_speed": top_speed,
-                "description": description,
-                "engineDetail": engine_detail,
-                "interior": interior,
-                "features": [],  # Will be populated from interior section
-                "processing_time": processing_time,
-                "timestamp": datetime.now().isoformat()  # Add timestamp for history
-            }
-            
-            # Extract features from interior section
-            if response_data["interior"]:
-                features = [line.strip('- ').strip() for line in response_data["interior"].split('\n') if line.strip().startswith('-')]
-                response_data["features"] = features
-            
-            # Lưu vào lịch sử
-            save_to_history(response_data)
-            # Lưu vào collection mặc định
-            save_to_collection(response_data)
-            logger.info(f"Successfully processed request in {processing_time} seconds")
-            return jsonify(response_data)
-            
-        except requests.exceptions.Timeout:
-            logger.error("Request timeout")
-            error_msg = {
-                'vi': "Quá thời gian phân tích. Vui lòng thử lại với ảnh khác (ảnh rõ nét hơn hoặc góc chụp khác).",
-                'en': "Analysis timeout. Please try again with a different image (clearer image or different angle)."
-            }
-            return jsonify({"error": error_msg[lang]}), 504
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request error: {str(e)}")
-            error_msg = {
-                'vi': "Lỗi kết nối đến máy chủ. Vui lòng kiểm tra kết nối mạng và thử lại sau.",
-                'en': "Server connection error. Please check your network and try again later."
-            }
-            return jsonify({"error": error_msg[lang]}), 500
+            ]
+        }]
+    }
+    if GEMINI_STRUCTURED_OUTPUT:
+        payload["generationConfig"] = {
+            "responseMimeType": "application/json",
+            "responseSchema": car_schema.IDENTIFICATION_SCHEMA,
+        }
+    return payload
+
+IMAGE_PLACEHOLDER = "@@IMAGE@@"
+
+def identification_body(base64_image, lang='en'):
+    """Serialized identification request; the base64 image is spliced into the JSON bytes once"""
+    prefix, suffix = json.dumps(identification_payload(IMAGE_PLACEHOLDER, lang)).encode("utf-8").split(
+        IMAGE_PLACEHOLDER.encode("ascii")
+    )
+    return b"".join((prefix, base64_image.encode("ascii"), suffix))
+
+def identification_fields(result, lang='en'):
+    """Extract the car fields from a generateContent response of the identification call"""
+    if 'error' in result:
+        logger.error(f"Gemini API error: {result['error']}")
+        raise AnalysisError('analysis_failed')
+
+    if 'candidates' not in result or not result['candidates']:
+        logger.error("No candidates in Gemini API response")
+        raise AnalysisError('analysis_failed')
+
+    content = result["candidates"][0]["content"]["parts"][0]["text"]
+    logger.info("Extracting fields from response")
+    return with_catalog_specs(parse_identification_text(content, lang), lang)
+
+def parse_identification_text(content, lang):
+    if GEMINI_STRUCTURED_OUTPUT:
+        identification = car_schema.parse_identification(content, prompt_lang(lang))
+        if identification is not None:
+            if identification.gaps:
+                logger.info(f"Identification of {identification.car_name} has gaps: {', '.join(identification.gaps)}")
+            return identification.to_fields()
+        # Không phải JSON (mô hình bỏ qua schema): đọc như văn bản tự do
+        logger.warning("Structured identification did not return JSON, parsing it as text")
+        car_schema.count_fallback()
+
+    try:
+        fields = dict(zip(SPEC_FIELDS, extract_fields(content)))
+        logger.info(f"Successfully extracted fields for car: {fields['car_name']}")
+        return fields
+    except Exception as e:
+        logger.error(f"Error extracting fields: {str(e)}")
+        raise AnalysisError('extraction_failed')
+
+# Số liệu phụ thuộc phiên bản: chỉ lấy từ danh mục khi tên khớp đúng mẫu xe
+CATALOG_TRIM_SPECS = ("price", "power", "acceleration", "top_speed")
+
+@metrics.timed("catalog")
+def with_catalog_specs(fields, lang='en'):
+    """Fill an identification from the local catalog, so enrichment has nothing to research
+
+    An exact match is authoritative for the trim-specific specs; a fuzzy (misspelled) match only
+    fills gaps. A prefix match ("Aventador SVJ", "Camry Hybrid") names a trim the catalog does not
+    have, so it is ignored and research runs as before.
+    """
+    match = vehicle_catalog.lookup(fields["car_name"], fields["year"])
+    if match is None:
+        return fields
+    if match.kind == "prefix":
+        logger.info(f"Catalog prefix match {match.car_name} for {fields['car_name']} ignored: trim not in catalog")
+        return fields
+    filled = {
+        name: value for name, value in match.fields(prompt_lang(lang)).items()
+        if (match.kind == "exact" and name in CATALOG_TRIM_SPECS)
+        or is_missing(fields[name], car_schema.PLACEHOLDERS[name])
+        or (name == "engine_detail" and "needs the engine specifications" in fields[name])
+    }
+    if filled:
+        logger.info(f"Catalog {match.kind} match {match.car_name} ({match.generation.name}) filled: {', '.join(filled)}")
+    return {**fields, **filled}
+
+def localize_price(price, lang):
+    if lang == 'vi':
+        # Translate price description if it contains "depending on"
+        if "depending on" in price.lower():
+            price = price.replace("depending on year and trim level", "tùy thuộc vào phiên bản và năm sản xuất")
+            price = price.replace("depending on", "tùy thuộc")
+    else:  # English
+        # Translate price description if it contains Vietnamese
+        if any(vn_word in price.lower() for vn_word in ['tùy thuộc', 'phiên bản', 'năm sản xuất']):
+            price = price.replace("tùy thuộc vào phiên bản và năm sản xuất", "depending on year and trim level")
+            price = price.replace("tùy thuộc", "depending on")
+    return price
+
+def build_response(fields, start_time):
+    car_name = fields["car_name"]
+    response_data = {
+        "car_name": car_name,
+        "brand": car_name.split()[0] if car_name else "",  # Extract brand from car name
+        "year": fields["year"],
+        "price": fields["price"],
+        "power": fields["power"],
+        "acceleration": fields["acceleration"],
+        "top_speed": fields["top_speed"],
+        "description": fields["description"],
+        "engineDetail": fields["engine_detail"],
+        "interior": fields["interior"],
+        "features": [],  # Will be populated from interior section
+        "processing_time": (datetime.now() - start_time).total_seconds(),
+        "timestamp": datetime.now().isoformat()  # Add timestamp for history
+    }
+
+    # Extract features from interior section
+    if response_data["interior"]:
+        features = [line.strip('- ').strip() for line in response_data["interior"].split('\n') if line.strip().startswith('-')]
+        response_data["features"] = features
+    return response_data
+
+def image_cache_keys(base64_image):
+    image_key = image_hash(base64_image)
+    phash = None
+    if RESULT_CACHE_PHASH:
+        try:
+            phash = perceptual_hash(base64_image)
+        except Exception as e:
+            logger.error(f"Error computing perceptual hash: {str(e)}")
+    return image_key, phash
+
+def record_translation_source(record):
+    """Text fields of the record in the language it was generated in"""
+    texts = record["texts"][record["lang"]]
+    return {field: texts[field] for field in records.TEXT_FIELDS if texts.get(field)}
+
+def add_record_language(record, lang, translated):
+    """Attach translated text to a cached record; kept only if every section was translated"""
+    record = records.with_texts(record, lang, translated or {})
+    # Đoạn vẫn sai ngôn ngữ mà không có bản dịch trong cache nghĩa là dịch lỗi: lần sau dịch lại
+    _, _, untranslated = plan_translation(translated or {}, lang)
+    if untranslated or not translated:
+        logger.warning(f"Translation of cached record {record['image_key'][:12]} to {lang} is incomplete, not caching it")
+        return record
+    result_cache.set(record["image_key"], record)
+    return record
+
+def serve_cached_record(record, lang, start_time):
+    """The cached analysis in lang, saved to history like a fresh one"""
+    processing_time = (datetime.now() - start_time).total_seconds()
+    record = {**record, "processing_time": processing_time, "timestamp": datetime.now().isoformat()}
+    save_result(record)
+    logger.info(f"Result cache hit for image {record['image_key'][:12]} in {processing_time} seconds")
+    return {**records.render(record, prompt_lang(lang)), "cached": True}
+
+@metrics.timed("cache_lookup")
+def cached_response(image_key, phash, lang, start_time):
+    """A previous analysis of the same image in lang; another language is translated, never re-identified"""
+    record = get_cached_record(image_key, phash)
+    if record is None:
+        return None
+    text_lang = prompt_lang(lang)
+    if text_lang not in record["texts"]:
+        logger.info(f"Cached record {record['image_key'][:12]} is in {record['lang']}, translating it to {text_lang}")
+        record = add_record_language(record, text_lang, translate_fields(record_translation_source(record), text_lang))
+    return serve_cached_record(record, lang, start_time)
+
+def prepare_image(image_file, lang):
+    """Encode the upload into its cache keys and the serialized identification request
+
+    The "body" entry is popped by whoever sends it, so the image is not kept
+    in memory for the rest of the analysis.
+    """
+    with metrics.stage("encode"):
+        base64_image = encode_image(image_file, max_size=512)
+        image_key, phash = image_cache_keys(base64_image)
+    return {"image_key": image_key, "phash": phash, "body": identification_body(base64_image, lang)}
+
+@metrics.timed("identification")
+def identify_car(body, lang):
+    response = gemini_client.hedged_post_generate_content(
+        "gemini-1.5-flash", body, api_version=IDENTIFY_API_VERSION, timeout=(3, 15),
+        priority=gemini_client.PRIORITY_PRIMARY,
+    )
+
+    if response.status_code != 200:
+        logger.error(f"API Error: {response.status_code} - {response.text}")
+        raise AnalysisError('analysis_failed')
+
+    logger.info("Received response from Gemini API")
+    return identification_fields(response.json(), lang)
+
+@metrics.timed("save")
+def finish_analysis(fields, image_key, phash, lang, start_time):
+    record = records.from_response(build_response(fields, start_time), prompt_lang(lang), image_key)
+    record = cache_result(image_key, phash, record)
+    save_result(record)
+    logger.info(f"Successfully processed request in {record['processing_time']} seconds")
+    return records.render(record, prompt_lang(lang))
+
+def run_analysis(image, lang, start_time):
+    """Identify, enrich and record one prepared image; raises on identification failures"""
+    logger.info("Sending request to Gemini API")
+    fields = identify_car(image.pop("body"), lang)
+    fields["price"] = localize_price(fields["price"], lang)
+
+    # Tra cứu thông tin còn thiếu và dịch song song
+    try:
+        fields = enrich_fields(fields, lang)
+    except Exception as e:
+        logger.error(f"Error enriching car information: {str(e)}")
+
+    return finish_analysis(fields, image["image_key"], image["phash"], lang, start_time)
+
+def analysis_error(e, lang):
+    """Response body and status for an exception raised while analyzing"""
+    if isinstance(e, AnalysisError):
+        return {"error": error_message(e.key, lang)}, e.status
+    if isinstance(e, gemini_client.CircuitOpenError):
+        logger.error(f"Gemini circuit open: {str(e)}")
+        return {"error": error_message('unavailable', lang)}, 503
+    if isinstance(e, gemini_client.QueueTimeoutError):
+        logger.error(f"Gemini rate limiter queue timeout: {str(e)}")
+        return {"error": error_message('busy', lang)}, 503
+    if isinstance(e, requests.exceptions.Timeout):
+        logger.error("Request timeout")
+        return {"error": error_message('timeout', lang)}, 504
+    if isinstance(e, requests.exceptions.RequestException):
+        logger.error(f"Request error: {str(e)}")
+        return {"error": error_message('connection', lang)}, 500
+    logger.error(f"Unexpected error: {str(e)}")
+    return {"error": error_message('unexpected', lang)}, 500
+
+def uploaded_image():
+    """The image of an analyze request, or (None, error response) when it cannot be analyzed"""
+    if not api_key:
+        logger.error("API key is not configured")
+        return None, (jsonify({"error": "API key is not configured"}), 500)
+
+    logger.debug(f"Using API key: {api_key[:5]}...{api_key[-5:]}")
+
+    if 'image' not in request.files:
+        logger.error("No image file provided")
+        return None, (jsonify({"error": "No image file provided"}), 400)
+
+    image_file = request.files['image']
+    logger.info(f"Received image file: {image_file.filename}")
+
+    if not image_file.filename:
+        logger.error("No image file selected")
+        return None, (jsonify({"error": "No image file selected"}), 400)
+    return image_file, None
+
+def wants_timings():
+    return request.values.get('timings', '').lower() in ('1', 'true', 'yes')
+
+def with_timings(response_data):
+    """The response with the per-stage breakdown of this request, when the client asked for it"""
+    if not wants_timings():
+        return response_data
+    return {**response_data, "timings": metrics.current().timings()}
+
+@app.route('/analyze_car', methods=['POST'])
+@metrics.tracked('analyze_car')
+def analyze_car():
+    lang = request.form.get('lang', 'vi')
+    try:
+        logger.info("Received analyze_car request")
+        image_file, error = uploaded_image()
+        if error:
+            return error
             
+        logger.info(f"Language: {lang}")
+        
+        start_time = datetime.now()
+        
+        try:
+            image = prepare_image(image_file, lang)
+            logger.info("Image encoded successfully")
+        except Exception as e:
+            logger.error(f"Error encoding image: {str(e)}")
+            payload, status = image_error(e, lang)
+            return jsonify(payload), status
+        finally:
+            # Giải phóng file upload (bộ nhớ hoặc file tạm) trước khi chờ Gemini
+            image_file.close()
+
+        cached = cached_response(image["image_key"], image["phash"], lang, start_time)
+        if cached is not None:
+            return jsonify(with_timings(cached))
+
+        try:
+            return jsonify(with_timings(run_analysis(image, lang, start_time)))
+        except Exception as e:
+            payload, status = analysis_error(e, lang)
+            return jsonify(payload), status
+
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
-        error_msg = {
-            'vi': "Đã xảy ra lỗi không mong muốn. Vui lòng thử lại sau.",
-            'en': "An unexpected error occurred. Please try again later."
+        return jsonify({"error": error_message('unexpected', lang)}), 500
+
+# Các trường có ngay sau lần gọi Gemini đầu tiên
+IDENTIFICATION_KEYS = ("car_name", "brand", "year", "price", "power", "acceleration", "top_speed")
+# Tên trường trong response khác tên nội bộ
+RESPONSE_KEYS = {"engine_detail": "engineDetail"}
+STREAM_FORMATS = ('sse', 'ndjson')
+
+def format_event(event, data, fmt):
+    if fmt == 'ndjson':
+        return json.dumps({"event": event, "data": data}, ensure_ascii=False) + "\n"
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def elapsed(start_time):
+    return (datetime.now() - start_time).total_seconds()
+
+def iter_analysis_events(image, lang, start_time):
+    """Events of one streamed analysis: identification, each enrichment as it completes, then the result"""
+    try:
+        fields = identify_car(image.pop("body"), lang)
+        fields["price"] = localize_price(fields["price"], lang)
+        identification = build_response(fields, start_time)
+        yield "identification", {
+            **{key: identification[key] for key in IDENTIFICATION_KEYS},
+            "processing_time": identification["processing_time"],
         }
-        return jsonify({"error": error_msg[lang]}), 500
+
+        try:
+            for stage, names, fields in iter_enrichment(fields, lang):
+                if names:
+                    yield stage, {
+                        "fields": {RESPONSE_KEYS.get(name, name): fields[name] for name in names},
+                        "processing_time": elapsed(start_time),
+                    }
+        except Exception as e:
+            logger.error(f"Error enriching car information: {str(e)}")
+
+        yield "result", finish_analysis(fields, image["image_key"], image["phash"], lang, start_time)
+
+    except Exception as e:
+        payload, status = analysis_error(e, lang)
+        yield "error", {**payload, "status": status}
+
+def iter_cached_events(cached):
+    yield "identification", {
+        **{key: cached[key] for key in IDENTIFICATION_KEYS},
+        "processing_time": cached["processing_time"],
+    }
+    yield "result", cached
+
+@app.route('/analyze_car/stream', methods=['POST'])
+def analyze_car_stream():
+    """/analyze_car as a stream of events (SSE, or NDJSON with format=ndjson)"""
+    lang = request.form.get('lang', 'vi')
+    fmt = request.form.get('format', request.args.get('format', 'sse'))
+    if fmt not in STREAM_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(STREAM_FORMATS)}"}), 400
+
+    logger.info("Received analyze_car stream request")
+    image_file, error = uploaded_image()
+    if error:
+        return error
+
+    start_time = datetime.now()
+    request_metrics = metrics.RequestMetrics('analyze_car_stream')
+    include_timings = wants_timings()
+    with metrics.activate(request_metrics):
+        try:
+            image = prepare_image(image_file, lang)
+            logger.info("Image encoded successfully")
+        except Exception as e:
+            logger.error(f"Error encoding image: {str(e)}")
+            payload, status = image_error(e, lang)
+            return jsonify(payload), status
+        finally:
+            image_file.close()
+
+        cached = cached_response(image["image_key"], image["phash"], lang, start_time)
+    if cached is not None:
+        events = iter_cached_events(cached)
+    else:
+        events = iter_analysis_events(image, lang, start_time)
+
+    def generate():
+        # Generator chạy sau khi view trả về: request được đo tiếp đến sự kiện cuối
+        with metrics.track_request('analyze_car_stream', request_metrics):
+            for event, data in events:
+                if event == "result" and include_timings:
+                    data = {**data, "timings": request_metrics.timings()}
+                yield format_event(event, data, fmt)
+
+    return Response(
+        generate(),
+        mimetype='application/x-ndjson' if fmt == 'ndjson' else 'text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Job phân tích bất đồng bộ: POST /upload trả về id ngay, client poll GET /analyze/<id>
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "30"))
+# Giới hạn ?wait= khi Flask trả lời (gunicorn sync): mỗi lần chờ giữ một thread của worker
+JOB_SYNC_MAX_WAIT = float(os.getenv("JOB_SYNC_MAX_WAIT", "2"))
+
+@metrics.tracked('job')
+def run_job(job_id, image, lang, start_time):
+    """Job handler: returns (result, None) or (None, error body with status)"""
+    try:
+        return run_analysis(image, lang, start_time), None
+    except Exception as e:
+        payload, status = analysis_error(e, lang)
+        return None, {**payload, "status": status}
+
+job_store = JobStore()
+job_queue = JobQueue(job_store, run_job)
+
+def job_id_for(image_key, lang):
+    # Cùng ảnh + cùng ngôn ngữ luôn cho cùng id, nên gửi lại ảnh không tạo job mới
+    return hashlib.sha256(f"{lang}:{image_key}".encode("utf-8")).hexdigest()[:32]
+
+def job_response(job):
+    response = {
+        "image_id": job["id"],
+        "status": job["status"],
+        "created_at": datetime.fromtimestamp(job["created_at"]).isoformat(),
+        "updated_at": datetime.fromtimestamp(job["updated_at"]).isoformat(),
+    }
+    if "result" in job:
+        response["result"] = job["result"]
+    if "error" in job:
+        response["error"] = job["error"]["error"]
+        response["error_status"] = job["error"]["status"]
+    return response
+
+def parse_wait(value, max_wait=JOB_MAX_WAIT):
+    try:
+        return min(max(float(value or 0), 0.0), max_wait)
+    except ValueError:
+        return None
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    """Submit an image for analysis; returns its job without waiting for the result"""
+    lang = request.form.get('lang', 'vi')
+    image_file, error = uploaded_image()
+    if error:
+        return error
+
+    start_time = datetime.now()
+    try:
+        image = prepare_image(image_file, lang)
+    except Exception as e:
+        logger.error(f"Error encoding image: {str(e)}")
+        payload, status = image_error(e, lang)
+        return jsonify(payload), status
+    finally:
+        image_file.close()
+
+    job_id = job_id_for(image["image_key"], lang)
+    job, created = job_store.claim(job_id)
+    if created:
+        cached = cached_response(image["image_key"], image["phash"], lang, start_time)
+        if cached is not None:
+            job_store.update(job_id, DONE, result=cached)
+        else:
+            try:
+                job_queue.submit(job_id, image, lang, start_time)
+                logger.info(f"Queued analysis job {job_id}")
+            except JobQueueFullError as e:
+                logger.warning(str(e))
+                job_store.update(job_id, FAILED, error={"error": error_message('busy', lang), "status": 503})
+                return jsonify({"error": error_message('busy', lang)}), 503
+        job = job_store.get(job_id)
+    else:
+        logger.info(f"Image already submitted as job {job_id} ({job['status']})")
+
+    return jsonify(job_response(job)), 200 if job["status"] in FINISHED else 202
+
+@app.route('/analyze/<image_id>', methods=['GET'])
+def get_analysis(image_id):
+    """Job status and result; ?wait=N long-polls up to N seconds for it to finish"""
+    lang = request.args.get('lang', 'vi')
+    wait = parse_wait(request.args.get('wait'), JOB_SYNC_MAX_WAIT)
+    if wait is None:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    job = job_store.wait(image_id, wait) if wait else job_store.get(image_id)
+    if job is None:
+        return jsonify({"error": error_message('job_not_found', lang)}), 404
+    return jsonify(job_response(job))
+
+@app.route('/jobs/stats', methods=['GET'])
+def get_job_stats():
+    return jsonify(job_queue.stats())
+
+# Số ảnh của một batch được mã hóa/nhận diện/tra cứu cùng lúc (mỗi worker)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch")
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def identify_batch_image(item, lang, start_time):
+    """Encode and identify one image of a batch; fills item with fields, a cached result or an error"""
+    started = time.perf_counter()
+    image_file = item.pop("file")
+    try:
+        image = prepare_image(image_file, lang)
+    except Exception as e:
+        logger.error(f"Error encoding batch image {item['index']}: {str(e)}")
+        item["error"], item["error_status"] = image_error(e, lang)
+        return
+    finally:
+        image_file.close()
+        item["timings"]["encode_ms"] = elapsed_ms(started)
+
+    item["image"] = image
+    cached = cached_response(image["image_key"], image["phash"], lang, start_time)
+    if cached is not None:
+        item["result"] = cached
+        return
+
+    started = time.perf_counter()
+    try:
+        fields = identify_car(image.pop("body"), lang)
+        fields["price"] = localize_price(fields["price"], lang)
+        item["fields"] = fields
+    except Exception as e:
+        item["error"], item["error_status"] = analysis_error(e, lang)
+    finally:
+        item["timings"]["identify_ms"] = elapsed_ms(started)
+
+def prefetch_research(group, lang):
+    """Run the spec research a group of images of the same car needs once, filling the spec cache"""
+    car_name = group[0]["fields"]["car_name"]
+    plans = [plan_enrichment(item["fields"]) for item in group]
+    missing_fields = sorted({field for plan in plans for field in plan["missing_fields"]})
+    tasks = {}
+    if any(plan["needs_engine"] for plan in plans):
+        tasks["engine"] = lambda: research_engine_info(car_name, lang)
+    if missing_fields:
+        tasks["missing"] = lambda: research_missing_info(car_name, missing_fields, lang)
+    for _ in iter_completed(tasks):
+        pass
+
+def finish_batch_image(item, lang, start_time):
+    started = time.perf_counter()
+    fields = item.pop("fields")
+    try:
+        fields = enrich_fields(fields, lang)
+    except Exception as e:
+        logger.error(f"Error enriching car information: {str(e)}")
+    image = item["image"]
+    item["result"] = finish_analysis(fields, image["image_key"], image["phash"], lang, start_time)
+    item["timings"]["enrich_ms"] = elapsed_ms(started)
+
+def batch_map(func, items, *args):
+    """Run func(item, *args) for each item on the batch pool; an exception is recorded on the item"""
+    futures = {batch_executor.submit(metrics.bind(func), item, *args): item for item in items}
+    for future in as_completed(futures):
+        item = futures[future]
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Error in batch image {item['index']}: {str(e)}")
+            item["error"], item["error_status"] = analysis_error(e, item["lang"])
+
+def batch_item_response(item):
+    response = {"index": item["index"], "filename": item["filename"], "timings": item["timings"]}
+    if "result" in item:
+        response["status"] = "ok"
+        response["result"] = item["result"]
+    else:
+        response["status"] = "error"
+        response["error"] = item["error"]["error"]
+        response["error_status"] = item["error_status"]
+    return response
+
+@app.route('/analyze_batch', methods=['POST'])
+@metrics.tracked('analyze_batch')
+def analyze_batch():
+    """Analyze several images (form field "images", repeated) in one request"""
+    lang = request.form.get('lang', 'vi')
+    if not api_key:
+        logger.error("API key is not configured")
+        return jsonify({"error": "API key is not configured"}), 500
+
+    files = [f for f in request.files.getlist('images') if f.filename]
+    if not files:
+        return jsonify({"error": "No image files provided"}), 400
+    if len(files) > BATCH_MAX_IMAGES:
+        return jsonify({"error": f"A batch can contain at most {BATCH_MAX_IMAGES} images"}), 400
+
+    logger.info(f"Received batch of {len(files)} images, language: {lang}")
+    batch_started = time.perf_counter()
+    start_time = datetime.now()
+    items = [
+        {"index": i, "filename": f.filename, "file": f, "lang": lang, "timings": {}}
+        for i, f in enumerate(files)
+    ]
+
+    # 1. Mã hóa và nhận diện song song, tối đa BATCH_CONCURRENCY ảnh cùng lúc
+    batch_map(identify_batch_image, items, lang, start_time)
+    identified = [item for item in items if "fields" in item]
+
+    # 2. Các ảnh cùng một xe dùng chung một lần tra cứu thông số
+    groups = {}
+    for item in identified:
+        groups.setdefault(normalize_car_name(item["fields"]["car_name"]), []).append(item)
+    research_started = time.perf_counter()
+    wait([batch_executor.submit(metrics.bind(prefetch_research), group, lang) for group in groups.values()])
+    research_ms = elapsed_ms(research_started)
+
+    # 3. Bổ sung/dịch từng ảnh (thông số đã có trong spec cache) và lưu kết quả
+    batch_map(finish_batch_image, identified, lang, start_time)
+
+    results = [batch_item_response(item) for item in items]
+    succeeded = sum(1 for result in results if result["status"] == "ok")
+    logger.info(f"Processed batch of {len(items)} images ({len(groups)} distinct cars) in {elapsed_ms(batch_started)} ms")
+    return jsonify({
+        "results": results,
+        "images": len(items),
+        "succeeded": succeeded,
+        "failed": len(items) - succeeded,
+        "distinct_cars": len(groups),
+        "timings": {
+            "research_ms": research_ms,
+            "total_ms": elapsed_ms(batch_started),
+            "gemini_calls": metrics.current().gemini_calls,
+        },
+        "processing_time": (datetime.now() - start_time).total_seconds(),
+    })
+
+@app.errorhandler(413)
+def request_too_large(e):
+    # Body chưa được đọc nên không biết trường lang, dùng mặc định như /analyze_car
+    lang = request.args.get('lang', 'vi')
+    return jsonify({"error": error_message('image_too_large', lang)}), 413
 
 @app.route('/test_api', methods=['GET'])
 def test_api():
@@ -745,21 +1660,11 @@ def test_api():
             }]
         }
 
-        headers = {
-            "Content-Type": "application/json"
-        }
-
         # Sử dụng API endpoint từ AI Studio
-        api_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
+        api_url = gemini_client.model_url("gemini-pro", api_version="v1beta")
         logger.info(f"Calling API URL: {api_url}")
         
-        response = requests.post(
-            api_url,
-            params={"key": api_key},
-            headers=headers,
-            json=payload,
-            timeout=10
-        )
+        response = gemini_client.post_generate_content("gemini-pro", payload, api_version="v1beta", timeout=10)
         
         if response.status_code != 200:
             logger.error(f"API Error: {response.status_code} - {response.text}")
@@ -786,44 +1691,184 @@ def test_api():
         logger.error(f"Unexpected error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(cache_stats())
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({"status": "ok"})
+
+@app.route('/gemini/stats', methods=['GET'])
+def get_gemini_stats():
+    return jsonify({**gemini_client.connection_stats(), "structured_output": car_schema.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/singleflight/stats', methods=['GET'])
+def get_singleflight_stats():
+    return jsonify(singleflight_stats())
+
+@app.route('/catalog/stats', methods=['GET'])
+def get_catalog_stats():
+    return jsonify(vehicle_catalog.stats())
+
+@app.route('/persistence/stats', methods=['GET'])
+def get_persistence_stats():
+    return jsonify(persistence_queue.stats())
+
 @app.route('/brands', methods=['GET'])
 def get_brands():
-    brands = [
-        {"name": "Toyota", "logo_url": "https://example.com/toyota.png"},
-        {"name": "Honda", "logo_url": "https://example.com/honda.png"},
-        {"name": "BMW", "logo_url": "https://example.com/bmw.png"},
-        {"name": "Mercedes", "logo_url": "https://example.com/mercedes.png"},
-        {"name": "Audi", "logo_url": "https://example.com/audi.png"},
-        # Thêm các thương hiệu khác nếu muốn
-    ]
-    return jsonify(brands)
+    try:
+        limit, cursor = parse_page_args()
+    except ValueError:
+        return jsonify({"error": "limit and cursor must be integers"}), 400
+    brands = vehicle_catalog.brand_list()
+    if limit is None:
+        response = jsonify(brands)
+    else:
+        # cursor là vị trí trong danh sách hãng đã sắp xếp theo tên
+        start = cursor or 0
+        next_cursor = start + limit if start + limit < len(brands) else None
+        response = jsonify({
+            "items": brands[start:start + limit],
+            "next_cursor": str(next_cursor) if next_cursor is not None else None,
+        })
+    # Nội dung chỉ đổi khi danh mục đổi phiên bản: ETag theo phiên bản + hash file
+    if vehicle_catalog.etag:
+        response.set_etag(vehicle_catalog.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = BRANDS_CACHE_MAX_AGE
+    return response.make_conditional(request)
+
+def localized(item, lang):
+    """A stored history/collection entry in lang; a missing language is borrowed from the result cache"""
+    if lang and records.is_record(item) and lang not in item["texts"] and item.get("image_key"):
+        cached = result_cache.get(item["image_key"])
+        if records.is_record(cached) and lang in cached["texts"]:
+            item = records.with_texts(item, lang, cached["texts"][lang])
+    return records.localize(item, prompt_lang(lang) if lang else None)
 
 @app.route('/history', methods=['GET'])
 def get_history():
+    lang = request.args.get('lang')
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                history = json.load(f)
-        else:
-            history = []
-        return jsonify(history)
+        if not any(param in request.args for param in HISTORY_PAGE_PARAMS):
+            # Không có tham số phân trang: trả về danh sách đầy đủ như trước
+            return jsonify([localized(item, lang) for item in history_store.list()])
+        try:
+            limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+            cursor = int(request.args['cursor']) if request.args.get('cursor') else None
+            year = int(request.args['year']) if request.args.get('year') else None
+        except ValueError:
+            return jsonify({"error": "limit, cursor and year must be integers"}), 400
+        items, next_cursor = history_store.page(
+            limit=limit,
+            cursor=cursor,
+            brand=request.args.get('brand'),
+            year=year,
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            summary=request.args.get('fields') == 'summary',
+        )
+        return jsonify({
+            "items": [localized(item, lang) for item in items],
+            "next_cursor": str(next_cursor) if next_cursor is not None else None,
+        })
     except Exception as e:
         logger.error(f"Error reading history: {str(e)}")
         return jsonify([]), 500
 
+def parse_page_args():
+    """limit/cursor query parameters; limit is None when not paging"""
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    limit = min(max(int(limit), 1), HISTORY_MAX_PAGE_SIZE) if limit else None
+    cursor = int(cursor) if cursor else None
+    if cursor is not None and limit is None:
+        limit = HISTORY_PAGE_SIZE
+    return limit, cursor
+
 @app.route('/collection', methods=['GET'])
 def get_collection():
     collection_name = request.args.get('name', 'Favorites')
     try:
-        if os.path.exists(COLLECTION_FILE):
-            with open(COLLECTION_FILE, "r", encoding="utf-8") as f:
-                collections = json.load(f)
-            return jsonify(collections.get(collection_name, []))
-        else:
-            return jsonify([])
+        try:
+            limit, cursor = parse_page_args()
+        except ValueError:
+            return jsonify({"error": "limit and cursor must be integers"}), 400
+        items, next_cursor = collection_store.page(collection_name, limit=limit, cursor=cursor)
+        items = [localized(item, request.args.get('lang')) for item in items]
+        if limit is None:
+            return jsonify(items)
+        return jsonify({
+            "items": items,
+            "next_cursor": str(next_cursor) if next_cursor is not None else None,
+        })
     except Exception as e:
         logger.error(f"Error reading collection: {str(e)}")
         return jsonify([]), 500
 
+@app.route('/collections', methods=['GET'])
+def list_collections():
+    return jsonify(collection_store.names())
+
+@app.route('/collections', methods=['POST'])
+def create_collection():
+    name = (request.get_json(silent=True) or {}).get('name', '').strip()
+    if not name:
+        return jsonify({"error": "Collection name is required"}), 400
+    try:
+        collection_store.create(name)
+    except CollectionError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify({"name": name}), 201
+
+@app.route('/collections/<name>', methods=['PATCH'])
+def rename_collection(name):
+    new_name = (request.get_json(silent=True) or {}).get('name', '').strip()
+    if not new_name:
+        return jsonify({"error": "New collection name is required"}), 400
+    try:
+        collection_store.rename(name, new_name)
+    except CollectionNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except CollectionError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify({"name": new_name})
+
+@app.route('/collections/<name>', methods=['DELETE'])
+def delete_collection(name):
+    try:
+        collection_store.delete(name)
+    except CollectionNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    return jsonify({"deleted": name})
+
+@app.route('/collections/<name>/items', methods=['POST'])
+def add_collection_item(name):
+    car_data = request.get_json(silent=True)
+    if not isinstance(car_data, dict) or not car_data.get('car_name'):
+        return jsonify({"error": "car_name is required"}), 400
+    try:
+        added = collection_store.add(name, car_data)
+    except CollectionNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    return jsonify({"added": added}), 201 if added else 200
+
+@app.route('/collections/<name>/items', methods=['DELETE'])
+def remove_collection_item(name):
+    brand = request.args.get('brand', '')
+    car_name = request.args.get('car_name', '')
+    try:
+        removed = collection_store.remove(name, brand, car_name)
+    except CollectionNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    if not removed:
+        return jsonify({"error": "Item not found"}), 404
+    return jsonify({"removed": True})
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,374 @@
+# Chế độ ASGI: /analyze_car chạy async, các route còn lại do Flask app xử lý.
+# Chạy bằng: uvicorn asgi:app --workers 2
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import app as flask_app
+import gemini_client
+import metrics
+from app import (
+    AnalysisError, ENRICHMENT_TIMEOUT, MISSING_INFO_PROMPTS, ENGINE_INFO_PROMPTS, ENGINE_INFO_FALLBACKS,
+    TRANSLATION_PROMPTS, translation_cache, translation_key, batch_translation_key, normalize_section,
+    prompt_lang, research_key, parse_batch_translation, batch_translation_prompt, store_batch_translation, plan_translation,
+    apply_translations, plan_enrichment, needs_engine_fallback, merge_research,
+    cached_missing_research, store_missing_research, cached_engine_research, store_engine_research,
+    error_message, image_error, identification_fields, localize_price, IDENTIFY_API_VERSION,
+    prepare_image, get_cached_record, record_translation_source, add_record_language, serve_cached_record,
+    finish_analysis, job_store, job_response, parse_wait,
+)
+from imaging import MAX_REQUEST_BYTES
+from jobs import FINISHED, JOB_POLL_INTERVAL
+from singleflight import coalesced
+
+logger = logging.getLogger(__name__)
+
+# Pillow nhả GIL khi decode/resize/encode nên thread pool là đủ để không chặn event loop
+ASGI_IMAGE_WORKERS = int(os.getenv("ASGI_IMAGE_WORKERS", "4"))
+# Số request Flask (WSGI) chạy song song trong mỗi worker
+ASGI_WSGI_WORKERS = int(os.getenv("ASGI_WSGI_WORKERS", "10"))
+
+image_executor = ThreadPoolExecutor(max_workers=ASGI_IMAGE_WORKERS, thread_name_prefix="image")
+
+
+async def run_blocking(func, *args):
+    """Run a blocking SQLite read/commit in the default pool so it does not stall the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, metrics.bind(func), *args)
+
+
+@coalesced(research_key)
+async def fetch_missing_research(car_name, lang='en'):
+    cached = await run_blocking(cached_missing_research, car_name, lang)
+    if cached:
+        return cached
+    content = await gemini_client.async_generate_text(
+        "gemini-pro", MISSING_INFO_PROMPTS[prompt_lang(lang)].format(car_name=car_name), api_version="v1beta",
+        timeout=20,
+    )
+    return await run_blocking(store_missing_research, car_name, content, lang)
+
+
+@metrics.timed("missing_research")
+async def research_missing_info(car_name, missing_fields, lang='en'):
+    """Async twin of app.research_missing_info"""
+    cached = await run_blocking(cached_missing_research, car_name, lang)
+    if cached:
+        return cached
+    try:
+        return await fetch_missing_research(car_name, lang)
+    except Exception as e:
+        logger.error(f"Error researching information: {str(e)}")
+        return None
+
+
+@coalesced(research_key)
+async def fetch_engine_research(car_name, lang='en'):
+    cached = await run_blocking(cached_engine_research, car_name, lang)
+    if cached:
+        return cached
+    engine_info = await gemini_client.async_generate_text(
+        "gemini-pro", ENGINE_INFO_PROMPTS[prompt_lang(lang)].format(car_name=car_name), api_version="v1beta",
+        timeout=20,
+    )
+    return await run_blocking(store_engine_research, car_name, engine_info, lang)
+
+
+@metrics.timed("engine_research")
+async def research_engine_info(car_name, lang='en'):
+    """Async twin of app.research_engine_info"""
+    cached = await run_blocking(cached_engine_research, car_name, lang)
+    if cached:
+        return cached
+    try:
+        return await fetch_engine_research(car_name, lang)
+    except Exception as e:
+        logger.error(f"Error researching engine info: {str(e)}")
+        return ENGINE_INFO_FALLBACKS[prompt_lang(lang)]
+
+
+@coalesced(translation_key)
+async def fetch_translation(section, target_lang):
+    key = translation_key(section, target_lang)
+    cached = await run_blocking(translation_cache.get, key)
+    if cached is not None:
+        return cached
+
+    translated = await gemini_client.async_generate_text(
+        "gemini-1.5-flash", TRANSLATION_PROMPTS[target_lang].format(section=section), timeout=20,
+        priority=gemini_client.PRIORITY_TRANSLATION
+    )
+    await run_blocking(translation_cache.set, key, translated)
+    return translated
+
+
+async def translate_section(section, target_lang):
+    cached = await run_blocking(translation_cache.get, translation_key(section, target_lang))
+    if cached is not None:
+        return cached
+    return await fetch_translation(section, target_lang)
+
+
+@coalesced(batch_translation_key)
+async def fetch_batch_translation(segments, target_lang):
+    text = await gemini_client.async_generate_text(
+        "gemini-1.5-flash", batch_translation_prompt(segments, target_lang), timeout=30,
+        priority=gemini_client.PRIORITY_TRANSLATION
+    )
+    return parse_batch_translation(text, segments)
+
+
+async def translate_batch(sections, target_lang):
+    """Async twin of app.translate_batch"""
+    if len(sections) == 1:
+        try:
+            return {normalize_section(sections[0]): await translate_section(sections[0], target_lang)}
+        except Exception as e:
+            logger.error(f"Error translating section: {str(e)}")
+            return {}
+
+    segments = {f"s{i}": section for i, section in enumerate(sections)}
+    parsed = {}
+    try:
+        parsed = await fetch_batch_translation(segments, target_lang)
+    except Exception as e:
+        logger.error(f"Error in batched translation: {str(e)}")
+
+    translated, missing = await run_blocking(store_batch_translation, segments, parsed, target_lang)
+
+    async def fallback(segment_id):
+        try:
+            translated[normalize_section(segments[segment_id])] = await translate_section(
+                segments[segment_id], target_lang
+            )
+        except Exception as e:
+            logger.error(f"Error translating section: {str(e)}")
+
+    await asyncio.gather(*(fallback(segment_id) for segment_id in missing))
+    return translated
+
+
+@metrics.timed("translation")
+async def translate_fields(fields, target_lang):
+    split_fields, translations, pending = await run_blocking(plan_translation, fields, target_lang)
+    if pending:
+        translations.update(await translate_batch(pending, target_lang))
+    return apply_translations(fields, split_fields, translations, target_lang)
+
+
+@metrics.timed("cache_lookup")
+async def cached_response(image_key, phash, lang, start_time):
+    record = await run_blocking(get_cached_record, image_key, phash)
+    if record is None:
+        return None
+    text_lang = prompt_lang(lang)
+    if text_lang not in record["texts"]:
+        logger.info(f"Cached record {record['image_key'][:12]} is in {record['lang']}, translating it to {text_lang}")
+        translations = await translate_fields(record_translation_source(record), text_lang)
+        record = await run_blocking(add_record_language, record, text_lang, translations)
+    return await run_blocking(serve_cached_record, record, lang, start_time)
+
+
+async def run_concurrently(tasks, timeout=ENRICHMENT_TIMEOUT):
+    """Await coroutines together; one that fails or times out yields None"""
+    async def guarded(name, coro):
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Enrichment task '{name}' timed out after {timeout}s")
+        except Exception as e:
+            logger.error(f"Error in enrichment task '{name}': {str(e)}")
+        return None
+
+    results = await asyncio.gather(*(guarded(name, coro) for name, coro in tasks.items()))
+    return dict(zip(tasks, results))
+
+
+async def enrich_fields(fields, lang):
+    """Async twin of app.enrich_fields"""
+    fields = dict(fields)
+    car_name = fields["car_name"]
+    target_lang = 'vi' if lang == 'vi' else 'en'
+    plan = plan_enrichment(fields)
+
+    tasks = {}
+    if plan["needs_engine"]:
+        logger.info("Researching engine details")
+        tasks["engine"] = research_engine_info(car_name, lang)
+    if plan["missing_fields"]:
+        logger.info(f"Researching missing fields: {plan['missing_fields']}")
+        tasks["missing"] = research_missing_info(car_name, plan["missing_fields"], lang)
+    if plan["stable"]:
+        tasks["translate"] = translate_fields(plan["stable"], target_lang)
+    results = await run_concurrently(tasks)
+
+    if results.get("translate"):
+        fields.update(results["translate"])
+
+    researched = results.get("missing")
+    if needs_engine_fallback(fields, plan, results.get("engine"), researched):
+        # Try one more time with a different prompt
+        researched = (await run_concurrently({
+            "missing": research_missing_info(car_name, ['engine'], lang)
+        }))["missing"]
+    fields = merge_research(fields, plan, results.get("engine"), researched)
+
+    if plan["researched_names"]:
+        translated = (await run_concurrently({
+            "translate": translate_fields({name: fields[name] for name in plan["researched_names"]}, target_lang)
+        }))["translate"]
+        if translated:
+            fields.update(translated)
+    return fields
+
+
+@metrics.timed("identification")
+async def identify_car(body, lang):
+    """Async twin of app.identify_car"""
+    response = await gemini_client.async_hedged_post_generate_content(
+        "gemini-1.5-flash", body, api_version=IDENTIFY_API_VERSION, timeout=(3, 15),
+        priority=gemini_client.PRIORITY_PRIMARY,
+    )
+
+    if response.status_code != 200:
+        logger.error(f"API Error: {response.status_code} - {response.text}")
+        raise AnalysisError('analysis_failed')
+
+    logger.info("Received response from Gemini API")
+    return identification_fields(response.json(), lang)
+
+
+@metrics.tracked('analyze_car')
+async def analyze_car(request):
+    # Từ chối theo Content-Length trước khi đọc body
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+        lang = request.query_params.get('lang', 'vi')
+        return JSONResponse({"error": error_message('image_too_large', lang)}, status_code=413)
+
+    form = await request.form()
+    lang = form.get('lang', 'vi')
+    include_timings = form.get('timings', request.query_params.get('timings', '')).lower() in ('1', 'true', 'yes')
+
+    def respond(response_data):
+        if include_timings:
+            response_data = {**response_data, "timings": metrics.current().timings()}
+        return JSONResponse(response_data)
+
+    try:
+        logger.info("Received analyze_car request")
+        if not flask_app.api_key:
+            logger.error("API key is not configured")
+            return JSONResponse({"error": "API key is not configured"}, status_code=500)
+
+        image_file = form.get('image')
+        if not isinstance(image_file, UploadFile):
+            logger.error("No image file provided")
+            return JSONResponse({"error": "No image file provided"}, status_code=400)
+
+        logger.info(f"Received image file: {image_file.filename}")
+        if not image_file.filename:
+            logger.error("No image file selected")
+            return JSONResponse({"error": "No image file selected"}, status_code=400)
+
+        logger.info(f"Language: {lang}")
+
+        start_time = datetime.now()
+        loop = asyncio.get_running_loop()
+
+        try:
+            image = await loop.run_in_executor(image_executor, metrics.bind(prepare_image), image_file.file, lang)
+            logger.info("Image encoded successfully")
+        except Exception as e:
+            logger.error(f"Error encoding image: {str(e)}")
+            payload, status = image_error(e, lang)
+            return JSONResponse(payload, status_code=status)
+        finally:
+            await image_file.close()
+
+        cached = await cached_response(image["image_key"], image["phash"], lang, start_time)
+        if cached is not None:
+            return respond(cached)
+
+        try:
+            logger.info("Sending request to Gemini API")
+            fields = await identify_car(image.pop("body"), lang)
+            fields["price"] = localize_price(fields["price"], lang)
+
+            try:
+                fields = await enrich_fields(fields, lang)
+            except Exception as e:
+                logger.error(f"Error enriching car information: {str(e)}")
+
+            return respond(await run_blocking(finish_analysis, fields, image["image_key"], image["phash"], lang, start_time))
+
+        except AnalysisError as e:
+            return JSONResponse({"error": error_message(e.key, lang)}, status_code=e.status)
+
+        except gemini_client.CircuitOpenError as e:
+            logger.error(f"Gemini circuit open: {str(e)}")
+            return JSONResponse({"error": error_message('unavailable', lang)}, status_code=503)
+
+        except gemini_client.QueueTimeoutError as e:
+            logger.error(f"Gemini rate limiter queue timeout: {str(e)}")
+            return JSONResponse({"error": error_message('busy', lang)}, status_code=503)
+
+        except httpx.TimeoutException:
+            logger.error("Request timeout")
+            return JSONResponse({"error": error_message('timeout', lang)}, status_code=504)
+
+        except httpx.HTTPError as e:
+            logger.error(f"Request error: {str(e)}")
+            return JSONResponse({"error": error_message('connection', lang)}, status_code=500)
+
+    except Exception as e:
+        logger.error(f"Unexpected error: {str(e)}")
+        return JSONResponse({"error": error_message('unexpected', lang)}, status_code=500)
+
+
+async def get_analysis(request):
+    """Long-poll GET /analyze/<id> without holding a WSGI thread while waiting"""
+    image_id = request.path_params['image_id']
+    lang = request.query_params.get('lang', 'vi')
+    wait = parse_wait(request.query_params.get('wait'))
+    if wait is None:
+        return JSONResponse({"error": "wait must be a number of seconds"}, status_code=400)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+        job = await run_blocking(job_store.get, image_id)
+        remaining = deadline - loop.time()
+        if job is None or job["status"] in FINISHED or remaining <= 0:
+            break
+        await asyncio.sleep(min(remaining, JOB_POLL_INTERVAL))
+
+    if job is None:
+        return JSONResponse({"error": error_message('job_not_found', lang)}, status_code=404)
+    return JSONResponse(job_response(job))
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    yield
+    await gemini_client.close_async_client()
+    image_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/analyze_car', analyze_car, methods=['POST']),
+        Route('/analyze/{image_id}', get_analysis, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(flask_app.app, workers=ASGI_WSGI_WORKERS)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,143 @@
+# Gửi N request /analyze_car đồng thời và in throughput + độ trễ.
+# Mặc định mỗi request một ảnh khác nhau để tránh result cache; --images DIR
+# phát lại một bộ ảnh (lặp vòng nếu ít ảnh hơn số request).
+# Chạy: python bench/concurrency.py --url http://127.0.0.1:8000 --requests 64 --concurrency 32
+import argparse
+import io
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def make_image(seed):
+    image = Image.new("RGB", (1024, 768), ((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def load_corpus(directory):
+    """(filename, bytes) of every image in the directory, in name order"""
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(directory, name), "rb") as f:
+                corpus.append((name, f.read()))
+    if not corpus:
+        raise SystemExit(f"No images in {directory}")
+    return corpus
+
+
+def build_uploads(count, corpus=None):
+    if corpus:
+        return [corpus[i % len(corpus)] for i in range(count)]
+    seed = int(time.time())
+    return [(f"synthetic-{i}.jpg", make_image(seed + i)) for i in range(count)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def mock_calls(mock_url):
+    """generateContent calls the mock server has answered so far, by kind, or None without a mock"""
+    if not mock_url:
+        return None
+    return requests.get(f"{mock_url}/stats", timeout=5).json()["counts"]
+
+
+def run_load(url, uploads, concurrency, lang="en", mock_url=None, path="/analyze_car"):
+    """Send every upload with at most `concurrency` in flight; returns the summary dict"""
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def send(upload):
+        filename, image = upload
+        start = time.perf_counter()
+        try:
+            response = session.post(
+                f"{url}{path}",
+                data={"lang": lang},
+                files={"image": (filename, image, "image/jpeg")},
+                timeout=120,
+            )
+            status = response.status_code
+        except requests.RequestException:
+            status = None
+        return status, time.perf_counter() - start
+
+    before = mock_calls(mock_url)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, uploads))
+    elapsed = time.perf_counter() - start
+    after = mock_calls(mock_url)
+
+    latencies = [latency for _, latency in results]
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    summary = {
+        "requests": len(results),
+        "concurrency": concurrency,
+        "errors": sum(1 for status, _ in results if status != 200),
+        "statuses": statuses,
+        "wall_s": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2),
+        "latency_s": {
+            "p50": round(statistics.median(latencies), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies), 3),
+        },
+    }
+    if before is not None:
+        calls = {key: after[key] - before[key] for key in after}
+        summary["gemini_calls"] = calls
+        summary["gemini_calls_per_request"] = round(calls["calls"] / len(results), 2)
+    return summary
+
+
+def print_summary(summary):
+    latency = summary["latency_s"]
+    print(f"requests: {summary['requests']}  concurrency: {summary['concurrency']}  errors: {summary['errors']}")
+    print(f"throughput: {summary['rps']:.2f} req/s  wall: {summary['wall_s']:.2f}s")
+    print(
+        f"latency p50: {latency['p50']:.2f}s  p95: {latency['p95']:.2f}s  "
+        f"p99: {latency['p99']:.2f}s  max: {latency['max']:.2f}s"
+    )
+    if "gemini_calls" in summary:
+        calls = summary["gemini_calls"]
+        by_kind = "  ".join(f"{kind}: {calls[kind]}" for kind in sorted(calls) if kind not in ("calls", "errors"))
+        print(f"gemini calls/request: {summary['gemini_calls_per_request']:.2f}  ({by_kind}  errors: {calls['errors']})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--lang", default="en")
+    parser.add_argument("--images", help="directory of images to replay instead of synthetic ones")
+    parser.add_argument("--mock", help="mock_gemini.py URL, to count Gemini calls per request")
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    uploads = build_uploads(args.requests, load_corpus(args.images) if args.images else None)
+    summary = run_load(args.url, uploads, args.concurrency, args.lang, args.mock)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
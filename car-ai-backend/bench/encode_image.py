@@ -0,0 +1,162 @@
+# So sánh encode_image cũ (giải mã toàn bộ, vòng lặp giảm chất lượng) với đường nhanh
+# trong imaging.py: ms/ảnh và peak RSS, mỗi đường chạy trong một process riêng.
+# Chạy: python bench/encode_image.py [--images 20]
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from imaging import encode_image  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+# Bản encode_image trước khi có đường nhanh, giữ lại để so sánh
+def legacy_encode_image(image_file, max_size=512):
+    try:
+        # Đọc và kiểm tra kích thước file
+        image_file.seek(0, os.SEEK_END)
+        original_size = image_file.tell()
+        image_file.seek(0)
+        logger.info(f"Original file size: {original_size / 1024:.2f}KB")
+
+        if original_size > 10 * 1024 * 1024:  # 10MB limit
+            raise ValueError("File size exceeds 10MB limit")
+
+        # Đọc ảnh
+        image = Image.open(image_file)
+        logger.info(f"Original image size: {image.size}, mode: {image.mode}")
+
+        # Chuyển đổi sang RGB nếu cần
+        if image.mode != 'RGB':
+            logger.info(f"Converting image from {image.mode} to RGB")
+            image = image.convert('RGB')
+
+        # Tính toán kích thước mới
+        if max(image.size) > max_size:
+            ratio = max_size / max(image.size)
+            new_size = tuple(int(dim * ratio) for dim in image.size)
+            logger.info(f"Resizing image from {image.size} to {new_size}")
+            image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+        # Nén ảnh với chất lượng tự động điều chỉnh
+        quality = 85
+        buffer = io.BytesIO()
+        while True:
+            buffer.seek(0)
+            buffer.truncate()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True)
+            size = buffer.tell()
+            logger.info(f"Compressed size with quality {quality}: {size / 1024:.2f}KB")
+            
+            if size <= 800 * 1024 or quality <= 30:  # Giới hạn 800KB
+                break
+                
+            quality -= 10
+
+        buffer.seek(0)
+        base64_data = base64.b64encode(buffer.read()).decode("utf-8")
+        logger.info(f"Final base64 size: {len(base64_data) / 1024:.2f}KB")
+        return base64_data
+
+    except Exception as e:
+        logger.error(f"Error encoding image: {str(e)}")
+        raise
+
+
+def make_photo(width, height, seed, orientation=None):
+    """Noisy gradient photo, large enough to behave like a phone camera JPEG"""
+    noise = Image.effect_noise((width // 4, height // 4), 40 + seed % 20).resize((width, height))
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (noise, gradient, Image.radial_gradient("L").resize((width, height))))
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    image.save(buffer, format="JPEG", quality=92, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+SAMPLES = {
+    "12mp_jpeg": lambda seed: make_photo(4032, 3024, seed),
+    "12mp_jpeg_rotated": lambda seed: make_photo(4032, 3024, seed, orientation=6),
+    "small_jpeg": lambda seed: make_photo(480, 360, seed),
+}
+
+
+def run(path, sample_dir):
+    encode = legacy_encode_image if path == "old" else encode_image
+    uploads = []
+    for name in sorted(os.listdir(sample_dir)):
+        with open(os.path.join(sample_dir, name), "rb") as f:
+            uploads.append(f.read())
+    images = len(uploads)
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    sizes = []
+    for data in uploads:
+        sizes.append(len(encode(io.BytesIO(data), max_size=512)))
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "ms_per_image": round(elapsed * 1000 / images, 1),
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "rss_growth_mb": round((peak_rss - baseline_rss) / 1024, 1),
+        "avg_base64_kb": round(sum(sizes) / len(sizes) / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--path", choices=["old", "new"])
+    parser.add_argument("--samples")
+    parser.add_argument("--generate", choices=sorted(SAMPLES))
+    args = parser.parse_args()
+
+    if args.generate:
+        for seed in range(args.images):
+            with open(os.path.join(args.samples, f"{seed:03d}.jpg"), "wb") as f:
+                f.write(SAMPLES[args.generate](seed))
+        return
+    if args.path:
+        print(json.dumps(run(args.path, args.samples)))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="encode_bench_")
+    print(f"{'sample':<20}{'path':<6}{'ms/image':>10}{'peak RSS MB':>13}{'RSS growth MB':>15}{'base64 KB':>11}")
+    for sample in SAMPLES:
+        # Tạo ảnh mẫu ở process khác: peak RSS được kế thừa qua fork nên process cha phải nhỏ
+        sample_dir = os.path.join(workdir, sample)
+        os.makedirs(sample_dir)
+        subprocess.run(
+            [sys.executable, __file__, "--generate", sample, "--samples", sample_dir, "--images", str(args.images)],
+            check=True,
+        )
+        for path in ("old", "new"):
+            # Process riêng để peak RSS của đường này không bị đường kia ảnh hưởng
+            output = subprocess.run(
+                [sys.executable, __file__, "--path", path, "--samples", sample_dir],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{sample:<20}{path:<6}{result['ms_per_image']:>10}{result['peak_rss_mb']:>13}"
+                f"{result['rss_growth_mb']:>15}{result['avg_base64_kb']:>11}"
+            )
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# Kiểm tra thứ tự ưu tiên của AdaptiveLimiter khi token bucket là giới hạn thực sự:
+# xếp hàng các lời gọi dịch trước, rồi một lời gọi nhận diện; lời gọi nhận diện phải
+# được nhận token đầu tiên. Thoát với mã 1 nếu không đúng.
+# Chạy: python bench/limiter_priority.py [--rate 10] [--translations 6]
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import PRIORITY_PRIMARY, PRIORITY_TRANSLATION, AdaptiveLimiter  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=10, help="requests/second, as GEMINI_RATE_LIMITS")
+    parser.add_argument("--translations", type=int, default=6)
+    args = parser.parse_args()
+
+    # Slot đồng thời dư thừa; burst một token để bucket là giới hạn duy nhất
+    limiter = AdaptiveLimiter("check", rate=args.rate, burst_seconds=1 / args.rate, max_limit=16)
+    limiter.acquire(PRIORITY_TRANSLATION)  # dùng hết token có sẵn
+    admitted = []
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def call(name, priority):
+        limiter.acquire(priority, timeout=10)
+        with lock:
+            admitted.append((name, round(time.monotonic() - start, 2)))
+
+    threads = []
+    for i in range(args.translations):
+        threads.append(threading.Thread(target=call, args=(f"translation-{i}", PRIORITY_TRANSLATION)))
+        threads[-1].start()
+        time.sleep(0.005)
+    threads.append(threading.Thread(target=call, args=("identification", PRIORITY_PRIMARY)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+
+    for name, elapsed in admitted:
+        print(f"{elapsed:5.2f}s  {name}")
+    if admitted[0][0] != "identification":
+        print("FAIL: identification was not given the first token")
+        sys.exit(1)
+    print("OK: identification got the first token")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+# Server giả lập generateContent để chạy benchmark offline.
+# Chạy: python bench/mock_gemini.py --port 8090 --latency 0.5
+# rồi đặt GEMINI_BASE_URL=http://127.0.0.1:8090 cho backend.
+#
+# Câu trả lời nhận diện được dựng từ các bản ghi thật trong history.json: cùng
+# một ảnh luôn ra cùng một xe. GET /stats đếm số lời gọi theo loại.
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "history.json")
+
+IDENTIFICATION_TEXT = """Brand: Lamborghini
+Model: Veneno
+Year: 2013
+Price: $4,500,000 USD
+Performance:
+- Power: 750 hp
+- 0-60 mph: 2.8 seconds
+- Top Speed: 355 km/h
+
+Description:
+Overview:
+The Veneno is a limited-production hypercar built to celebrate Lamborghini's 50th anniversary.
+
+Engine Details:
+- Configuration: 6.5L naturally aspirated V12
+- Transmission: 7-speed ISR automated manual
+
+Interior & Features:
+- Seating: Carbon fiber racing seats
+- Technology: Race-derived telemetry display
+"""
+
+RESEARCH_TEXT = """Overview:
+Researched overview.
+
+Engine Details:
+- Power: 750 hp
+- 0-60 mph: 2.8 seconds
+- Top Speed: 355 km/h"""
+
+KINDS = ("identification", "research", "translation", "batch_translation")
+
+settings = {"latency": 0.5, "jitter": 0.0, "error_rate": 0.0, "error_status": 503}
+cars = []
+counts = {"calls": 0, "errors": 0, **{kind: 0 for kind in KINDS}}
+
+
+def bullets(text):
+    lines = [line.strip().lstrip("•-* ").strip() for line in (text or "").splitlines()]
+    return "\n".join(f"- {line}" for line in lines if line)
+
+
+def identification_text(entry):
+    """An answer in the IDENTIFY_PROMPT format built from one history record"""
+    brand = entry.get("brand") or entry["car_name"].split()[0]
+    model = entry["car_name"][len(brand):].strip() if entry["car_name"].startswith(brand) else entry["car_name"]
+    return "\n".join([
+        f"Brand: {brand}",
+        f"Model: {model}",
+        f"Year: {entry.get('year', '')}",
+        f"Price: {entry.get('price', '')}",
+        "Performance:",
+        f"- Power: {entry.get('power', 'N/A')}",
+        f"- 0-60 mph: {entry.get('acceleration', 'N/A')}",
+        f"- Top Speed: {entry.get('top_speed', 'N/A')}",
+        "",
+        "Description:",
+        "Overview:",
+        " ".join((entry.get("description") or "").split()),
+        "",
+        "Engine Details:",
+        bullets(entry.get("engineDetail")),
+        "",
+        "Interior & Features:",
+        bullets(entry.get("interior")),
+    ])
+
+
+def identification_json(entry):
+    """The same answer as identification_text, as JSON for a request with a responseSchema"""
+    brand = entry.get("brand") or entry["car_name"].split()[0]
+    model = entry["car_name"][len(brand):].strip() if entry["car_name"].startswith(brand) else entry["car_name"]
+    engine = bullets(entry.get("engineDetail")).splitlines()
+    interior = bullets(entry.get("interior")).splitlines()
+    return json.dumps({
+        "brand": brand,
+        "model": model,
+        "year": str(entry.get("year", "")),
+        "price": entry.get("price", ""),
+        "performance": {
+            "power": entry.get("power", ""),
+            "acceleration": entry.get("acceleration", ""),
+            "top_speed": entry.get("top_speed", ""),
+        },
+        "overview": " ".join((entry.get("description") or "").split()),
+        "engine": {
+            "configuration": engine[0][2:] if engine else "",
+            "displacement": "",
+            "aspiration": "",
+            "transmission": " ".join(line[2:] for line in engine[1:]),
+        },
+        "interior": {
+            "seating": interior[0][2:] if interior else "",
+            "dashboard": "",
+            "technology": "",
+            "key_features": [line[2:] for line in interior[1:]],
+        },
+    }, ensure_ascii=False)
+
+
+def research_text(entry):
+    return "\n".join([
+        "Overview:",
+        f"{entry['car_name']} ({entry.get('year', '')}).",
+        "",
+        "Engine Details:",
+        bullets(entry.get("engineDetail")) or "- Configuration: N/A",
+        f"- Power: {entry.get('power', 'N/A')}",
+        f"- 0-60 mph: {entry.get('acceleration', 'N/A')}",
+        f"- Top Speed: {entry.get('top_speed', 'N/A')}",
+    ])
+
+
+def load_cars(path):
+    """Every history.json record with a car name; records of the same car differ in wording"""
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    return [entry for entry in entries if entry.get("car_name")]
+
+
+def car_for_image(data):
+    # Cùng ảnh -> cùng xe, để result cache và research cache hoạt động như thật
+    digest = int(hashlib.sha1(data.encode("ascii")).hexdigest()[:8], 16)
+    return cars[digest % len(cars)]
+
+
+def car_in_prompt(prompt):
+    matches = [car for car in cars if car["car_name"] in prompt]
+    return max(matches, key=lambda car: len(car["car_name"])) if matches else None
+
+
+def reply(text):
+    return JSONResponse({"candidates": [{"content": {"parts": [{"text": text}]}}]})
+
+
+def answer(parts, prompt, structured=False):
+    """(kind, text) for one generateContent request"""
+    if len(parts) > 1:
+        image = parts[1].get("inline_data", {}).get("data", "")
+        if structured and cars:
+            return "identification", identification_json(car_for_image(image))
+        return "identification", identification_text(car_for_image(image)) if cars else IDENTIFICATION_TEXT
+    if prompt.startswith("Translate every value"):
+        # Trả lại đúng các key của batch, coi như đã dịch
+        segments = json.loads(prompt[prompt.index("{"):prompt.index("\n}\n") + 2])
+        return "batch_translation", json.dumps(segments, ensure_ascii=False)
+    if prompt.startswith("Translate"):
+        return "translation", prompt.split("\n\n")[1]
+    car = car_in_prompt(prompt)
+    return "research", research_text(car) if car else RESEARCH_TEXT
+
+
+async def generate_content(request):
+    payload = await request.json()
+    parts = payload["contents"][0]["parts"]
+    prompt = parts[0].get("text", "")
+    structured = "responseSchema" in payload.get("generationConfig", {})
+    kind, text = answer(parts, prompt, structured)
+    counts["calls"] += 1
+    counts[kind] += 1
+
+    jitter = settings["jitter"]
+    await asyncio.sleep(settings["latency"] * random.uniform(1 - jitter, 1 + jitter))
+    if random.random() < settings["error_rate"]:
+        counts["errors"] += 1
+        return JSONResponse({"error": {"message": "mock error"}}, status_code=settings["error_status"])
+    return reply(text)
+
+
+async def get_stats(request):
+    return JSONResponse({"counts": counts, "settings": settings, "cars": len(cars)})
+
+
+async def reset_stats(request):
+    for key in counts:
+        counts[key] = 0
+    return JSONResponse({"counts": counts})
+
+
+app = Starlette(routes=[
+    Route("/{version}/models/{model}:generateContent", generate_content, methods=["POST"]),
+    Route("/stats", get_stats, methods=["GET"]),
+    Route("/stats/reset", reset_stats, methods=["POST"]),
+])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per generateContent call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latency varies uniformly by +/- this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with an error")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--history", default=HISTORY_FILE, help="history.json used for canned answers")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    settings.update(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                    error_status=args.error_status)
+    random.seed(args.seed)
+    cars.extend(load_cars(args.history))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
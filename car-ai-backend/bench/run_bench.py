@@ -0,0 +1,210 @@
+# Benchmark offline trọn gói: khởi động mock Gemini và backend (gunicorn hoặc
+# uvicorn) trong thư mục tạm, chạy tải với concurrency chọn trước và in báo cáo
+# req/s, p50/p95/p99, số lời gọi Gemini mỗi request, CPU và RSS của từng worker.
+# Chạy: python bench/run_bench.py --server gunicorn --workers 2 --requests 200 --concurrency 16
+# CPU/RSS đọc từ /proc nên chỉ có trên Linux.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from concurrency import build_uploads, load_corpus, print_summary, run_load
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def wait_until_ready(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{url} exited with status {process.returncode}")
+        try:
+            # Chỉ 200 mới là sẵn sàng: 404/5xx nghĩa là URL sai hoặc app chưa khởi động xong
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"{url} did not start within {timeout}s")
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Tên process nằm trong ngoặc và có thể chứa khoảng trắng
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def process_usage(pid):
+    """(CPU seconds used so far, current RSS in bytes) of one process"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    rss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+    return cpu, rss
+
+
+class WorkerSampler:
+    """Samples CPU time and peak RSS of the server workers while the load runs"""
+
+    def __init__(self, pids, interval=0.25):
+        self.pids = pids
+        self.interval = interval
+        self.start_cpu = {}
+        self.end_cpu = {}
+        self.peak_rss = {pid: 0 for pid in pids}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        usage = {}
+        for pid in self.pids:
+            try:
+                usage[pid] = process_usage(pid)
+            except OSError:
+                continue
+            self.peak_rss[pid] = max(self.peak_rss[pid], usage[pid][1])
+        return usage
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start_cpu = {pid: cpu for pid, (cpu, _) in self._sample().items()}
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        self.end_cpu = {pid: cpu for pid, (cpu, _) in self._sample().items()}
+
+    def report(self):
+        workers = []
+        for pid in self.pids:
+            cpu = self.end_cpu.get(pid, 0.0) - self.start_cpu.get(pid, 0.0)
+            workers.append({
+                "pid": pid,
+                "cpu_s": round(cpu, 2),
+                "cpu_pct": round(100 * cpu / self.elapsed, 1),
+                "peak_rss_mb": round(self.peak_rss[pid] / (1024 * 1024), 1),
+            })
+        return workers
+
+
+def server_command(args):
+    bind = f"127.0.0.1:{args.port}"
+    if args.server == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(args.port),
+                "--workers", str(args.workers), "--log-level", "warning"]
+    return [sys.executable, "-m", "gunicorn", "app:app", "--bind", bind, "--workers", str(args.workers),
+            "--threads", str(args.threads), "--timeout", "120", "--log-level", "warning"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--mock-port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.5, help="mock seconds per Gemini call")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=0, help="requests sent before measuring")
+    parser.add_argument("--lang", default="en")
+    parser.add_argument("--images", help="directory of images to replay instead of synthetic ones")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--server-log", default=os.devnull, help="file for the server and mock output")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.images) if args.images else None
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    server_url = f"http://127.0.0.1:{args.port}"
+    processes = []
+    log = open(args.server_log, "ab")
+    with log, tempfile.TemporaryDirectory(prefix="car-ai-bench-") as workdir:
+        env = dict(
+            os.environ,
+            GEMINI_BASE_URL=mock_url,
+            GEMINI_API_KEY=os.getenv("GEMINI_API_KEY") or "bench-key",
+            PYTHONPATH=BACKEND_DIR,
+            GUNICORN_THREADS=str(args.threads),
+        )
+        try:
+            mock = subprocess.Popen([
+                sys.executable, os.path.join(BENCH_DIR, "mock_gemini.py"), "--port", str(args.mock_port),
+                "--latency", str(args.latency), "--jitter", str(args.jitter),
+                "--error-rate", str(args.error_rate), "--error-status", str(args.error_status), "--seed", "1",
+            ], stdout=log, stderr=log)
+            processes.append(mock)
+            wait_until_ready(f"{mock_url}/stats", mock)
+
+            # Thư mục tạm làm cwd: cache/history/jobs DB mới cho mỗi lần chạy
+            server = subprocess.Popen(server_command(args), cwd=workdir, env=env, stdout=log, stderr=log)
+            processes.append(server)
+            wait_until_ready(f"{server_url}/health", server)
+            workers = child_pids(server.pid) or [server.pid]
+
+            if args.warmup:
+                run_load(server_url, build_uploads(args.warmup, corpus), args.concurrency, args.lang)
+
+            uploads = build_uploads(args.requests, corpus)
+            with WorkerSampler(workers) as sampler:
+                summary = run_load(server_url, uploads, args.concurrency, args.lang, mock_url)
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    report = {
+        "server": args.server,
+        "workers": args.workers,
+        "threads": args.threads if args.server == "gunicorn" else None,
+        "mock": {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate},
+        **summary,
+        "worker_usage": sampler.report(),
+    }
+    print(f"server: {args.server}  workers: {args.workers}  mock latency: {args.latency}s  error rate: {args.error_rate}")
+    print_summary(summary)
+    for worker in report["worker_usage"]:
+        print(f"worker {worker['pid']}: cpu {worker['cpu_s']:.2f}s ({worker['cpu_pct']:.1f}%)  "
+              f"peak rss {worker['peak_rss_mb']:.1f} MB")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Đo bộ nhớ đỉnh (tracemalloc) của các bước xử lý upload trong /analyze_car và
+# kiểm tra các giới hạn; thoát với mã lỗi 1 nếu vượt ngân sách.
+# Chạy: python bench/upload_memory.py
+# tracemalloc chỉ thấy bộ nhớ do Python cấp (bytes, str, BytesIO, dict), không thấy
+# bộ đệm pixel của Pillow; đó chính là các bản sao ảnh/base64 cần giới hạn.
+import gc
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+# app mở history.db/collections.db/cache.db trong thư mục hiện tại
+os.chdir(tempfile.mkdtemp(prefix="upload_memory_"))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+
+import logging  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+import app  # noqa: E402
+from encode_image import legacy_encode_image, make_photo  # noqa: E402
+from imaging import MAX_REQUEST_BYTES, ImageTooLargeError, encode_image  # noqa: E402
+from PIL import Image  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def measure(func):
+    """Run func; returns (result, peak traced bytes above the starting point)"""
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak - start
+
+
+def legacy_pipeline(data):
+    # Trước đây: base64 str + dict payload + chuỗi JSON + bytes gửi đi cùng tồn tại
+    base64_image = legacy_encode_image(io.BytesIO(data), max_size=512)
+    return json.dumps(app.identification_payload(base64_image)).encode("utf-8")
+
+
+def new_pipeline(data):
+    return app.prepare_image(io.BytesIO(data), 'en')["body"]
+
+
+def main():
+    failures = []
+
+    def check(name, ok, detail):
+        print(f"{'PASS' if ok else 'FAIL'}  {name}: {detail}")
+        if not ok:
+            failures.append(name)
+
+    upload = make_photo(4032, 3024, seed=1)
+    print(f"12 MP upload: {len(upload) / MB:.2f}MB")
+
+    legacy_body, legacy_peak = measure(lambda: legacy_pipeline(upload))
+    body, peak = measure(lambda: new_pipeline(upload))
+    print(f"legacy pipeline peak: {legacy_peak / MB:.2f}MB, body {len(legacy_body) / MB:.2f}MB")
+    print(f"new pipeline peak:    {peak / MB:.2f}MB, body {len(body) / MB:.2f}MB")
+    # Đỉnh: bản JPEG đã nén + base64 + bản bytes tạm + body, không có bản sao nào của ảnh gốc
+    check("pipeline peak", peak <= 4 * len(body) + 256 * 1024,
+          f"{peak / 1024:.0f}KB for a {len(body) / 1024:.0f}KB request body")
+    check("pipeline peak below legacy", peak < legacy_peak,
+          f"{peak / 1024:.0f}KB vs {legacy_peak / 1024:.0f}KB")
+
+    # Sau khi chuẩn bị xong chỉ còn lại body
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    body = new_pipeline(upload)
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    check("retained after encoding", retained - start <= len(body) + 64 * 1024,
+          f"{(retained - start) / 1024:.0f}KB retained for a {len(body) / 1024:.0f}KB body")
+
+    # Upload quá lớn bị từ chối theo Content-Length, body không được đọc vào bộ nhớ
+    oversized = os.urandom(MAX_REQUEST_BYTES + MB)
+    client = app.app.test_client()
+
+    def post_oversized():
+        return client.post(
+            "/analyze_car",
+            data={"lang": "en", "image": (io.BytesIO(oversized), "big.jpg")},
+        ).status_code
+
+    status, peak = measure(post_oversized)
+    check("oversized upload rejected", status == 413, f"status {status}")
+    check("oversized upload not buffered", peak < len(oversized),
+          f"{peak / MB:.2f}MB traced for a {len(oversized) / MB:.2f}MB body")
+
+    # Decompression bomb: file nhỏ nhưng header khai báo 80 MP, bị chặn trước khi giải mã
+    bomb = io.BytesIO()
+    Image.new("L", (10000, 8000)).save(bomb, format="PNG")
+    started = time.perf_counter()
+    try:
+        encode_image(bomb)
+        rejected = False
+    except ImageTooLargeError:
+        rejected = True
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    check("decompression bomb rejected from header", rejected and elapsed_ms < 100,
+          f"{len(bomb.getvalue()) / 1024:.0f}KB file, rejected={rejected} in {elapsed_ms:.1f}ms")
+
+    app.persistence_queue.stop()
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
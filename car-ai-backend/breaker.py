@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Số lỗi liên tiếp (timeout, lỗi kết nối, 5xx) trước khi ngắt mạch
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+# Thời gian mạch mở trước khi cho một request thử lại
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """The endpoint is failing; the call was rejected without contacting it"""
+
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures -> half-open single probe after a cool-down"""
+
+    def __init__(self, name, failure_threshold=GEMINI_BREAKER_FAILURES, reset_timeout=GEMINI_BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self._stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go ahead; must be followed by record()"""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                logger.info(f"Circuit {self.name} half-open, sending a probe")
+            # Nửa mở: chỉ một request thăm dò, các request khác vẫn bị từ chối
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                self._stats["rejected"] += 1
+                raise CircuitOpenError(f"Circuit for {self.name} is open")
+            if self.state == HALF_OPEN:
+                self._probing = True
+
+    def abandon(self):
+        """The allowed call was cancelled before it got an answer"""
+        with self._lock:
+            self._probing = False
+
+    def record(self, success):
+        with self._lock:
+            self._probing = False
+            if success:
+                self._stats["successes"] += 1
+                self._failures = 0
+                if self.state != CLOSED:
+                    logger.info(f"Circuit {self.name} closed")
+                self.state = CLOSED
+                return
+            self._stats["failures"] += 1
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+                logger.warning(f"Circuit {self.name} opened after {self._failures} failures")
+
+    @property
+    def closed(self):
+        return self.state == CLOSED
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = self.state
+            stats["consecutive_failures"] = self._failures
+            if self.state == OPEN:
+                stats["retry_in"] = round(max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)), 1)
+        return stats
+
+
+def is_failure(status):
+    """Timeouts/connection errors (None) and 5xx count against the endpoint; 429 and 4xx do not"""
+    return status is None or status >= 500
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(endpoint):
+    """One breaker per endpoint URL, shared by all threads and the event loop of this process"""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(endpoint)
+            if breaker is None:
+                breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+
+def stats():
+    return {endpoint: breaker.stats() for endpoint, breaker in list(_breakers.items())}
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_DB_FILE = os.getenv("CACHE_DB_FILE", "cache.db")
+
+# Tất cả cache đã tạo, dùng cho endpoint thống kê
+_registry = []
+
+
+class LRUCache:
+    """Thread-safe LRU cache with TTL, optionally persisted to SQLite"""
+
+    def __init__(self, namespace, max_entries=1000, ttl=7 * 24 * 3600, db_path=CACHE_DB_FILE):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.RLock()
+        self._conn = None
+        if db_path:
+            try:
+                self._open_db()
+                self._load()
+            except Exception as e:
+                logger.error(f"Error opening cache database {db_path}: {str(e)}")
+                self._conn = None
+        _registry.append(self)
+
+    def _open_db(self):
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5)
+        # WAL cho phép nhiều worker gunicorn đọc/ghi cùng lúc
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_updated ON cache_entries (namespace, updated_at)"
+        )
+        self._conn.commit()
+
+    def _load(self):
+        """Load the most recently used, non-expired entries from disk"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, now),
+            )
+            rows = self._conn.execute(
+                "SELECT key, value, expires_at FROM cache_entries WHERE namespace = ? "
+                "ORDER BY updated_at DESC LIMIT ?",
+                (self.namespace, self.max_entries),
+            ).fetchall()
+            self._trim_db()
+            self._conn.commit()
+            for key, value, expires_at in reversed(rows):
+                try:
+                    self._data[key] = (expires_at, json.loads(value))
+                except ValueError:
+                    continue
+        logger.info(f"Loaded {len(self._data)} entries into cache '{self.namespace}'")
+
+    def _trim_db(self):
+        self._conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key NOT IN ("
+            "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY updated_at DESC LIMIT ?)",
+            (self.namespace, self.namespace, self.max_entries),
+        )
+
+    def _read_db(self, key):
+        row = self._conn.execute(
+            "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+            (self.namespace, key),
+        ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[1], json.loads(row[0])
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None and self._conn is not None:
+                # Worker khác có thể đã ghi entry này
+                try:
+                    entry = self._read_db(key)
+                except Exception as e:
+                    logger.error(f"Error reading cache '{self.namespace}': {str(e)}")
+                    entry = None
+                if entry is not None:
+                    self._store(key, entry)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.time():
+                self._delete(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._store(key, (expires_at, value))
+            if self._conn is not None:
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (self.namespace, key, json.dumps(value, ensure_ascii=False), expires_at, time.time()),
+                    )
+                    self._conn.commit()
+                except Exception as e:
+                    logger.error(f"Error writing cache '{self.namespace}': {str(e)}")
+
+    def _store(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            old_key, _ = self._data.popitem(last=False)
+            self.evictions += 1
+            self._delete_db(old_key)
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        self._data.pop(key, None)
+        self._delete_db(key)
+
+    def _delete_db(self, key):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key)
+            )
+            self._conn.commit()
+        except Exception as e:
+            logger.error(f"Error deleting from cache '{self.namespace}': {str(e)}")
+
+    def items(self):
+        """Snapshot of the live in-memory entries, most recently used last"""
+        now = time.time()
+        with self._lock:
+            return [(k, v) for k, (exp, v) in self._data.items() if exp > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+                self._conn.commit()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "persistent": self._conn is not None,
+        }
+
+
+def all_stats():
+    return {c.namespace: c.stats() for c in _registry}
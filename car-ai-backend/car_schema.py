@@ -0,0 +1,230 @@
+import json
+import re
+import threading
+
+# Schema cho chế độ structured output của Gemini (generationConfig.responseSchema):
+# mọi trường, kể cả động cơ và hiệu năng, về trong một lần gọi nhận diện.
+IDENTIFICATION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "brand": {"type": "STRING", "description": "Manufacturer name"},
+        "model": {"type": "STRING", "description": "Model name without the brand"},
+        "year": {"type": "STRING", "description": "Specific year or year range, e.g. 2013 or 2019-2023"},
+        "price": {"type": "STRING", "description": "Price range in USD"},
+        "performance": {
+            "type": "OBJECT",
+            "properties": {
+                "power": {"type": "STRING", "description": "Power with unit, e.g. 750 hp"},
+                "acceleration": {"type": "STRING", "description": "0-60 mph time with unit, e.g. 2.8 seconds"},
+                "top_speed": {"type": "STRING", "description": "Top speed with unit, e.g. 355 km/h"},
+            },
+            "required": ["power", "acceleration", "top_speed"],
+        },
+        "overview": {"type": "STRING", "description": "2-3 sentences about the car's overall characteristics"},
+        "engine": {
+            "type": "OBJECT",
+            "properties": {
+                "configuration": {"type": "STRING", "description": "Engine type and layout"},
+                "displacement": {"type": "STRING", "description": "Displacement in liters"},
+                "aspiration": {"type": "STRING", "description": "Turbo/supercharging, or naturally aspirated"},
+                "transmission": {"type": "STRING", "description": "Transmission type and speeds"},
+            },
+            "required": ["configuration", "displacement", "aspiration", "transmission"],
+        },
+        "interior": {
+            "type": "OBJECT",
+            "properties": {
+                "seating": {"type": "STRING", "description": "Material and configuration"},
+                "dashboard": {"type": "STRING", "description": "Key dashboard features"},
+                "technology": {"type": "STRING", "description": "Main tech features"},
+                "key_features": {"type": "ARRAY", "items": {"type": "STRING"}, "description": "3-4 standout features"},
+            },
+            "required": ["seating", "dashboard", "technology", "key_features"],
+        },
+    },
+    "required": ["brand", "model", "year", "price", "performance", "overview", "engine", "interior"],
+}
+
+# Nhãn của các dòng gạch đầu dòng, theo ngôn ngữ của câu trả lời
+ENGINE_LABELS = {
+    "en": (
+        ("configuration", "Configuration"), ("displacement", "Displacement"),
+        ("aspiration", "Turbo/Supercharging"), ("transmission", "Transmission"),
+    ),
+    "vi": (
+        ("configuration", "Cấu hình"), ("displacement", "Dung tích"),
+        ("aspiration", "Tăng áp/Siêu nạp"), ("transmission", "Hộp số"),
+    ),
+}
+INTERIOR_LABELS = {
+    "en": (("seating", "Seating"), ("dashboard", "Dashboard"), ("technology", "Technology")),
+    "vi": (("seating", "Ghế ngồi"), ("dashboard", "Bảng điều khiển"), ("technology", "Công nghệ")),
+}
+
+# Giá trị thay thế khi thiếu, giống extract_fields để plan_enrichment nhận ra
+PLACEHOLDERS = {
+    "year": "N/A",
+    "price": "N/A",
+    "power": "N/A",
+    "acceleration": "N/A",
+    "top_speed": "N/A",
+    "engine_detail": "No engine details available.",
+    "interior": "No interior details available.",
+    "description": "No detailed description available.",
+}
+
+# Mô hình hay trả về các chuỗi này thay vì để trống
+UNKNOWN_VALUE = re.compile(
+    r"^(?:n/?a|unknown|not (?:available|applicable|specified)|none|null|-+|\?+"
+    r"|không rõ|chưa rõ|không có(?: thông tin)?|không xác định)\.?$",
+    re.I,
+)
+YEAR_VALUE = re.compile(r"\b(?:18|19|20)\d{2}\b")
+NUMBER_VALUE = re.compile(r"\d")
+CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# Kiểm tra từng trường được dựng sẵn một lần: (tên trường, đường dẫn trong JSON, điều kiện hợp lệ)
+VALIDATORS = (
+    ("year", ("year",), YEAR_VALUE.search),
+    ("price", ("price",), NUMBER_VALUE.search),
+    ("power", ("performance", "power"), NUMBER_VALUE.search),
+    ("acceleration", ("performance", "acceleration"), NUMBER_VALUE.search),
+    ("top_speed", ("performance", "top_speed"), NUMBER_VALUE.search),
+    ("description", ("overview",), bool),
+)
+
+
+def _text(value):
+    """A schema string with whitespace collapsed; '' for missing, non-string or 'unknown' values"""
+    if not isinstance(value, str):
+        return ""
+    value = " ".join(value.split())
+    return "" if UNKNOWN_VALUE.match(value) else value
+
+
+def _lookup(data, path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def _bullets(section, labels):
+    if not isinstance(section, dict):
+        return []
+    lines = []
+    for key, label in labels:
+        value = _text(section.get(key))
+        if value:
+            lines.append(f"• {label}: {value}")
+    return lines
+
+
+class CarIdentification:
+    """A validated identification result; gaps lists the fields research still has to fill"""
+
+    __slots__ = (
+        "brand", "model", "year", "price", "power", "acceleration", "top_speed",
+        "description", "engine_detail", "interior", "gaps",
+    )
+
+    def __init__(self, brand, model, year, price, power, acceleration, top_speed,
+                 description, engine_detail, interior, gaps):
+        self.brand = brand
+        self.model = model
+        self.year = year
+        self.price = price
+        self.power = power
+        self.acceleration = acceleration
+        self.top_speed = top_speed
+        self.description = description
+        self.engine_detail = engine_detail
+        self.interior = interior
+        self.gaps = gaps
+
+    @property
+    def car_name(self):
+        return f"{self.brand} {self.model}".strip() or "Unknown Car"
+
+    def to_fields(self):
+        """The fields dict extract_fields produces, with placeholders in the gaps"""
+        fields = {"car_name": self.car_name}
+        for name, placeholder in PLACEHOLDERS.items():
+            fields[name] = getattr(self, name) or placeholder
+        return fields
+
+
+def parse_identification(text, lang="en"):
+    """Validate the JSON answer of a structured identification call; None if it is not JSON
+
+    lang is the language the answer was requested in; it picks the bullet labels.
+    """
+    try:
+        data = json.loads(CODE_FENCE.sub("", text.strip()))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    values = {}
+    gaps = []
+    for name, path, valid in VALIDATORS:
+        value = _text(_lookup(data, path))
+        if not valid(value):
+            value = ""
+            gaps.append(name)
+        values[name] = value
+
+    brand = _text(data.get("brand"))
+    model = _text(data.get("model"))
+    # Mô hình đôi khi lặp lại hãng trong tên mẫu xe
+    if brand and model.lower().startswith(brand.lower() + " "):
+        model = model[len(brand) + 1:]
+    if not brand and not model:
+        gaps.insert(0, "car_name")
+
+    # Chỉ cần cấu hình động cơ là đủ, các dòng còn lại là thông tin thêm
+    engine = data.get("engine")
+    engine_lines = _bullets(engine, ENGINE_LABELS[lang]) if isinstance(engine, dict) and _text(engine.get("configuration")) else []
+    if not engine_lines:
+        gaps.append("engine_detail")
+
+    interior = data.get("interior")
+    interior_lines = _bullets(interior, INTERIOR_LABELS[lang])
+    features = interior.get("key_features") if isinstance(interior, dict) else None
+    if isinstance(features, list):
+        interior_lines.extend(f"• {feature}" for feature in map(_text, features) if feature)
+    if not interior_lines:
+        gaps.append("interior")
+
+    result = CarIdentification(
+        brand=brand, model=model, engine_detail="\n".join(engine_lines), interior="\n".join(interior_lines),
+        gaps=tuple(gaps), **values,
+    )
+    _count(result)
+    return result
+
+
+_stats_lock = threading.Lock()
+_stats = {"parsed": 0, "complete": 0, "fallback": 0, "gaps": {}}
+
+
+def _count(result):
+    with _stats_lock:
+        _stats["parsed"] += 1
+        if not result.gaps:
+            _stats["complete"] += 1
+        for name in result.gaps:
+            _stats["gaps"][name] = _stats["gaps"].get(name, 0) + 1
+
+
+def count_fallback():
+    """The structured call answered with something that is not JSON; free-text parsing was used"""
+    with _stats_lock:
+        _stats["fallback"] += 1
+
+
+def stats():
+    with _stats_lock:
+        return {**_stats, "gaps": dict(_stats["gaps"])}
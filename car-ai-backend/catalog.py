@@ -0,0 +1,293 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import unicodedata
+from datetime import datetime
+
+import records
+from car_schema import ENGINE_LABELS
+
+logger = logging.getLogger(__name__)
+
+# Danh mục xe đi kèm mã nguồn (hãng -> mẫu -> thế hệ -> thông số), không phụ thuộc thư mục chạy
+CATALOG_FILE = os.getenv("CATALOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+# Điểm Dice trigram tối thiểu để coi tên mẫu xe gần đúng là khớp
+CATALOG_MATCH_THRESHOLD = float(os.getenv("CATALOG_MATCH_THRESHOLD", "0.75"))
+# Ảnh logo: <BRAND_LOGO_BASE_URL>/<logo>.png, cùng dạng URL app Flutter đã dùng; để trống thì logo_url là ""
+BRAND_LOGO_BASE_URL = os.getenv("BRAND_LOGO_BASE_URL", "https://example.com").rstrip("/")
+
+YEAR = re.compile(r"\b(?:18|19|20)\d{2}\b")
+
+LAYOUTS = {
+    "I": {"en": "Inline-{cylinders}", "vi": "{cylinders} xi-lanh thẳng hàng"},
+    "H": {"en": "Flat-{cylinders}", "vi": "{cylinders} xi-lanh nằm ngang"},
+}
+ASPIRATIONS = {
+    "na": {"en": "Naturally aspirated", "vi": "Hút khí tự nhiên"},
+    "turbo": {"en": "Turbocharged", "vi": "Tăng áp"},
+    "twin-turbo": {"en": "Twin-turbocharged", "vi": "Tăng áp kép"},
+    "quad-turbo": {"en": "Quad-turbocharged", "vi": "Bốn bộ tăng áp"},
+    "supercharged": {"en": "Supercharged", "vi": "Siêu nạp"},
+}
+TRANSMISSIONS = {
+    "automatic": {"en": "{speeds}-speed automatic", "vi": "Tự động {speeds} cấp"},
+    "manual": {"en": "{speeds}-speed manual", "vi": "Số sàn {speeds} cấp"},
+    "dct": {"en": "{speeds}-speed dual-clutch", "vi": "Ly hợp kép {speeds} cấp"},
+    "isr": {"en": "{speeds}-speed ISR automated manual", "vi": "Số tự động hóa ISR {speeds} cấp"},
+    "cvt": {"en": "CVT", "vi": "Vô cấp CVT"},
+    "single-speed": {"en": "Single-speed", "vi": "Một cấp"},
+}
+MOTORS = {"en": ("electric motor", "electric motors"), "vi": ("mô-tơ điện", "mô-tơ điện")}
+DISPLACEMENT = {"en": "{liters}L", "vi": "{liters} lít"}
+
+
+def normalize(name):
+    """Fold case, accents and punctuation: "Huracán LP-610" -> "huracan lp 610" """
+    name = unicodedata.normalize("NFKD", name or "").lower()
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^\w\s]", " ", name).split())
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Generation:
+    __slots__ = ("name", "start", "end", "price", "power", "acceleration", "top_speed", "engine")
+
+    def __init__(self, data):
+        self.name = data["name"]
+        self.start, self.end = data["years"]
+        self.price = tuple(data["price"])
+        self.power = data["power"]
+        self.acceleration = data["acceleration"]
+        self.top_speed = data["top_speed"]
+        self.engine = data["engine"]
+
+    def covers(self, year):
+        return self.start <= year <= (self.end or datetime.now().year)
+
+
+class Model:
+    __slots__ = ("name", "aliases", "generations")
+
+    def __init__(self, data):
+        self.name = data["name"]
+        self.aliases = tuple(data.get("aliases", ()))
+        self.generations = tuple(sorted((Generation(g) for g in data["generations"]), key=lambda g: g.start))
+
+    def generation(self, years):
+        """The generation built in one of the identified years; the newest one when no year is known"""
+        if not years:
+            return self.generations[-1]
+        for generation in reversed(self.generations):
+            if any(generation.covers(year) for year in years):
+                return generation
+        return None
+
+
+class Brand:
+    __slots__ = ("name", "aliases", "logo", "models")
+
+    def __init__(self, data):
+        self.name = data["name"]
+        self.aliases = tuple(data.get("aliases", ()))
+        self.logo = data.get("logo") or normalize(self.name).replace(" ", "-")
+        self.models = tuple(Model(model) for model in data["models"])
+
+    @property
+    def logo_url(self):
+        return f"{BRAND_LOGO_BASE_URL}/{self.logo}.png" if BRAND_LOGO_BASE_URL and self.logo else ""
+
+
+def _keys(names):
+    """Lookup keys of a name and its aliases, also without spaces ("cr v" -> "crv")"""
+    keys = []
+    for name in names:
+        key = normalize(name)
+        for variant in (key, key.replace(" ", "")):
+            if variant and variant not in keys:
+                keys.append(variant)
+    return keys
+
+
+class Match:
+    """A catalog entry an identified car name resolved to; kind is exact, prefix or fuzzy"""
+
+    __slots__ = ("brand", "model", "generation", "kind", "score")
+
+    def __init__(self, brand, model, generation, kind, score):
+        self.brand = brand
+        self.model = model
+        self.generation = generation
+        self.kind = kind
+        self.score = score
+
+    @property
+    def car_name(self):
+        return f"{self.brand.name} {self.model.name}"
+
+    def engine_detail(self, lang):
+        engine = self.generation.engine
+        configuration = engine.get("layout") or ""
+        if configuration[:1] in LAYOUTS and configuration[1:].isdigit():
+            configuration = LAYOUTS[configuration[0]][lang].format(cylinders=configuration[1:])
+        if engine.get("fuel"):
+            configuration = f"{configuration} {engine['fuel']}"
+        motors = engine.get("motors")
+        if motors:
+            motor_text = f"{motors} {MOTORS[lang][motors > 1]}"
+            configuration = f"{configuration} + {motor_text}" if configuration else motor_text
+        kind, speeds = engine["transmission"]
+        values = {
+            "configuration": configuration,
+            "displacement": DISPLACEMENT[lang].format(liters=engine["displacement"]) if engine.get("displacement") else "",
+            "aspiration": ASPIRATIONS[engine["aspiration"]][lang] if engine.get("aspiration") else "",
+            "transmission": TRANSMISSIONS[kind][lang].format(speeds=speeds),
+        }
+        return "\n".join(f"• {label}: {values[key]}" for key, label in ENGINE_LABELS[lang] if values[key])
+
+    def fields(self, lang):
+        """Spec fields in the format of the identification answer, in lang"""
+        generation = self.generation
+        end = generation.end or datetime.now().year
+        specs = {
+            "year": {"value": generation.start, "unit": "year"},
+            "price": {"value": generation.price[0], "unit": "USD"},
+            "power": {"value": generation.power, "unit": "hp"},
+            "acceleration": {"value": generation.acceleration, "unit": "s"},
+            "top_speed": {"value": generation.top_speed, "unit": "km/h"},
+        }
+        if end != generation.start:
+            specs["year"]["max"] = end
+        if generation.price[1] != generation.price[0]:
+            specs["price"]["max"] = generation.price[1]
+        fields = {name: records.render_spec(spec, lang) for name, spec in specs.items()}
+        fields["engine_detail"] = self.engine_detail(lang)
+        return fields
+
+
+class VehicleCatalog:
+    """Read-only brand -> model -> generation index with exact, prefix and trigram lookup of car names"""
+
+    def __init__(self, path=CATALOG_FILE, threshold=CATALOG_MATCH_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.version = None
+        self.etag = None
+        self.brands = ()
+        self._brand_trie = {}
+        self._models = {}       # brand name -> {key: model}
+        self._trigrams = {}     # brand name -> {trigram: [(key, model)]}
+        self._model_keys = {}   # key -> [(brand, model)] trên mọi hãng, cho tên không có hãng
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "exact": 0, "prefix": 0, "fuzzy": 0, "misses": 0}
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            self._index(json.loads(raw))
+            self.etag = f"{self.version}-{hashlib.sha256(raw).hexdigest()[:12]}"
+            logger.info(f"Loaded vehicle catalog {self.version}: {len(self.brands)} brands from {path}")
+        except Exception as e:
+            # Không có danh mục thì mọi xe đều đi qua bước tra cứu Gemini như trước
+            logger.error(f"Error loading vehicle catalog {path}: {str(e)}")
+
+    def _index(self, data):
+        self.version = data["version"]
+        self.brands = tuple(sorted((Brand(brand) for brand in data["brands"]), key=lambda b: b.name.lower()))
+        for brand in self.brands:
+            for key in _keys((brand.name, *brand.aliases)):
+                node = self._brand_trie
+                for token in key.split():
+                    node = node.setdefault(token, {})
+                node[""] = brand
+            models = self._models[brand.name] = {}
+            index = self._trigrams[brand.name] = {}
+            for model in brand.models:
+                for key in _keys((model.name, *model.aliases)):
+                    models.setdefault(key, model)
+                    self._model_keys.setdefault(key, []).append((brand, model))
+                    for trigram in trigrams(key):
+                        index.setdefault(trigram, []).append((key, model))
+
+    def _brand(self, tokens):
+        """(brand, number of tokens its name used) for the longest brand name at the start of tokens"""
+        node, found = self._brand_trie, (None, 0)
+        for i, token in enumerate(tokens):
+            node = node.get(token)
+            if node is None:
+                break
+            if "" in node:
+                found = (node[""], i + 1)
+        return found
+
+    def _model(self, brand, tokens):
+        """(model, kind, score) of the best model of brand for the tokens after the brand name"""
+        models = self._models[brand.name]
+        query = " ".join(tokens)
+        for candidate in (query, query.replace(" ", "")):
+            if candidate in models:
+                return models[candidate], "exact", 1.0
+        # "veneno roadster 2014", "911 carrera 4s": mẫu dài nhất là tiền tố của tên
+        for length in range(len(tokens) - 1, 0, -1):
+            prefix = " ".join(tokens[:length])
+            if prefix in models:
+                return models[prefix], "prefix", length / len(tokens)
+        # Sai chính tả / viết khác: Dice trên trigram, đếm qua chỉ mục ngược của hãng
+        query_trigrams = trigrams(query)
+        shared = {}
+        for trigram in query_trigrams:
+            for key, model in self._trigrams[brand.name].get(trigram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        best = None
+        for key, count in shared.items():
+            score = 2 * count / (len(query_trigrams) + len(trigrams(key)))
+            if score >= self.threshold and (best is None or score > best[2]):
+                best = (self._models[brand.name][key], "fuzzy", score)
+        return best or (None, None, 0.0)
+
+    def lookup(self, car_name, year=None):
+        """The catalog generation of an identified car, or None; year is the identified year text"""
+        tokens = [token for token in normalize(car_name).split() if not YEAR.fullmatch(token)]
+        years = [int(value) for value in YEAR.findall(str(year or ""))]
+        brand, used = self._brand(tokens)
+        model = kind = None
+        score = 0.0
+        if brand is not None and tokens[used:]:
+            model, kind, score = self._model(brand, tokens[used:])
+        elif brand is None and tokens:
+            # Tên không có hãng ("Veneno Roadster"): chỉ nhận khi khớp đúng một mẫu
+            for length in range(len(tokens), 0, -1):
+                candidates = self._model_keys.get(" ".join(tokens[:length]), ())
+                if len(candidates) == 1:
+                    brand, model = candidates[0]
+                    kind, score = ("exact", 1.0) if length == len(tokens) else ("prefix", length / len(tokens))
+                    break
+        generation = model.generation(years) if model is not None else None
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._stats[kind if generation is not None else "misses"] += 1
+        if generation is None:
+            return None
+        return Match(brand, model, generation, kind, round(score, 2))
+
+    def brand_list(self):
+        return [
+            {"name": brand.name, "logo_url": brand.logo_url, "models": [model.name for model in brand.models]}
+            for brand in self.brands
+        ]
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._stats)
+        return {
+            "version": self.version,
+            "brands": len(self.brands),
+            "models": sum(len(brand.models) for brand in self.brands),
+            "generations": sum(len(model.generations) for brand in self.brands for model in brand.models),
+            **counts,
+        }
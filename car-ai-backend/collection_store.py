@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# FULL (mặc định): fsync mỗi lần commit (mỗi batch ghi), NORMAL: chỉ fsync khi checkpoint WAL, mất điện có thể mất batch đã ghi
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "FULL").upper()
+
+COLLECTION_DB_FILE = os.getenv("COLLECTION_DB_FILE", "collections.db")
+
+
+class CollectionError(Exception):
+    """Invalid collection operation, e.g. a duplicate name"""
+
+
+class CollectionNotFoundError(CollectionError):
+    """The named collection does not exist"""
+
+
+def item_key(car_data):
+    # Một xe chỉ xuất hiện một lần trong mỗi collection
+    return f"{car_data.get('brand') or ''}|{car_data.get('car_name') or ''}"
+
+
+class CollectionStore:
+    """Named car collections in SQLite; UNIQUE (collection_id, item_key) keeps one copy of each car"""
+
+    def __init__(self, db_path=COLLECTION_DB_FILE, legacy_file=None):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        if SQLITE_SYNCHRONOUS in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            self._conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS collections (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                created_at TEXT
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS collection_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                collection_id INTEGER NOT NULL,
+                item_key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                added_at TEXT,
+                UNIQUE (collection_id, item_key)
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_collection_items_page ON collection_items (collection_id, id)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_file:
+            self._migrate(legacy_file)
+        count = self._conn.execute("SELECT COUNT(*) FROM collections").fetchone()[0]
+        logger.info(f"Loaded {count} collections")
+
+    def _migrate(self, legacy_file):
+        """One-time import of the old collections.json ({name: [items, newest first]})"""
+        if not os.path.exists(legacy_file):
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone():
+                    self._conn.execute("COMMIT")
+                    return
+                with open(legacy_file, "r", encoding="utf-8") as f:
+                    collections = json.load(f)
+                for name, items in collections.items():
+                    collection_id = self._conn.execute(
+                        "INSERT INTO collections (name, created_at) VALUES (?, ?)",
+                        (name, datetime.now().isoformat()),
+                    ).lastrowid
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO collection_items (collection_id, item_key, data, added_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        [
+                            (collection_id, item_key(item), json.dumps(item, ensure_ascii=False), item.get("timestamp"))
+                            for item in reversed(items)
+                        ],
+                    )
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (legacy_file,))
+                self._conn.execute("COMMIT")
+                logger.info(f"Migrated {len(collections)} collections from {legacy_file}")
+            except Exception as e:
+                self._conn.execute("ROLLBACK")
+                logger.error(f"Error migrating collections from {legacy_file}: {str(e)}")
+
+    def _collection_id(self, name, create=False):
+        """Id of the named collection, read from the database so renames and deletes by other workers are seen"""
+        row = self._conn.execute("SELECT id FROM collections WHERE name = ?", (name,)).fetchone()
+        if row is None and create:
+            return self._conn.execute(
+                "INSERT INTO collections (name, created_at) VALUES (?, ?)",
+                (name, datetime.now().isoformat()),
+            ).lastrowid
+        if row is None:
+            raise CollectionNotFoundError(f"Collection '{name}' not found")
+        return row[0]
+
+    def _transaction(self, write):
+        """Run write(conn) inside BEGIN IMMEDIATE ... COMMIT and return its result"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = write(self._conn)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return result
+
+    def names(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT c.name, COUNT(i.id) FROM collections c "
+                "LEFT JOIN collection_items i ON i.collection_id = c.id GROUP BY c.id ORDER BY c.id"
+            ).fetchall()
+        return [{"name": name, "count": count} for name, count in rows]
+
+    def create(self, name):
+        def write(conn):
+            try:
+                conn.execute("INSERT INTO collections (name, created_at) VALUES (?, ?)", (name, datetime.now().isoformat()))
+            except sqlite3.IntegrityError:
+                raise CollectionError(f"Collection '{name}' already exists")
+
+        self._transaction(write)
+
+    def rename(self, name, new_name):
+        def write(conn):
+            collection_id = self._collection_id(name)
+            try:
+                conn.execute("UPDATE collections SET name = ? WHERE id = ?", (new_name, collection_id))
+            except sqlite3.IntegrityError:
+                raise CollectionError(f"Collection '{new_name}' already exists")
+
+        self._transaction(write)
+
+    def delete(self, name):
+        def write(conn):
+            collection_id = self._collection_id(name)
+            conn.execute("DELETE FROM collection_items WHERE collection_id = ?", (collection_id,))
+            conn.execute("DELETE FROM collections WHERE id = ?", (collection_id,))
+
+        self._transaction(write)
+
+    def add(self, name, car_data):
+        """Add a car to an existing collection unless it is already there; returns True if added"""
+        return self.add_many(name, [car_data], create=False) == 1
+
+    def add_many(self, name, items, create=True):
+        """Add cars in one transaction, skipping duplicates; returns the number added"""
+        def write(conn):
+            collection_id = self._collection_id(name, create=create)
+            now = datetime.now().isoformat()
+            added = 0
+            for car_data in items:
+                # Trùng lặp do ràng buộc UNIQUE quyết định, không dựa vào bộ nhớ của worker
+                added += conn.execute(
+                    "INSERT OR IGNORE INTO collection_items (collection_id, item_key, data, added_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (collection_id, item_key(car_data), json.dumps(car_data, ensure_ascii=False), now),
+                ).rowcount
+            return added
+
+        return self._transaction(write)
+
+    def remove(self, name, brand, car_name):
+        """Remove a car from a collection; returns True if it was there"""
+        def write(conn):
+            collection_id = self._collection_id(name)
+            return conn.execute(
+                "DELETE FROM collection_items WHERE collection_id = ? AND item_key = ?",
+                (collection_id, item_key({"brand": brand, "car_name": car_name})),
+            ).rowcount > 0
+
+        return self._transaction(write)
+
+    def page(self, name, limit=None, cursor=None):
+        """Items newest first, plus the cursor of the next page (or None)"""
+        with self._lock:
+            try:
+                collection_id = self._collection_id(name)
+            except CollectionNotFoundError:
+                return [], None
+            params = [collection_id]
+            where = "collection_id = ?"
+            if cursor is not None:
+                where += " AND id < ?"
+                params.append(cursor)
+            rows = self._conn.execute(
+                f"SELECT id, data FROM collection_items WHERE {where} ORDER BY id DESC LIMIT ?",
+                params + [limit + 1 if limit is not None else -1],
+            ).fetchall()
+        if limit is None or len(rows) <= limit:
+            return [json.loads(row[1]) for row in rows], None
+        return [json.loads(row[1]) for row in rows[:limit]], rows[limit - 1][0]
@@ -0,0 +1,407 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import breaker
+import metrics
+import ratelimit
+from breaker import CircuitOpenError
+from ratelimit import PRIORITY_PRIMARY, PRIORITY_ENRICHMENT, PRIORITY_TRANSLATION, QueueTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Đổi sang địa chỉ server giả lập khi chạy thử/benchmark offline
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+
+# Mỗi thread của gunicorn và của enrichment pool có thể giữ một kết nối
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "0")) or (
+    int(os.getenv("GUNICORN_THREADS", "1")) + int(os.getenv("ENRICHMENT_WORKERS", "8"))
+)
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_FACTOR = float(os.getenv("GEMINI_BACKOFF_FACTOR", "0.5"))
+# Trần cho Retry-After của 429/503
+GEMINI_MAX_RETRY_AFTER = float(os.getenv("GEMINI_MAX_RETRY_AFTER", "10"))
+# Gửi request thứ hai khi request nhận diện chưa trả lời sau percentile độ trễ này. 0 = tắt
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0"))
+# Số mẫu độ trễ gần nhất dùng để tính percentile, và số mẫu tối thiểu trước khi hedge
+GEMINI_HEDGE_WINDOW = int(os.getenv("GEMINI_HEDGE_WINDOW", "200"))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+
+_session = None
+_session_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_request_count = 0
+_retry_count = 0
+_async_client = None
+_async_request_count = 0
+_async_retry_count = 0
+_hedge_executor = None
+_hedge_latencies = {}
+_hedge_stats = {"calls": 0, "hedged": 0, "primary_wins": 0, "hedge_wins": 0}
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def _create_session():
+    # Chỉ retry lỗi kết nối ở đây; 429/5xx được retry qua rate limiter để AIMD thấy tín hiệu
+    retry_strategy = Retry(
+        total=GEMINI_MAX_RETRIES,
+        connect=GEMINI_MAX_RETRIES,
+        # Request đã gửi đi (read timeout, lỗi giữa chừng) có thể đã được tính phí: không gửi lại,
+        # để Timeout tới caller (504) và breaker/limiter thấy đúng một lần lỗi
+        read=False,
+        status=0,
+        other=False,
+        backoff_factor=GEMINI_BACKOFF_FACTOR,
+        # Chỉ lỗi kết nối được retry, khi request chưa tới Gemini
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=GEMINI_POOL_SIZE,
+        max_retries=retry_strategy,
+    )
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    logger.info(f"Created Gemini HTTP session for {GEMINI_BASE_URL} with pool size {GEMINI_POOL_SIZE}")
+    return session
+
+
+def get_session():
+    """Process-wide pooled session shared by all threads"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def model_url(model, api_version="v1"):
+    return f"{GEMINI_BASE_URL}/{api_version}/models/{model}:generateContent"
+
+
+def endpoint_name(model, api_version="v1"):
+    return f"{api_version}/{model}"
+
+
+def _record(limiter, circuit, status, started):
+    metrics.count_gemini_call(limiter.name, status)
+    limiter.record(status, time.monotonic() - started)
+    circuit.record(not breaker.is_failure(status))
+
+
+def retry_delay(response, attempt):
+    """Backoff before the next attempt, honouring a numeric Retry-After"""
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+        return min(float(retry_after), GEMINI_MAX_RETRY_AFTER)
+    return GEMINI_BACKOFF_FACTOR * (2 ** attempt)
+
+
+def post_generate_content(model, payload, api_version="v1", timeout=20, priority=PRIORITY_ENRICHMENT):
+    """POST a generateContent request and return the raw response
+
+    payload is a dict, or the already serialized JSON bytes for large requests.
+    Every attempt waits for a slot of the model's limiter; 429/5xx are retried
+    with backoff outside the slot.
+    """
+    global _request_count, _retry_count
+    limiter = ratelimit.limiter_for(model)
+    circuit = breaker.breaker_for(endpoint_name(model, api_version))
+    body = {"data": payload} if isinstance(payload, bytes) else {"json": payload}
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        with limiter.slot(priority):
+            # Mạch mở: từ chối ngay, kể cả giữa các lần retry
+            circuit.allow()
+            with _stats_lock:
+                _request_count += 1
+            started = time.monotonic()
+            try:
+                response = get_session().post(
+                    model_url(model, api_version),
+                    params={"key": os.getenv("GEMINI_API_KEY")},
+                    timeout=timeout,
+                    **body,
+                )
+            except requests.exceptions.RequestException:
+                _record(limiter, circuit, None, started)
+                raise
+            except BaseException:
+                circuit.abandon()
+                raise
+            _record(limiter, circuit, response.status_code, started)
+        if response.status_code not in RETRY_STATUSES or attempt == GEMINI_MAX_RETRIES:
+            return response
+        with _stats_lock:
+            _retry_count += 1
+        time.sleep(retry_delay(response, attempt))
+
+
+def generate_text(model, prompt, api_version="v1", timeout=20, priority=PRIORITY_ENRICHMENT):
+    """Send a text-only prompt and return the first candidate's text"""
+    payload = {
+        "contents": [{
+            "parts": [{"text": prompt}]
+        }]
+    }
+    response = post_generate_content(model, payload, api_version=api_version, timeout=timeout, priority=priority)
+    response.raise_for_status()
+    result = response.json()
+    return result["candidates"][0]["content"]["parts"][0]["text"]
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _session_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=GEMINI_POOL_SIZE, thread_name_prefix="gemini-hedge")
+    return _hedge_executor
+
+
+def _record_latency(model, seconds):
+    with _stats_lock:
+        samples = _hedge_latencies.get(model)
+        if samples is None:
+            samples = _hedge_latencies[model] = deque(maxlen=GEMINI_HEDGE_WINDOW)
+        samples.append(seconds)
+
+
+def _count_hedge(outcome):
+    with _stats_lock:
+        _hedge_stats[outcome] += 1
+
+
+def hedge_delay(model, api_version="v1"):
+    """Seconds to wait before hedging; None when hedging is off, not warmed up or the circuit is not closed"""
+    if GEMINI_HEDGE_PERCENTILE <= 0 or not breaker.breaker_for(endpoint_name(model, api_version)).closed:
+        return None
+    with _stats_lock:
+        samples = sorted(_hedge_latencies.get(model, ()))
+    if len(samples) < GEMINI_HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * GEMINI_HEDGE_PERCENTILE / 100))]
+
+
+def _timed_post(model, payload, api_version, timeout, priority):
+    started = time.monotonic()
+    response = post_generate_content(model, payload, api_version=api_version, timeout=timeout, priority=priority)
+    if response.status_code == 200:
+        _record_latency(model, time.monotonic() - started)
+    return response
+
+
+def hedged_post_generate_content(model, payload, api_version="v1", timeout=20, priority=PRIORITY_PRIMARY):
+    """post_generate_content, plus an identical second request if the first is slower than the hedge percentile
+
+    The first 200 response wins. A thread cannot be interrupted, so the slower
+    request finishes in the background and its response is dropped.
+    """
+    _count_hedge("calls")
+    args = (model, payload, api_version, timeout, priority)
+    delay = hedge_delay(model, api_version)
+    if delay is None:
+        return _timed_post(*args)
+
+    executor = _get_hedge_executor()
+    primary = executor.submit(metrics.bind(_timed_post), *args)
+    try:
+        # Thường request đầu trả lời trước ngưỡng và không tốn thêm request nào
+        return primary.result(timeout=delay)
+    except FuturesTimeoutError:
+        pass
+    _count_hedge("hedged")
+    outcomes = {primary: "primary_wins", executor.submit(metrics.bind(_timed_post), *args): "hedge_wins"}
+
+    pending = set(outcomes)
+    last = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result().status_code == 200:
+                _count_hedge(outcomes[future])
+                return future.result()
+            last = future
+    return last.result()
+
+
+def get_async_client():
+    """Process-wide httpx client for the ASGI app, created on its event loop"""
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            headers={"Content-Type": "application/json"},
+            limits=httpx.Limits(
+                max_connections=GEMINI_POOL_SIZE,
+                max_keepalive_connections=GEMINI_POOL_SIZE,
+            ),
+        )
+        logger.info(f"Created async Gemini client for {GEMINI_BASE_URL} with pool size {GEMINI_POOL_SIZE}")
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _httpx_timeout(timeout):
+    # Cùng quy ước với requests: một số hoặc (connect, read)
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+
+async def async_post_generate_content(model, payload, api_version="v1", timeout=20, priority=PRIORITY_ENRICHMENT):
+    """Async twin of post_generate_content with the same limiter and retry/backoff policy"""
+    global _async_request_count, _async_retry_count
+    _async_request_count += 1
+    client = get_async_client()
+    limiter = ratelimit.limiter_for(model)
+    circuit = breaker.breaker_for(endpoint_name(model, api_version))
+    body = {"content": payload} if isinstance(payload, bytes) else {"json": payload}
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        response = None
+        async with limiter.async_slot(priority):
+            circuit.allow()
+            started = time.monotonic()
+            try:
+                response = await client.post(
+                    model_url(model, api_version),
+                    params={"key": os.getenv("GEMINI_API_KEY") or ""},
+                    timeout=_httpx_timeout(timeout),
+                    **body,
+                )
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # Request chưa tới Gemini nên thử lại an toàn, như Retry(connect=...) của session sync
+                _record(limiter, circuit, None, started)
+                if attempt == GEMINI_MAX_RETRIES:
+                    raise
+            except httpx.TransportError:
+                # Read timeout, mất kết nối giữa chừng...: POST có thể đã được tính phí, không gửi lại
+                _record(limiter, circuit, None, started)
+                raise
+            except BaseException:
+                # Bị hủy (ví dụ request hedge thua): không tính là lỗi của endpoint
+                circuit.abandon()
+                raise
+            else:
+                _record(limiter, circuit, response.status_code, started)
+        if response is not None and (response.status_code not in RETRY_STATUSES or attempt == GEMINI_MAX_RETRIES):
+            return response
+        _async_retry_count += 1
+        await asyncio.sleep(retry_delay(response, attempt))
+
+
+async def async_generate_text(model, prompt, api_version="v1", timeout=20, priority=PRIORITY_ENRICHMENT):
+    """Async twin of generate_text"""
+    payload = {
+        "contents": [{
+            "parts": [{"text": prompt}]
+        }]
+    }
+    response = await async_post_generate_content(
+        model, payload, api_version=api_version, timeout=timeout, priority=priority
+    )
+    response.raise_for_status()
+    result = response.json()
+    return result["candidates"][0]["content"]["parts"][0]["text"]
+
+
+async def _async_timed_post(model, payload, api_version, timeout, priority):
+    started = time.monotonic()
+    response = await async_post_generate_content(
+        model, payload, api_version=api_version, timeout=timeout, priority=priority
+    )
+    if response.status_code == 200:
+        _record_latency(model, time.monotonic() - started)
+    return response
+
+
+async def async_hedged_post_generate_content(model, payload, api_version="v1", timeout=20, priority=PRIORITY_PRIMARY):
+    """Async twin of hedged_post_generate_content; the losing request is cancelled"""
+    _count_hedge("calls")
+    args = (model, payload, api_version, timeout, priority)
+    delay = hedge_delay(model, api_version)
+    if delay is None:
+        return await _async_timed_post(*args)
+
+    primary = asyncio.ensure_future(_async_timed_post(*args))
+    outcomes = {primary: "primary_wins"}
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        _count_hedge("hedged")
+        outcomes[asyncio.ensure_future(_async_timed_post(*args))] = "hedge_wins"
+
+        pending = set(outcomes)
+        last = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code == 200:
+                    _count_hedge(outcomes[task])
+                    return task.result()
+                last = task
+        return last.result()
+    finally:
+        for task in outcomes:
+            if not task.done():
+                task.cancel()
+
+
+def hedge_stats():
+    with _stats_lock:
+        stats = dict(_hedge_stats)
+    stats["percentile"] = GEMINI_HEDGE_PERCENTILE
+    stats["delay"] = {model: hedge_delay(model) for model in list(_hedge_latencies)}
+    return stats
+
+
+def connection_stats():
+    """How many HTTP requests were served per opened connection"""
+    connections = 0
+    upstream_requests = 0
+    if _session is not None:
+        # Cùng một adapter được mount cho cả http:// và https://
+        adapters = {id(adapter): adapter for adapter in _session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                upstream_requests += pool.num_requests
+    return {
+        "base_url": GEMINI_BASE_URL,
+        "pool_size": GEMINI_POOL_SIZE,
+        "requests": _request_count,
+        "retries": _retry_count,
+        "upstream_requests": upstream_requests,
+        "connections_opened": connections,
+        "connections_reused": max(upstream_requests - connections, 0),
+        "reuse_ratio": round(1 - connections / upstream_requests, 4) if upstream_requests else 0.0,
+        "async_requests": _async_request_count,
+        "async_retries": _async_retry_count,
+        "limiters": ratelimit.stats(),
+        "breakers": breaker.stats(),
+        "hedging": hedge_stats(),
+    }
@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+import records
+
+logger = logging.getLogger(__name__)
+
+# FULL (mặc định): fsync mỗi lần commit (mỗi batch ghi), NORMAL: chỉ fsync khi checkpoint WAL, mất điện có thể mất batch đã ghi
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "FULL").upper()
+
+HISTORY_DB_FILE = os.getenv("HISTORY_DB_FILE", "history.db")
+HISTORY_RETENTION = int(os.getenv("HISTORY_RETENTION", "5000"))
+# Số lần ghi giữa hai lần dọn dẹp bản ghi cũ
+HISTORY_COMPACT_EVERY = int(os.getenv("HISTORY_COMPACT_EVERY", "100"))
+
+# Các trường màn hình lịch sử của app Flutter hiển thị
+SUMMARY_FIELDS = ("car_name", "brand", "year", "price", "power", "top_speed", "timestamp")
+
+YEAR_PATTERN = re.compile(r"\b(19|20)\d{2}\b")
+
+
+def parse_year(year):
+    """First four-digit year in strings like "2013" or "2018-2020" """
+    match = YEAR_PATTERN.search(str(year or ""))
+    return int(match.group(0)) if match else None
+
+
+class HistoryStore:
+    """Append-only analysis history in SQLite (WAL), newest entries first"""
+
+    def __init__(self, db_path=HISTORY_DB_FILE, retention=HISTORY_RETENTION, legacy_file=None):
+        self.db_path = db_path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._writes_since_compact = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        if SQLITE_SYNCHRONOUS in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            self._conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT,
+                brand TEXT,
+                car_name TEXT,
+                year TEXT,
+                year_num INTEGER,
+                summary TEXT,
+                data TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._upgrade_schema()
+        if legacy_file:
+            self._migrate(legacy_file)
+
+    def _upgrade_schema(self):
+        """Add the filter/projection columns and their indexes to older databases"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(history)")}
+        if "year_num" not in columns:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    columns = {row[1] for row in self._conn.execute("PRAGMA table_info(history)")}
+                    if "year_num" not in columns:
+                        self._conn.execute("ALTER TABLE history ADD COLUMN year_num INTEGER")
+                        self._conn.execute("ALTER TABLE history ADD COLUMN summary TEXT")
+                        rows = self._conn.execute("SELECT id, data FROM history").fetchall()
+                        for row_id, data in rows:
+                            record = json.loads(data)
+                            self._conn.execute(
+                                "UPDATE history SET year_num = ?, summary = ? WHERE id = ?",
+                                (parse_year(record.get("year")), self._summary(record), row_id),
+                            )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_brand ON history (brand COLLATE NOCASE, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_year ON history (year_num, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp)")
+
+    def _migrate(self, legacy_file):
+        """One-time import of the old history.json (a list, newest first)"""
+        if not os.path.exists(legacy_file):
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                done = self._conn.execute(
+                    "SELECT value FROM meta WHERE key = 'migrated_from'"
+                ).fetchone()
+                if done:
+                    self._conn.execute("COMMIT")
+                    return
+                with open(legacy_file, "r", encoding="utf-8") as f:
+                    history = json.load(f)
+                # Chèn bản ghi cũ nhất trước để id tăng dần theo thời gian
+                self._conn.executemany(
+                    self.INSERT_SQL,
+                    [self._row(record) for record in reversed(history)],
+                )
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (legacy_file,)
+                )
+                self._conn.execute("COMMIT")
+                logger.info(f"Migrated {len(history)} history entries from {legacy_file}")
+            except Exception as e:
+                self._conn.execute("ROLLBACK")
+                logger.error(f"Error migrating history from {legacy_file}: {str(e)}")
+
+    INSERT_SQL = (
+        "INSERT INTO history (timestamp, brand, car_name, year, year_num, summary, data) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    )
+
+    @staticmethod
+    def _summary(record):
+        if records.is_record(record):
+            return json.dumps(records.summary(record), ensure_ascii=False)
+        return json.dumps({field: record.get(field) for field in SUMMARY_FIELDS}, ensure_ascii=False)
+
+    @staticmethod
+    def _year(record):
+        # Bản ghi mới giữ năm trong specs; bản ghi cũ là chuỗi hiển thị
+        return records.display_year(record) if records.is_record(record) else record.get("year")
+
+    @classmethod
+    def _row(cls, record):
+        return (
+            record.get("timestamp"),
+            record.get("brand"),
+            record.get("car_name"),
+            cls._year(record),
+            parse_year(cls._year(record)),
+            cls._summary(record),
+            json.dumps(record, ensure_ascii=False),
+        )
+
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Append records atomically in a single transaction"""
+        if not records:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    self.INSERT_SQL,
+                    [self._row(record) for record in records],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._writes_since_compact += len(records)
+            if self._writes_since_compact >= HISTORY_COMPACT_EVERY:
+                self._compact()
+
+    def list(self, limit=None):
+        """Entries newest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM history ORDER BY id DESC LIMIT ?",
+                (limit if limit is not None else -1,),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def page(self, limit=20, cursor=None, brand=None, year=None, since=None, until=None, summary=False):
+        """One page of entries newest first, plus the cursor of the next page (or None)"""
+        clauses = []
+        params = []
+        if cursor is not None:
+            clauses.append("id < ?")
+            params.append(cursor)
+        if brand:
+            clauses.append("brand = ? COLLATE NOCASE")
+            params.append(brand)
+        if year is not None:
+            clauses.append("year_num = ?")
+            params.append(year)
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        column = "summary" if summary else "data"
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, {column} FROM history {where} ORDER BY id DESC LIMIT ?",
+                params + [limit + 1],
+            ).fetchall()
+        items = [json.loads(row[1]) for row in rows[:limit]]
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return items, next_cursor
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        """Drop entries beyond the retention cap and give the space back"""
+        self._writes_since_compact = 0
+        deleted = self._conn.execute(
+            "DELETE FROM history WHERE id <= "
+            "(SELECT id FROM history ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (self.retention,),
+        ).rowcount
+        self._conn.execute("PRAGMA incremental_vacuum")
+        self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if deleted:
+            logger.info(f"Compacted history: removed {deleted} entries beyond retention {self.retention}")
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM history")
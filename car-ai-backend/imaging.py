@@ -0,0 +1,146 @@
+import base64
+import io
+import logging
+import os
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))  # 10MB limit
+# Phần multipart ngoài file ảnh (boundary, header, trường lang)
+MULTIPART_OVERHEAD = 64 * 1024
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD
+# Số pixel tối đa được phép giải mã (chặn decompression bomb: file nhỏ, ảnh khổng lồ)
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50 * 1000 * 1000)))
+# Giới hạn kích thước ảnh JPEG gửi lên Gemini
+MAX_ENCODED_BYTES = 800 * 1024
+JPEG_QUALITY = 85
+JPEG_MIN_QUALITY = 30
+# Ảnh JPEG đã nhỏ hơn ngưỡng này (và không cần resize/xoay) được gửi nguyên bản
+IMAGE_PASSTHROUGH_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_BYTES", str(MAX_ENCODED_BYTES)))
+
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageTooLargeError(ValueError):
+    """The upload is over the byte limit or its header declares too many pixels"""
+
+
+def _file_size(image_file):
+    image_file.seek(0, os.SEEK_END)
+    size = image_file.tell()
+    image_file.seek(0)
+    return size
+
+
+def _can_pass_through(image, original_size, max_size):
+    """A small, upright RGB JPEG that is already within max_size needs no re-encode"""
+    return (
+        image.format == "JPEG"
+        and image.mode == "RGB"
+        and original_size <= IMAGE_PASSTHROUGH_BYTES
+        and max(image.size) <= max_size
+        and image.getexif().get(EXIF_ORIENTATION, 1) == 1
+    )
+
+
+def _replace(image, new_image):
+    """Free the pixel memory of an intermediate image as soon as the next one exists"""
+    image.close()
+    return new_image
+
+
+def _save_jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer
+
+
+def _compress(image):
+    """Encode at JPEG_QUALITY, or binary-search the highest quality that fits MAX_ENCODED_BYTES"""
+    buffer = _save_jpeg(image, JPEG_QUALITY)
+    if buffer.tell() <= MAX_ENCODED_BYTES:
+        logger.info(f"Compressed size with quality {JPEG_QUALITY}: {buffer.tell() / 1024:.2f}KB")
+        return buffer
+    buffer.close()
+
+    best = None
+    low, high = JPEG_MIN_QUALITY, JPEG_QUALITY - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _save_jpeg(image, quality)
+        if candidate.tell() <= MAX_ENCODED_BYTES:
+            if best is not None:
+                best.close()
+            best, low = candidate, quality + 1
+        else:
+            candidate.close()
+            high = quality - 1
+    if best is None:
+        best = _save_jpeg(image, JPEG_MIN_QUALITY)
+    logger.info(f"Compressed size after quality search: {best.tell() / 1024:.2f}KB")
+    return best
+
+
+# Resize ảnh và mã hóa base64
+def encode_image(image_file, max_size=512):
+    try:
+        # Đọc và kiểm tra kích thước file
+        original_size = _file_size(image_file)
+        logger.info(f"Original file size: {original_size / 1024:.2f}KB")
+
+        if original_size > MAX_UPLOAD_BYTES:
+            raise ImageTooLargeError(f"File size exceeds {MAX_UPLOAD_BYTES // (1024 * 1024)}MB limit")
+
+        # Chỉ đọc header, chưa giải mã ảnh
+        try:
+            image = Image.open(image_file)
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(str(e))
+        logger.info(f"Original image size: {image.size}, mode: {image.mode}, format: {image.format}")
+
+        width, height = image.size
+        if width * height > IMAGE_MAX_PIXELS:
+            raise ImageTooLargeError(f"Image is {width}x{height}, over the {IMAGE_MAX_PIXELS} pixel limit")
+
+        if _can_pass_through(image, original_size, max_size):
+            image_file.seek(0)
+            base64_data = base64.b64encode(image_file.read()).decode("ascii")
+            image.close()
+            logger.info(f"Small JPEG sent as is, base64 size: {len(base64_data) / 1024:.2f}KB")
+            return base64_data
+
+        if image.format == "JPEG" and max(image.size) > max_size:
+            # Giải mã JPEG ở tỉ lệ 1/2, 1/4, 1/8 nhưng vẫn không nhỏ hơn kích thước đích
+            ratio = max_size / max(image.size)
+            image.draft("RGB", (int(image.size[0] * ratio), int(image.size[1] * ratio)))
+            logger.info(f"JPEG draft decode at {image.size}")
+
+        # Xoay theo EXIF orientation một lần, trước khi resize
+        ImageOps.exif_transpose(image, in_place=True)
+
+        # Chuyển đổi sang RGB nếu cần
+        if image.mode != 'RGB':
+            logger.info(f"Converting image from {image.mode} to RGB")
+            image = _replace(image, image.convert('RGB'))
+
+        # Tính toán kích thước mới
+        if max(image.size) > max_size:
+            ratio = max_size / max(image.size)
+            new_size = tuple(int(dim * ratio) for dim in image.size)
+            logger.info(f"Resizing image from {image.size} to {new_size}")
+            image = _replace(image, image.resize(new_size, Image.Resampling.LANCZOS))
+
+        buffer = _compress(image)
+        image.close()
+        # Mã hóa thẳng từ buffer, không tạo thêm bản sao bytes của JPEG
+        with buffer.getbuffer() as jpeg:
+            base64_data = base64.b64encode(jpeg).decode("ascii")
+        buffer.close()
+        logger.info(f"Final base64 size: {len(base64_data) / 1024:.2f}KB")
+        return base64_data
+
+    except Exception as e:
+        logger.error(f"Error encoding image: {str(e)}")
+        raise
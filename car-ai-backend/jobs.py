@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+JOB_DB_FILE = os.getenv("JOB_DB_FILE", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Thời gian giữ trạng thái và kết quả của một job
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+# Job queued/running không có heartbeat lâu hơn mức này coi như đã mất (worker gunicorn bị restart) và được chạy lại
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "120"))
+# Chu kỳ worker cập nhật updated_at của các job đang chờ hoặc đang chạy trong process
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", str(JOB_STALE_AFTER / 4)))
+# Số job mới giữa hai lần xóa job hết hạn
+JOB_PURGE_EVERY = int(os.getenv("JOB_PURGE_EVERY", "100"))
+# Khoảng thời gian đọc lại DB khi long-poll, để thấy job do worker khác cập nhật
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.25"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+
+class JobQueueFullError(Exception):
+    """The worker pool has no room for another job"""
+
+
+class JobStore:
+    """Job state and results in SQLite with a TTL, shared by all worker processes"""
+
+    def __init__(self, db_path=JOB_DB_FILE, ttl=JOB_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._claims_since_purge = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs (expires_at)")
+
+    @staticmethod
+    def _job(row):
+        job_id, status, result, error, created_at, updated_at = row
+        job = {"id": job_id, "status": status, "created_at": created_at, "updated_at": updated_at}
+        if result is not None:
+            job["result"] = json.loads(result)
+        if error is not None:
+            job["error"] = json.loads(error)
+        return job
+
+    def _get(self, job_id):
+        row = self._conn.execute(
+            "SELECT id, status, result, error, created_at, updated_at FROM jobs "
+            "WHERE id = ? AND expires_at > ?",
+            (job_id, time.time()),
+        ).fetchone()
+        return self._job(row) if row else None
+
+    def get(self, job_id):
+        with self._lock:
+            return self._get(job_id)
+
+    def claim(self, job_id):
+        """Create the job unless a live one exists; returns (job, created)
+
+        A finished job, or a queued/running one with a recent heartbeat, is
+        returned as is so resubmitting the same image is idempotent. A failed
+        job, or a queued/running one whose heartbeat stopped (its worker
+        process is gone), is replaced by a new run.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                job = self._get(job_id)
+                reusable = job is not None and (
+                    job["status"] == DONE
+                    # Job queued sau một hàng dài vẫn có heartbeat nên không bị chạy lần hai
+                    or (job["status"] in (QUEUED, RUNNING) and job["updated_at"] > now - JOB_STALE_AFTER)
+                )
+                if not reusable:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO jobs (id, status, result, error, created_at, updated_at, expires_at) "
+                        "VALUES (?, ?, NULL, NULL, ?, ?, ?)",
+                        (job_id, QUEUED, now, now, now + self.ttl),
+                    )
+                    job = self._get(job_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            if not reusable:
+                self._claims_since_purge += 1
+        if self._claims_since_purge >= JOB_PURGE_EVERY:
+            self.purge()
+        return job, not reusable
+
+    def update(self, job_id, status, result=None, error=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?, expires_at = ? WHERE id = ?",
+                (
+                    status,
+                    json.dumps(result, ensure_ascii=False) if result is not None else None,
+                    json.dumps(error, ensure_ascii=False) if error is not None else None,
+                    now,
+                    now + self.ttl,
+                    job_id,
+                ),
+            )
+            self._changed.notify_all()
+
+    def heartbeat(self, job_ids):
+        """Mark queued and running jobs as alive so claim() does not treat them as stale"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET updated_at = ? WHERE id = ? AND status IN (?, ?)",
+                [(now, job_id, QUEUED, RUNNING) for job_id in job_ids],
+            )
+
+    def wait(self, job_id, timeout):
+        """Block until the job is finished or timeout seconds pass; returns the job (or None)"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                job = self._get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] in FINISHED or remaining <= 0:
+                    return job
+                # Job của process này đánh thức ngay; job của worker khác được thấy ở lần đọc lại DB
+                self._changed.wait(min(remaining, JOB_POLL_INTERVAL))
+
+    def purge(self):
+        with self._lock:
+            self._claims_since_purge = 0
+            deleted = self._conn.execute("DELETE FROM jobs WHERE expires_at <= ?", (time.time(),)).rowcount
+        if deleted:
+            logger.info(f"Purged {deleted} expired jobs")
+        return deleted
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE expires_at > ? GROUP BY status", (time.time(),)
+            ).fetchall()
+        return dict(rows)
+
+
+class JobQueue:
+    """Bounded pool of worker threads running handler(job_id, *args) for submitted jobs"""
+
+    def __init__(self, store, handler, workers=JOB_WORKERS, max_size=JOB_QUEUE_SIZE):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stats_lock = threading.Lock()
+        self._stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0}
+        self._running = 0
+        self._active = set()  # id của job đang chờ hoặc đang chạy trong process này
+        self._threads = [
+            threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True) for i in range(workers)
+        ]
+        self._threads.append(threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job_id, *args):
+        with self._stats_lock:
+            self._active.add(job_id)
+        try:
+            self._queue.put_nowait((job_id, args))
+        except queue.Full:
+            with self._stats_lock:
+                self._active.discard(job_id)
+                self._stats["rejected"] += 1
+            raise JobQueueFullError(f"Job queue is full ({self._queue.maxsize} jobs)")
+        with self._stats_lock:
+            self._stats["submitted"] += 1
+
+    def _run(self):
+        while True:
+            job_id, args = self._queue.get()
+            with self._stats_lock:
+                self._running += 1
+            try:
+                self.store.update(job_id, RUNNING)
+                result, error = self.handler(job_id, *args)
+                self.store.update(job_id, FAILED if error else DONE, result=result, error=error)
+                outcome = "failed" if error else "completed"
+            except Exception as e:
+                logger.error(f"Error running job {job_id}: {str(e)}")
+                self.store.update(job_id, FAILED, error={"error": str(e), "status": 500})
+                outcome = "failed"
+            finally:
+                self._queue.task_done()
+            with self._stats_lock:
+                self._running -= 1
+                self._active.discard(job_id)
+                self._stats[outcome] += 1
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            with self._stats_lock:
+                active = list(self._active)
+            if not active:
+                continue
+            try:
+                self.store.heartbeat(active)
+            except Exception as e:
+                logger.error(f"Error updating job heartbeat: {str(e)}")
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["running"] = self._running
+        stats["workers"] = self.workers
+        stats["queue_depth"] = self._queue.qsize()
+        stats["max_queue_size"] = self._queue.maxsize
+        stats["jobs"] = self.store.counts()
+        return stats
@@ -0,0 +1,237 @@
+import bisect
+import contextvars
+import functools
+import inspect
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Số mẫu gần nhất của mỗi chuỗi dùng để tính p50/p95/p99
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1024"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+CALL_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class Histogram:
+    """Cumulative buckets for Prometheus plus a window of recent samples for quantiles"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, window=METRICS_WINDOW):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+            self._samples.append(value)
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            samples = sorted(self._samples)
+            total, count = self._sum, self._count
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        quantiles = {
+            q: samples[min(len(samples) - 1, int(len(samples) * q))] for q in QUANTILES
+        } if samples else {}
+        return {"buckets": cumulative, "sum": total, "count": count, "quantiles": quantiles}
+
+
+class RequestMetrics:
+    """Stage durations and Gemini calls of one request, shared by every thread working on it"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.gemini_calls = 0
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_gemini_call(self):
+        with self._lock:
+            self.gemini_calls += 1
+
+    def timings(self):
+        """Milliseconds per stage (summed when a stage runs more than once), Gemini calls and total"""
+        with self._lock:
+            timings = {f"{name}_ms": round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+            timings["gemini_calls"] = self.gemini_calls
+        timings["total_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return timings
+
+
+_lock = threading.Lock()
+_stage_histograms = {}
+_request_histograms = {}
+_call_histograms = {}
+_gemini_requests = {}
+
+
+def _histogram(table, key, buckets=LATENCY_BUCKETS):
+    histogram = table.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = table.setdefault(key, Histogram(buckets))
+    return histogram
+
+
+def observe_stage(name, seconds):
+    _histogram(_stage_histograms, name).observe(seconds)
+    current = _current.get()
+    if current is not None:
+        current.add_stage(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def timed(name):
+    """Decorator: record every call of the function (plain or coroutine) as the given stage"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_gemini_call(model, status):
+    """One HTTP attempt to Gemini; status is the HTTP code or None for a transport error"""
+    key = (model, str(status) if status is not None else "error")
+    with _lock:
+        _gemini_requests[key] = _gemini_requests.get(key, 0) + 1
+    current = _current.get()
+    if current is not None:
+        current.add_gemini_call()
+
+
+@contextmanager
+def activate(request_metrics):
+    """Attribute the stages run inside the block to request_metrics, without finishing it"""
+    token = _current.set(request_metrics)
+    try:
+        yield request_metrics
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def track_request(endpoint, request_metrics=None):
+    """Collect the stages of the request handled inside the block and record its totals on exit
+
+    Pass request_metrics to finish a request started earlier, e.g. one whose
+    response body is streamed after the view has returned.
+    """
+    request_metrics = request_metrics or RequestMetrics(endpoint)
+    try:
+        with activate(request_metrics):
+            yield request_metrics
+    finally:
+        _histogram(_request_histograms, endpoint).observe(time.perf_counter() - request_metrics.started)
+        _histogram(_call_histograms, endpoint, CALL_BUCKETS).observe(request_metrics.gemini_calls)
+
+
+def tracked(endpoint):
+    """Decorator: run the view (plain or coroutine) inside track_request(endpoint)"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with track_request(endpoint):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_request(endpoint):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current():
+    """RequestMetrics of the request being handled, or None outside one"""
+    return _current.get()
+
+
+def bind(func):
+    """func running in a copy of the current context, so request metrics follow it into a pool thread"""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _render_histogram(lines, name, help_text, label, table, quantile_name=None):
+    if not table:
+        return
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    snapshots = {key: histogram.snapshot() for key, histogram in sorted(table.items())}
+    for key, snapshot in snapshots.items():
+        for bound, count in snapshot["buckets"]:
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{_format_value(bound)}"}} {count}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {_format_value(snapshot["sum"])}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {snapshot["count"]}')
+    if quantile_name:
+        lines.append(f"# HELP {quantile_name} p50/p95/p99 over the last {METRICS_WINDOW} observations")
+        lines.append(f"# TYPE {quantile_name} gauge")
+        for key, snapshot in snapshots.items():
+            for q, value in snapshot["quantiles"].items():
+                lines.append(f'{quantile_name}{{{label}="{key}",quantile="{q}"}} {_format_value(value)}')
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    _render_histogram(lines, "car_ai_stage_duration_seconds", "Duration of each analysis stage",
+                      "stage", _stage_histograms, "car_ai_stage_latency_seconds")
+    _render_histogram(lines, "car_ai_request_duration_seconds", "Duration of analysis requests",
+                      "endpoint", _request_histograms, "car_ai_request_latency_seconds")
+    _render_histogram(lines, "car_ai_gemini_calls_per_request", "Gemini HTTP requests made per analysis request",
+                      "endpoint", _call_histograms, "car_ai_gemini_calls_per_request_quantile")
+    with _lock:
+        gemini_requests = sorted(_gemini_requests.items())
+    if gemini_requests:
+        lines.append("# HELP car_ai_gemini_requests_total Gemini HTTP requests by model and status")
+        lines.append("# TYPE car_ai_gemini_requests_total counter")
+        for (model, status), count in gemini_requests:
+            lines.append(f'car_ai_gemini_requests_total{{model="{model}",status="{status}"}} {count}')
+    return "\n".join(lines) + "\n"
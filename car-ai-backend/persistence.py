@@ -0,0 +1,179 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# "async": ghi lịch sử/collection ở background; "sync": ghi ngay trong request
+PERSIST_MODE = os.getenv("PERSIST_MODE", "async")
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "1000"))
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "100"))
+# Thời gian chờ gom thêm bản ghi vào cùng một batch
+PERSIST_LINGER = float(os.getenv("PERSIST_LINGER", "0.05"))
+# Hàng đợi đầy quá thời gian này thì ghi đồng bộ trên request thread
+PERSIST_ENQUEUE_TIMEOUT = float(os.getenv("PERSIST_ENQUEUE_TIMEOUT", "1.0"))
+PERSIST_SHUTDOWN_TIMEOUT = float(os.getenv("PERSIST_SHUTDOWN_TIMEOUT", "10"))
+# Số lần thử lại phần batch của một store bị lỗi (các store khác không ghi lại), chờ tăng dần
+PERSIST_RETRIES = int(os.getenv("PERSIST_RETRIES", "2"))
+PERSIST_RETRY_DELAY = float(os.getenv("PERSIST_RETRY_DELAY", "0.1"))
+
+_STOP = object()
+
+
+class PersistenceQueue:
+    """Write-behind queue: a background thread writes records in coalesced batches
+
+    writers maps a store name to a function writing a whole batch to that
+    store in one transaction. Each store is written and retried on its own,
+    so a failing store does not drop or rewrite the others.
+    """
+
+    def __init__(self, writers, mode=PERSIST_MODE, max_size=PERSIST_QUEUE_SIZE,
+                 batch_size=PERSIST_BATCH_SIZE, linger=PERSIST_LINGER,
+                 retries=PERSIST_RETRIES, retry_delay=PERSIST_RETRY_DELAY):
+        self.writers = writers
+        self.mode = mode
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.linger = linger
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "failed": 0,
+            "retries": 0,
+            "store_failures": {name: 0 for name in writers},
+            "sync_fallbacks": 0,
+            "batches": 0,
+            "max_queue_depth": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+        self._thread = None
+        if mode == "async":
+            self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def submit(self, *item):
+        """Queue one record for writing; blocks briefly, then writes inline, when the queue is full"""
+        with self._stats_lock:
+            self._stats["submitted"] += 1
+        if self._thread is None or not self._thread.is_alive():
+            self._write([item])
+            return
+        try:
+            self._queue.put(item, timeout=PERSIST_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            logger.warning("Persistence queue is full, writing on the request thread")
+            with self._stats_lock:
+                self._stats["sync_fallbacks"] += 1
+            self._write([item])
+            return
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], depth)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                try:
+                    remaining = deadline - time.monotonic()
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            for _ in range(len(batch) + (1 if stopping else 0)):
+                self._queue.task_done()
+            if stopping:
+                return
+
+    def _write_store(self, name, batch):
+        """Write batch to one store, retrying only that store; returns True on success"""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._stats_lock:
+                    self._stats["retries"] += 1
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self.writers[name](batch)
+                return True
+            except Exception as e:
+                logger.error(f"Error writing {len(batch)} records to {name} (attempt {attempt + 1}): {str(e)}")
+        return False
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        failed_stores = [name for name in self.writers if not self._write_store(name, batch)]
+        failed = len(batch) if failed_stores else 0
+        elapsed = time.perf_counter() - start
+        metrics.observe_stage("persistence", elapsed)
+        elapsed_ms = elapsed * 1000
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["written"] += len(batch) - failed
+            self._stats["failed"] += failed
+            for name in failed_stores:
+                self._stats["store_failures"][name] += len(batch)
+            self._stats["last_batch_size"] = len(batch)
+            self._stats["max_batch_size"] = max(self._stats["max_batch_size"], len(batch))
+            self._stats["last_flush_ms"] = round(elapsed_ms, 3)
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], round(elapsed_ms, 3))
+            self._stats["total_flush_ms"] += elapsed_ms
+
+    def flush(self, timeout=PERSIST_SHUTDOWN_TIMEOUT):
+        """Wait until every queued record has been written; returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout=PERSIST_SHUTDOWN_TIMEOUT):
+        """Flush pending records and stop the worker thread"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.error("Persistence queue did not drain before shutdown")
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Persistence queue still has {self._queue.qsize()} records after shutdown timeout")
+        else:
+            logger.info("Persistence queue flushed")
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["store_failures"] = dict(stats["store_failures"])
+        total_flush_ms = stats.pop("total_flush_ms")
+        batches = stats["batches"]
+        stats["avg_flush_ms"] = round(total_flush_ms / batches, 3) if batches else 0.0
+        stats["avg_batch_size"] = round((stats["written"] + stats["failed"]) / batches, 2) if batches else 0.0
+        stats["queue_depth"] = self._queue.qsize()
+        stats["mode"] = self.mode if self._thread is not None else "sync"
+        return stats
@@ -0,0 +1,281 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Thứ tự ưu tiên khi chờ slot: số nhỏ đi trước
+PRIORITY_PRIMARY = 0  # nhận diện xe, người dùng đang chờ
+PRIORITY_ENRICHMENT = 1  # nghiên cứu động cơ/thông số
+PRIORITY_TRANSLATION = 2
+
+# Số request/giây cho mỗi model, "model=rate,...", trong một worker process. 0 = không giới hạn
+GEMINI_RATE_LIMITS = os.getenv("GEMINI_RATE_LIMITS", "gemini-1.5-flash=10,gemini-pro=5")
+# Số giây quota có thể dùng dồn một lúc
+GEMINI_RATE_BURST = float(os.getenv("GEMINI_RATE_BURST", "2"))
+# Giới hạn số request đồng thời (AIMD điều chỉnh trong khoảng này)
+GEMINI_MIN_CONCURRENCY = int(os.getenv("GEMINI_MIN_CONCURRENCY", "1"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+# Phản hồi chậm hơn mức này được coi là upstream quá tải
+GEMINI_LATENCY_TARGET = float(os.getenv("GEMINI_LATENCY_TARGET", "8"))
+# Khoảng cách tối thiểu giữa hai lần giảm, để một loạt 429 chỉ giảm một lần
+GEMINI_AIMD_COOLDOWN = float(os.getenv("GEMINI_AIMD_COOLDOWN", "2"))
+# Thời gian chờ tối đa cho một slot và token
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30"))
+
+THROTTLED_DECREASE = 0.5
+SLOW_DECREASE = 0.8
+
+
+class QueueTimeoutError(Exception):
+    """No Gemini slot or rate-limit token became available in time"""
+
+
+def parse_rate_limits(value):
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, rate = item.split("=", 1)
+            limits[model.strip()] = float(rate)
+    return limits
+
+
+RATE_LIMITS = parse_rate_limits(GEMINI_RATE_LIMITS)
+
+
+class TokenBucket:
+    """Requests per second with a burst allowance; a token is only taken when one is available now"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a token if one is available (returns 0), else the seconds until the next one"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Không đặt trước token: token mới được trao theo thứ tự ưu tiên trong heap, không theo giờ đến
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("granted", "cancelled", "wake")
+
+    def __init__(self, wake):
+        self.granted = False
+        self.cancelled = False
+        self.wake = wake
+
+
+class AdaptiveLimiter:
+    """Per-model token bucket plus an AIMD concurrency limit with priority admission
+
+    The limit grows by one per round of successful requests and is cut on 429
+    or slow responses. Waiters are admitted by priority, then arrival order;
+    admission takes both a slot and a rate-limit token, so tokens follow the
+    same order when the rate is the binding limit.
+    """
+
+    def __init__(self, name, rate=0, burst_seconds=GEMINI_RATE_BURST, min_limit=GEMINI_MIN_CONCURRENCY,
+                 max_limit=GEMINI_MAX_CONCURRENCY, latency_target=GEMINI_LATENCY_TARGET):
+        self.name = name
+        self.bucket = TokenBucket(rate, rate * burst_seconds) if rate > 0 else None
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.latency_target = latency_target
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._waiters = []  # heap (priority, seq, waiter)
+        self._seq = itertools.count()
+        self._last_decrease = 0.0
+        self._token_timer = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "admitted": 0, "queued": 0, "queue_timeouts": 0,
+            "throttled": 0, "slow": 0, "decreases": 0, "increases": 0,
+        }
+        self._admitted_by_priority = {}
+
+    def _admit(self, priority):
+        # Gọi khi đang giữ lock
+        self.in_flight += 1
+        self._stats["admitted"] += 1
+        self._admitted_by_priority[priority] = self._admitted_by_priority.get(priority, 0) + 1
+
+    def _take_token(self):
+        """0 if a token was taken, else seconds until the next one (lock held)"""
+        return self.bucket.take() if self.bucket is not None else 0.0
+
+    def _grant(self):
+        """Hand free slots and tokens to the highest-priority waiters (lock held)"""
+        while self._waiters and self.in_flight < int(self.limit):
+            priority, _, waiter = self._waiters[0]
+            if waiter.cancelled:
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._take_token()
+            if delay > 0:
+                # Hết token: chờ token kế tiếp rồi trao cho waiter đứng đầu heap lúc đó
+                self._schedule_grant(delay)
+                return
+            heapq.heappop(self._waiters)
+            self._admit(priority)
+            waiter.granted = True
+            waiter.wake()
+
+    def _schedule_grant(self, delay):
+        if self._token_timer is not None:
+            return
+        self._token_timer = threading.Timer(delay, self._on_token)
+        self._token_timer.daemon = True
+        self._token_timer.start()
+
+    def _on_token(self):
+        with self._lock:
+            self._token_timer = None
+            self._grant()
+
+    def _enqueue(self, priority, wake):
+        """Take a slot and a token now (returns None) or queue a waiter for them (lock held)"""
+        if self.in_flight < int(self.limit) and not self._waiters:
+            delay = self._take_token()
+            if delay == 0:
+                self._admit(priority)
+                return None
+            self._schedule_grant(delay)
+        waiter = _Waiter(wake)
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        self._stats["queued"] += 1
+        # Các waiter đứng trước có thể đã bỏ cuộc trong khi slot và token vẫn còn
+        self._grant()
+        return waiter
+
+    def _abandon(self, waiter):
+        """The waiter gave up; returns True if a slot had been granted meanwhile"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self._stats["queue_timeouts"] += 1
+            return False
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._grant()
+
+    def acquire(self, priority, timeout=GEMINI_QUEUE_TIMEOUT):
+        """Block until a slot and a token are available"""
+        event = threading.Event()
+        with self._lock:
+            waiter = self._enqueue(priority, event.set)
+        if waiter is not None and not event.wait(timeout):
+            if not self._abandon(waiter):
+                raise QueueTimeoutError(f"{self.name}: no request slot or rate-limit token within {timeout}s")
+
+    async def acquire_async(self, priority, timeout=GEMINI_QUEUE_TIMEOUT):
+        """Async twin of acquire; slots and tokens are shared with threads of the same process"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            waiter = self._enqueue(priority, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                if not self._abandon(waiter):
+                    raise QueueTimeoutError(f"{self.name}: no request slot or rate-limit token within {timeout}s")
+            except asyncio.CancelledError:
+                if self._abandon(waiter):
+                    self.release()
+                raise
+
+    def record(self, status, latency):
+        """Feed back one response: status None means a timeout or connection error"""
+        with self._lock:
+            now = time.monotonic()
+            throttled = status == 429
+            slow = status is None or latency > self.latency_target
+            if throttled:
+                self._stats["throttled"] += 1
+            elif slow:
+                self._stats["slow"] += 1
+
+            if throttled or slow:
+                if now - self._last_decrease >= GEMINI_AIMD_COOLDOWN:
+                    factor = THROTTLED_DECREASE if throttled else SLOW_DECREASE
+                    previous = self.limit
+                    self.limit = max(float(self.min_limit), self.limit * factor)
+                    self._last_decrease = now
+                    self._stats["decreases"] += 1
+                    logger.warning(
+                        f"{self.name}: concurrency limit {previous:.1f} -> {self.limit:.1f} "
+                        f"({'429' if throttled else f'{latency:.1f}s'})"
+                    )
+            elif status < 500 and self.limit < self.max_limit:
+                # Tăng cộng: +1 sau khoảng `limit` request thành công
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+                self._stats["increases"] += 1
+                self._grant()
+
+    @contextmanager
+    def slot(self, priority, timeout=GEMINI_QUEUE_TIMEOUT):
+        self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self, priority, timeout=GEMINI_QUEUE_TIMEOUT):
+        await self.acquire_async(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["limit"] = round(self.limit, 2)
+            stats["in_flight"] = self.in_flight
+            stats["waiting"] = sum(1 for _, _, waiter in self._waiters if not waiter.cancelled)
+            stats["admitted_by_priority"] = dict(self._admitted_by_priority)
+        stats["rate"] = self.bucket.rate if self.bucket else None
+        return stats
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(model):
+    """One limiter per model endpoint, shared by all threads and the event loop of this process"""
+    limiter = _limiters.get(model)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(model)
+            if limiter is None:
+                limiter = _limiters[model] = AdaptiveLimiter(model, rate=RATE_LIMITS.get(model, 0))
+    return limiter
+
+
+def stats():
+    return {model: limiter.stats() for model, limiter in list(_limiters.items())}
@@ -0,0 +1,257 @@
+import re
+
+# Bản ghi phân tích không phụ thuộc ngôn ngữ: thông số dạng số + văn bản theo từng ngôn ngữ.
+# Lưu trong result cache, lịch sử và collection; render(record, lang) ra response cũ.
+RECORD_VERSION = 1
+
+SPEC_NAMES = ("year", "price", "power", "acceleration", "top_speed")
+SUMMARY_SPECS = ("year", "price", "power", "top_speed")
+TEXT_FIELDS = ("description", "engineDetail", "interior")
+
+NUMBER = r"\d+(?:[.,]\d+)*"
+YEAR = re.compile(r"\b(?:18|19|20)\d{2}\b")
+MULTIPLIER = r"(?:million|mil|m|triệu|billion|bn|b|tỷ|tỉ|thousand|k|nghìn|ngàn)"
+MULTIPLIERS = {
+    "million": 1e6, "mil": 1e6, "m": 1e6, "triệu": 1e6,
+    "billion": 1e9, "bn": 1e9, "b": 1e9, "tỷ": 1e9, "tỉ": 1e9,
+    "thousand": 1e3, "k": 1e3, "nghìn": 1e3, "ngàn": 1e3,
+}
+RANGE = r"\s*(?:-|–|—|~|to|đến|tới)\s*"
+# Số chỉ được lấy khi đứng ngay trước đơn vị của thông số: "6.5L V12, 740 hp" -> 740, không phải 6.5
+UNIT_VALUES = {
+    "power": re.compile(rf"({NUMBER})(?:{RANGE}({NUMBER}))?\s*(hp|bhp|ps|cv|kw|mã lực)\b", re.IGNORECASE),
+    "top_speed": re.compile(rf"({NUMBER})(?:{RANGE}({NUMBER}))?\s*(km/h|kph|mph)(?!\w)", re.IGNORECASE),
+    "acceleration": re.compile(rf"({NUMBER})(?:{RANGE}({NUMBER}))?\s*(seconds|second|secs|sec|s|giây)\b", re.IGNORECASE),
+}
+PRICE_VALUE = re.compile(
+    rf"([$€]?)\s*({NUMBER})\s*({MULTIPLIER}\b)?(?:{RANGE}[$€]?\s*({NUMBER})\s*({MULTIPLIER}\b)?)?",
+    re.IGNORECASE,
+)
+CURRENCIES = (("VND", re.compile(r"vnd|vnđ|đồng|₫", re.IGNORECASE)), ("EUR", re.compile(r"€|\beur", re.IGNORECASE)),
+              ("USD", re.compile(r"\$|\busd\b", re.IGNORECASE)))
+# Giá trị chỉ gồm số (hoặc khoảng) và đơn vị, không có chữ nào khác: dựng lại được ở ngôn ngữ khác.
+# "Under 3 seconds", "from $40,000 depending on options" giữ nguyên văn bản gốc.
+EXACT = {
+    "year": re.compile(rf"^\s*(?:18|19|20)\d{{2}}(?:{RANGE}(?:18|19|20)\d{{2}})?\s*$", re.IGNORECASE),
+    "price": re.compile(
+        rf"^\s*[$€]?\s*{NUMBER}\s*(?:{MULTIPLIER}\b)?\s*(?:{RANGE}[$€]?\s*{NUMBER}\s*(?:{MULTIPLIER}\b)?)?"
+        r"\s*(?:usd|eur|vnd|vnđ|đồng|₫)?\s*$",
+        re.IGNORECASE,
+    ),
+    "power": re.compile(rf"^\s*{NUMBER}(?:{RANGE}{NUMBER})?\s*(?:hp|bhp|ps|cv|kw|mã lực)\s*$", re.IGNORECASE),
+    "top_speed": re.compile(rf"^\s*{NUMBER}(?:{RANGE}{NUMBER})?\s*(?:km/h|kph|mph)\s*$", re.IGNORECASE),
+    "acceleration": re.compile(
+        rf"^\s*{NUMBER}(?:{RANGE}{NUMBER})?\s*(?:seconds|second|secs|sec|s|giây)\s*$", re.IGNORECASE
+    ),
+}
+# Đổi về một đơn vị chung cho mỗi thông số
+TO_HP = {"kw": 1.341, "ps": 0.986, "cv": 0.986}
+MPH_TO_KMH = 1.609
+
+UNIT_TEXT = {
+    "s": {"en": "seconds", "vi": "giây"},
+}
+SPEC_UNITS = {"power": "hp", "top_speed": "km/h", "acceleration": "s"}
+
+
+def _number(token):
+    """Float of a number token; groups of exactly three digits are thousands ("4,500,000", "26.000")"""
+    if token is None:
+        return None
+    parts = re.split(r"[.,]", token)
+    if len(parts) > 1 and all(len(part) == 3 for part in parts[1:]):
+        return float("".join(parts))
+    if len(parts) == 2:
+        return float(f"{parts[0]}.{parts[1]}")
+    if len(parts) == 1:
+        return float(token)
+    return None
+
+
+def _multiplier(word):
+    return MULTIPLIERS[word.lower()] if word else None
+
+
+def _converted(value, factor):
+    # Giá trị đổi đơn vị được làm tròn như số liệu công bố
+    if value is None or factor == 1:
+        return value
+    return float(round(value * factor))
+
+
+def _spec(value, high, unit, raw, exact=False):
+    spec = {"value": round(value, 2) if value is not None else None, "unit": unit, "raw": raw}
+    if high is not None and value is not None and high != value:
+        spec["max"] = round(high, 2)
+    # exact: raw chỉ là số + đơn vị nên có thể hiển thị lại từ value ở ngôn ngữ khác
+    spec["exact"] = exact and value is not None
+    return spec
+
+
+def _price(raw):
+    match = PRICE_VALUE.search(raw)
+    currency = next((code for code, pattern in CURRENCIES if pattern.search(raw)), None)
+    if not match or not currency:
+        return _spec(None, None, None, raw)
+    low, high = _number(match.group(2)), _number(match.group(4))
+    # "$1.5 - 2 million": hệ số sau số cuối áp dụng cho cả khoảng nếu số đầu không có hệ số riêng
+    high_factor = _multiplier(match.group(5)) or 1
+    low *= _multiplier(match.group(3)) or (high_factor if high is not None else 1)
+    if high is not None:
+        high *= high_factor
+    return _spec(low, high, currency, raw, bool(EXACT["price"].match(raw)))
+
+
+def parse_spec(name, raw):
+    """Structured value of one displayed spec; value is None when raw has no number tied to the spec's unit"""
+    raw = (raw or "").strip()
+    if name == "year":
+        years = [int(year) for year in YEAR.findall(raw)]
+        return _spec(min(years) if years else None, max(years) if years else None, "year", raw,
+                     bool(EXACT["year"].match(raw)))
+    if name == "price":
+        return _price(raw)
+    match = UNIT_VALUES[name].search(raw)
+    if not match:
+        return _spec(None, None, SPEC_UNITS[name], raw)
+    low, high, unit = _number(match.group(1)), _number(match.group(2)), match.group(3).lower()
+    if name == "power":
+        factor = TO_HP.get(unit, 1)
+    elif name == "top_speed":
+        factor = MPH_TO_KMH if unit == "mph" else 1
+    else:
+        factor = 1
+    return _spec(_converted(low, factor), _converted(high, factor), SPEC_UNITS[name], raw,
+                 bool(EXACT[name].match(raw)))
+
+
+def _format_number(value, grouping=False):
+    if value == int(value):
+        return f"{int(value):,}" if grouping else str(int(value))
+    text = f"{value:,.2f}" if grouping else f"{value:.2f}"
+    return text.rstrip("0").rstrip(".")
+
+
+def render_spec(spec, lang):
+    """Display text of a structured spec built from its numbers, in the given language"""
+    if not spec:
+        return "N/A"
+    value = spec.get("value")
+    if value is None:
+        return spec.get("raw") or "N/A"
+    unit = spec.get("unit")
+    high = spec.get("max")
+    amounts = [amount for amount in (value, high) if amount is not None]
+    if unit == "year":
+        return "-".join(str(int(amount)) for amount in amounts)
+    if unit in ("USD", "EUR", "VND"):
+        symbol = {"USD": "$", "EUR": "€"}.get(unit, "")
+        return f"{' - '.join(f'{symbol}{_format_number(amount, grouping=True)}' for amount in amounts)} {unit}"
+    text = " - ".join(_format_number(amount) for amount in amounts)
+    unit_text = UNIT_TEXT.get(unit, {}).get(lang, UNIT_TEXT.get(unit, {}).get("en", unit))
+    return f"{text} {unit_text}" if unit_text else text
+
+
+def display_spec(spec, lang, source_lang):
+    """The model's own text in the language it was written in; rebuilt from numbers elsewhere only when exact"""
+    if not spec:
+        return "N/A"
+    if spec.get("raw") and (lang == source_lang or not spec.get("exact")):
+        return spec["raw"]
+    return render_spec(spec, lang)
+
+
+def features(interior):
+    """Feature list shown by the app: the dash bullet lines of the interior text"""
+    return [line.strip('- ').strip() for line in (interior or "").split('\n') if line.strip().startswith('-')]
+
+
+def from_response(response_data, lang, image_key=None):
+    """Language-neutral record of an /analyze_car response generated in lang"""
+    texts = {field: response_data.get(field) or "" for field in TEXT_FIELDS}
+    texts["features"] = list(response_data.get("features") or features(texts["interior"]))
+    return {
+        "record_version": RECORD_VERSION,
+        "car_name": response_data.get("car_name"),
+        "brand": response_data.get("brand"),
+        "lang": lang,
+        "image_key": image_key,
+        "specs": {name: parse_spec(name, response_data.get(name)) for name in SPEC_NAMES},
+        "texts": {lang: texts},
+        "processing_time": response_data.get("processing_time"),
+        "timestamp": response_data.get("timestamp"),
+    }
+
+
+def with_texts(record, lang, texts):
+    """The record with the text fields of one more language"""
+    texts = {field: texts.get(field) or "" for field in TEXT_FIELDS}
+    texts["features"] = features(texts["interior"])
+    return {**record, "texts": {**record["texts"], lang: texts}}
+
+
+def merge(existing, record):
+    """A new analysis of the same image keeps the languages the old record already had"""
+    if not is_record(existing):
+        return record
+    return {**record, "texts": {**existing["texts"], **record["texts"]}}
+
+
+def is_record(data):
+    return isinstance(data, dict) and data.get("record_version") is not None and "texts" in data
+
+
+def text_language(record, lang):
+    """lang if the record has text in it, else the language it was generated in"""
+    return lang if lang in record["texts"] else record["lang"]
+
+
+def render(record, lang):
+    """The /analyze_car response for one language; text falls back to the record's own language"""
+    text_lang = text_language(record, lang)
+    texts = record["texts"][text_lang]
+    specs = record["specs"]
+    return {
+        "car_name": record["car_name"],
+        "brand": record["brand"],
+        **{name: display_spec(specs.get(name), lang, record["lang"]) for name in SPEC_NAMES},
+        "description": texts["description"],
+        "engineDetail": texts["engineDetail"],
+        "interior": texts["interior"],
+        "features": texts["features"],
+        "processing_time": record.get("processing_time"),
+        "timestamp": record.get("timestamp"),
+        "specs": specs,
+        "lang": text_lang,
+    }
+
+
+def summary(record):
+    """The projection stored for the history list screen"""
+    return {
+        "record_version": RECORD_VERSION,
+        "car_name": record["car_name"],
+        "brand": record["brand"],
+        "lang": record["lang"],
+        "specs": {name: record["specs"].get(name) for name in SUMMARY_SPECS},
+        "timestamp": record.get("timestamp"),
+    }
+
+
+def display_year(record):
+    return display_spec(record["specs"].get("year"), record["lang"], record["lang"])
+
+
+def localize(item, lang=None):
+    """A stored history/collection entry in lang (its own language when None); old flat entries as is"""
+    if not isinstance(item, dict) or item.get("record_version") is None:
+        return item
+    lang = lang or item["lang"]
+    if "texts" in item:
+        return render(item, lang)
+    return {
+        "car_name": item["car_name"],
+        "brand": item["brand"],
+        **{name: display_spec(item["specs"].get(name), lang, item["lang"]) for name in SUMMARY_SPECS},
+        "timestamp": item.get("timestamp"),
+    }
@@ -0,0 +1,129 @@
+import asyncio
+import functools
+import inspect
+import threading
+
+
+class CoalescedCallCancelled(Exception):
+    """The call another request was waiting on was cancelled (e.g. its stage timed out)"""
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution and all get its result or error"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call (threads)
+        self._async_calls = {}  # key -> asyncio.Future (event loop)
+        self._stats = {}
+
+    def _enter(self, key, table, create):
+        """Register a caller; returns (leader?, the shared call)"""
+        with self._lock:
+            stats = self._stats.setdefault(key[0], {"calls": 0, "executions": 0, "coalesced": 0, "errors": 0})
+            stats["calls"] += 1
+            call = table.get(key)
+            if call is not None:
+                stats["coalesced"] += 1
+                return False, call
+            stats["executions"] += 1
+            call = table[key] = create()
+            return True, call
+
+    def _leave(self, key, table, failed):
+        with self._lock:
+            del table[key]
+            if failed:
+                self._stats[key[0]]["errors"] += 1
+
+    def do(self, key, func):
+        """Run func() unless a call with this key is already running in another thread"""
+        leader, call = self._enter(key, self._calls, _Call)
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._leave(key, self._calls, call.error is not None)
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, func):
+        """Await func() unless a call with this key is already pending on the event loop"""
+        loop = asyncio.get_running_loop()
+        leader, future = self._enter(key, self._async_calls, loop.create_future)
+        if not leader:
+            # shield: một request bị hủy không được hủy lời gọi chung
+            return await asyncio.shield(future)
+
+        failed = True
+        try:
+            result = await func()
+            future.set_result(result)
+            failed = False
+            return result
+        except asyncio.CancelledError:
+            future.set_exception(CoalescedCallCancelled(f"{key[0]} was cancelled"))
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            if failed:
+                future.exception()  # Đánh dấu đã đọc khi không có ai chờ
+            self._leave(key, self._async_calls, failed)
+
+    def stats(self):
+        with self._lock:
+            functions = {name: dict(stats) for name, stats in self._stats.items()}
+            in_flight = len(self._calls) + len(self._async_calls)
+        for stats in functions.values():
+            stats["coalesce_rate"] = round(stats["coalesced"] / stats["calls"], 4) if stats["calls"] else 0.0
+        return {"in_flight": in_flight, "functions": functions}
+
+
+# Dùng chung cho cả process: mọi thread của một worker gunicorn
+flights = SingleFlight()
+
+
+def coalesced(key_func, group=flights):
+    """Decorator: concurrent calls whose key_func(*args) match share one execution
+
+    Works for plain functions (across threads) and coroutine functions (on the event loop).
+    """
+    def decorator(func):
+        name = func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = (name, key_func(*args, **kwargs))
+                return await group.do_async(key, lambda: func(*args, **kwargs))
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (name, key_func(*args, **kwargs))
+            return group.do(key, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def stats():
+    return flights.stats()